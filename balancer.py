@@ -5,5 +5,15 @@
 @copyright 2013, Maprox LLC
 """
 
-from kernel.balancer import PacketReceiveBalancer
-PacketReceiveBalancer().run()
\ No newline at end of file
+from kernel.config import conf
+from kernel.metrics import reporter
+
+# counters of the balancer (like timeouts of devices) are written to the log
+reporter.start()
+
+if conf.messageTransport == 'redis':
+    from kernel.streambalancer import StreamReceiveBalancer
+    StreamReceiveBalancer().run()
+else:
+    from kernel.balancer import PacketReceiveBalancer
+    PacketReceiveBalancer().run()
\ No newline at end of file
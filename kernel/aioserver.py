@@ -0,0 +1,405 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Asyncio TCP-server
+@copyright 2009-2016, Maprox LLC
+"""
+
+import socket
+import asyncio
+import traceback
+from collections import deque
+from threading import Thread, Condition
+from concurrent.futures import ThreadPoolExecutor
+
+from kernel.logger import log
+from kernel.config import conf
+import kernel.pipe as pipe
+from lib.handlers.list import HandlerClass
+
+# interval of processEvents() calls for idle connections (seconds)
+IDLE_EVENTS_TIMEOUT = 60
+
+
+# ===========================================================================
+class AsyncSocketAdapter:
+    """
+     Socket-like object, which is given to AbstractHandler instead of
+     the real socket. Data is pushed into it by the event loop and is
+     read by the handler from a worker thread, so handlers written
+     for blocking sockets work without any changes.
+     Handlers are fed by processData(), they must not wait for data in
+     recv() (it would hold a worker of the pool, see the handshake of
+     teltonika configuration in TeltonikaHandler.processBuffer).
+    """
+
+    def __init__(self, connection):
+        """
+         Adapter constructor
+         @param connection: AsyncClientConnection instance
+        """
+        self._connection = connection
+        self._chunks = deque()
+        self._condition = Condition()
+        self._closed = False
+        self._timeout = None
+
+    def push(self, data):
+        """
+         Stores data chunk received by the event loop
+         @param data: bytes
+        """
+        with self._condition:
+            self._chunks.append(data)
+            self._condition.notify()
+
+    def close(self):
+        """
+         Marks adapter as closed (connection is lost)
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def settimeout(self, value):
+        """
+         Sets timeout for recv() calls
+         @param value: seconds
+        """
+        self._timeout = value
+
+    def recv(self, size):
+        """
+         Returns received data (blocks until data is received).
+         Raises socket.timeout if there is no data within timeout.
+         @param size: maximum size of returned data
+         @return: bytes (empty if connection is closed)
+        """
+        with self._condition:
+            if not self._chunks and not self._closed:
+                self._condition.wait(self._timeout)
+            if not self._chunks:
+                if self._closed:
+                    return b''
+                raise socket.timeout('timed out')
+            data = self._chunks.popleft()
+            if len(data) > size:
+                self._chunks.appendleft(data[size:])
+                data = data[:size]
+            return data
+
+    def recv_into(self, buffer, nbytes = 0):
+        """
+         Receives data into the buffer (see recv())
+         @param buffer: writable bytes-like object
+         @param nbytes: maximum size of received data
+         @return: Number of received bytes
+        """
+        data = self.recv(nbytes or len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def recvNowait(self):
+        """
+         Returns the next received chunk or None if there is no data
+         @return: bytes or None
+        """
+        with self._condition:
+            if not self._chunks:
+                return None
+            return self._chunks.popleft()
+
+    def send(self, data):
+        """
+         Sends data to the client (thread-safe)
+         @param data: bytes
+         @return: int
+        """
+        self._connection.write(data)
+        return len(data)
+
+    sendall = send
+
+
+# ===========================================================================
+class AsyncClientConnection(asyncio.Protocol):
+    """
+     Connection protocol of the asyncio server.
+     Keeps handler instance and serializes all its calls: handler
+     methods are executed one at a time in the server's worker pool,
+     so idle connections do not hold any thread.
+    """
+
+    def __init__(self, server, handlerClass):
+        """
+         Constructor
+         @param server: AsyncServer instance
+         @param handlerClass: Protocol handler class of the listener
+        """
+        self._server = server
+        self._handlerClass = handlerClass
+        self._loop = server.loop
+        self._transport = None
+        self._handler = None
+        self._idleTimer = None
+        self._busy = False
+        self._eventsPending = False
+        self._condition = Condition()
+        self.request = AsyncSocketAdapter(self)
+        self.client_address = None
+
+    @property
+    def handler(self):
+        return self._handler
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self.client_address = transport.get_extra_info('peername')
+        self._server.connectionsCount += 1
+        self._server.connections.add(self)
+        self._handler = self._handlerClass(pipe.Manager(), self)
+        self._resetIdleTimer()
+
+    def data_received(self, data):
+        self.request.push(data)
+        self._resetIdleTimer()
+        self._schedule()
+
+    def connection_lost(self, exc):
+        log.debug('AsyncClientConnection lost: %s', exc)
+        self._server.connectionsCount -= 1
+        self._server.connections.discard(self)
+        if self._idleTimer:
+            self._idleTimer.cancel()
+            self._idleTimer = None
+        self.request.close()
+        with self._condition:
+            if not self._busy:
+                self._handler = None
+
+    def write(self, data):
+        """
+         Writes data to the transport from any thread
+         @param data: bytes
+        """
+        if self._transport is None or self._transport.is_closing():
+            return
+        self._loop.call_soon_threadsafe(self._transport.write, bytes(data))
+
+    def close(self):
+        """
+         Closes connection (called in the event loop thread)
+        """
+        if self._transport is not None:
+            self._transport.close()
+
+    def _resetIdleTimer(self):
+        """
+         Restarts timer of processEvents() calls
+        """
+        if self._idleTimer:
+            self._idleTimer.cancel()
+        self._idleTimer = self._loop.call_later(
+            IDLE_EVENTS_TIMEOUT, self._onIdle)
+
+    def _onIdle(self):
+        self._idleTimer = None
+        with self._condition:
+            self._eventsPending = True
+        self._schedule()
+        self._resetIdleTimer()
+
+    def _schedule(self):
+        """
+         Submits processing job if it is not running yet
+        """
+        with self._condition:
+            if self._busy or self._handler is None:
+                return
+            self._busy = True
+        self._server.executor.submit(self._process)
+
+    def _process(self):
+        """
+         Worker job: feeds received data and events to the handler
+        """
+        while True:
+            with self._condition:
+                handler = self._handler
+                data = self.request.recvNowait()
+                if data is None and not self._eventsPending:
+                    self._busy = False
+                    if self.request.closed:
+                        self._handler = None
+                    return
+                if data is None:
+                    self._eventsPending = False
+            try:
+                if data is not None:
+                    handler.processData(data)
+                else:
+                    handler.processEvents()
+            except Exception:
+                log.error("Dispatch error: %s", traceback.format_exc())
+
+
+# ===========================================================================
+class AsyncServer:
+    """
+     Asyncio TCP-server.
+     Holds all connections of all its listeners in one event loop thread.
+    """
+    loop = None
+    executor = None
+    servers = None
+    connectionsCount = 0
+
+    def __init__(self, port, handlerClass = None, reusePort = False):
+        """
+         Server class constructor
+         @param port: Listening port
+         @param handlerClass: Protocol handler class
+         @param reusePort: Share listening ports with other processes
+        """
+        log.debug("AsyncServer::__init__(%s)", port)
+        self.host = ""
+        self.port = port
+        self.reusePort = reusePort
+        self.handlerClass = handlerClass or HandlerClass
+        self.listeners = [(port, self.handlerClass)]
+        self.servers = []
+        self.connections = set()
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers = conf.asyncWorkers)
+        self._thread = None
+
+    def addListener(self, port, handlerClass):
+        """
+         Adds one more listening port served by the same event loop
+         @param port: Listening port
+         @param handlerClass: Protocol handler class
+        """
+        self.listeners.append((port, handlerClass))
+        return self
+
+    def run(self):
+        """
+         Method which starts TCP-server
+        """
+        log.debug("AsyncServer::run()")
+        for port, handlerClass in self.listeners:
+            if not handlerClass:
+                log.critical('No protocol handlers specified! (use --handler)')
+                return
+        for port, handlerClass in self.listeners:
+            server = self.loop.run_until_complete(self.loop.create_server(
+                lambda handlerClass = handlerClass:
+                    AsyncClientConnection(self, handlerClass),
+                self.host, port, reuse_address = True,
+                reuse_port = self.reusePort or None))
+            self.servers.append(server)
+            log.info("Server is started on port %s (asyncio)",
+                server.sockets[0].getsockname()[1])
+        self.port = self.servers[0].sockets[0].getsockname()[1]
+        self._thread = Thread(target = self.loop.run_forever)
+        self._thread.start()
+
+    def stop(self):
+        """
+         Stops TCP-server
+        """
+        if not self._thread:
+            return
+        def shutdown():
+            for server in self.servers:
+                server.close()
+            for connection in list(self.connections):
+                connection.close()
+            self.loop.call_soon(self.loop.stop)
+        self.loop.call_soon_threadsafe(shutdown)
+        self._thread.join()
+        self._thread = None
+        self.executor.shutdown(wait = True)
+        self.loop.close()
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+import time
+from lib.handler import AbstractHandler
+
+class EchoHandler(AbstractHandler):
+    """ Test handler, which answers with received data """
+    received = None
+
+    def processData(self, data):
+        EchoHandler.received.append(data)
+        self.send(b'OK:' + data)
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        EchoHandler.received = []
+        self.server = AsyncServer(0, EchoHandler)
+        self.server.host = '127.0.0.1'
+        self.server.run()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_echo(self):
+        client = socket.create_connection(('127.0.0.1', self.server.port))
+        client.settimeout(5)
+        client.sendall(b'PING')
+        self.assertEqual(client.recv(1024), b'OK:PING')
+        client.sendall(b'PONG')
+        self.assertEqual(client.recv(1024), b'OK:PONG')
+        client.close()
+        self.assertEqual(EchoHandler.received, [b'PING', b'PONG'])
+
+    def test_manyConnections(self):
+        clients = []
+        for i in range(50):
+            clients.append(
+                socket.create_connection(('127.0.0.1', self.server.port)))
+        for _ in range(20):
+            if self.server.connectionsCount == 50: break
+            time.sleep(0.05)
+        self.assertEqual(self.server.connectionsCount, 50)
+        for client in clients:
+            client.close()
+
+    def test_manyListeners(self):
+        self.server.stop()
+        self.server = AsyncServer(0, EchoHandler)
+        self.server.host = '127.0.0.1'
+        self.server.addListener(0, EchoHandler)
+        self.server.run()
+        self.assertEqual(len(self.server.servers), 2)
+        for server in self.server.servers:
+            port = server.sockets[0].getsockname()[1]
+            client = socket.create_connection(('127.0.0.1', port))
+            client.settimeout(5)
+            client.sendall(b'PING')
+            self.assertEqual(client.recv(1024), b'OK:PING')
+            client.close()
+
+    def test_adapterRecv(self):
+        adapter = AsyncSocketAdapter(None)
+        adapter.settimeout(0.01)
+        self.assertRaises(socket.timeout, adapter.recv, 10)
+        adapter.push(b'0123456789')
+        self.assertEqual(adapter.recv(4), b'0123')
+        self.assertEqual(adapter.recv(10), b'456789')
+        adapter.push(b'abc')
+        data = bytearray(5)
+        self.assertEqual(adapter.recv_into(data, 5), 3)
+        self.assertEqual(data, b'abc\x00\x00')
+        adapter.close()
+        self.assertEqual(adapter.recv(10), b'')
@@ -5,22 +5,30 @@
 @copyright 2013, Maprox LLC
 """
 
+import os
 import time
+import heapq
 import socket
 import json
+import zlib
 
-from collections import deque
+from collections import deque, OrderedDict
 
-from threading import Thread
+from threading import Thread, Lock, RLock
 from kernel.logger import log
 from kernel.config import conf
-from lib.broker import broker
+from kernel.metrics import metrics
+from kernel.database.balancer import DatabaseBalancer
+from lib.broker import broker, getBucket
 from kombu import BrokerConnection, Queue
 
 # --------------------------------------------------------------------
 
 QUEUE_PREFIX = conf.environment + '.mon.device.packet'
 QUEUE_MAX_TIMEOUT = 60 * 5 # 5 minutes
+# key of the packet sequence number, which is added to sent packets
+# when window of the device is greater than 1
+SEQUENCE_KEY = 'balancer_seq'
 
 # --------------------------------------------------------------------
 
@@ -43,7 +51,8 @@ class PacketReceiveBalancer:
          Starts balancer
          @return:
         """
-        self._receiveManager = PacketReceiveManager()
+        self._receiveManager = PacketReceiveManager(
+            registry = getRegistry(conf.balancerRegistry)).start()
         self.initControlThreads()
 
     def initControlThreads(self):
@@ -52,24 +61,53 @@ class PacketReceiveBalancer:
          @return:
         """
         log.debug('%s::initControlThreads()', self.__class__)
-        # starting request signal thread
-        self._threadSignalRequest = Thread(
-            target = self.threadSignalRequestHandler)
-        self._threadSignalRequest.start()
+        # starting request signal thread (bucket queues are known
+        # beforehand, so new devices need no signals)
+        if conf.balancerBuckets:
+            self.deleteSignalRequestQueue()
+        else:
+            self._threadSignalRequest = Thread(
+                target = self.threadSignalRequestHandler)
+            self._threadSignalRequest.start()
         # starting response signal thread
         self._threadSignalResponse = Thread(
             target = self.threadSignalResponseHandler)
         self._threadSignalResponse.start()
 
-    def threadSignalRequestHandler(self):
-        threadName = 'SignalRequestThread'
-        signalQueueName = QUEUE_PREFIX + '.signal.request'
-        signalRoutingKey = QUEUE_PREFIX + '.create.#'
-        signalQueue = Queue(
-            signalQueueName,
+    def getSignalRequestQueue(self):
+        """
+         Returns request signal queue, which is bound to queues of devices
+         @return: Queue
+        """
+        return Queue(
+            QUEUE_PREFIX + '.signal.request',
             exchange = broker._exchanges['mon.device'],
-            routing_key = signalRoutingKey
+            routing_key = QUEUE_PREFIX + '.create.#'
         )
+
+    def deleteSignalRequestQueue(self):
+        """
+         Deletes request signal queue, which is left by a deployment
+         without bucket queues. Nobody consumes it in bucket mode, but
+         it would receive a copy of every packet and grow forever.
+         The queue is shared by all balancers, so it is deleted only
+         when it is unused and empty (balancers of the old deployment
+         may still consume it while deployments are switched)
+        """
+        signalQueue = self.getSignalRequestQueue()
+        try:
+            with BrokerConnection(conf.amqpConnection) as conn:
+                signalQueue(conn.default_channel).delete(
+                    if_unused = True, if_empty = True)
+            log.info('Queue %s is deleted if unused and empty',
+                signalQueue.name)
+        except Exception as E:
+            log.warning('Queue %s is not deleted (in use?): %s',
+                signalQueue.name, E)
+
+    def threadSignalRequestHandler(self):
+        threadName = 'SignalRequestThread'
+        signalQueue = self.getSignalRequestQueue()
         log.debug('%s::started', threadName)
         while True:
             try:
@@ -158,7 +196,8 @@ class PacketReceiveBalancer:
             log.debug('%s:: < Signal for %s', threadName, uid)
             if uid:
                 self._receiveManager.checkListeningForQueue(uid)
-                self._receiveManager.messageReceived(uid)
+                self._receiveManager.messageReceived(uid,
+                    body.get(SEQUENCE_KEY))
         except Exception as E:
             log.error('%s::%s', threadName, E)
         message.ack()
@@ -166,42 +205,299 @@ class PacketReceiveBalancer:
 
 # --------------------------------------------------------------------
 
+class DeviceRegistryFile:
+    """
+     Registry of devices, which is stored in a local snapshot file
+    """
+
+    def __init__(self, path):
+        """
+         Class initialization
+         @param path: Path to the snapshot file
+        """
+        self.path = path
+
+    def load(self):
+        """
+         Returns saved state of devices
+         @return: dict of device states by device identifiers
+        """
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, devices):
+        """
+         Replaces saved state of devices.
+         Snapshot is written to a temporary file and renamed, so a crash
+         during saving does not corrupt the previous snapshot
+         @param devices: dict of device states by device identifiers
+        """
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(devices, f)
+        os.replace(tmpPath, self.path)
+
+def getRegistry(kind, instance = None):
+    """
+     Returns registry of devices
+     @param kind: 'redis', 'file' or 'none' (conf.balancerRegistry)
+     @param instance: Number of the balancer instance, if instances share
+       the work, so every instance has its own registry
+     @return: DatabaseBalancer, DeviceRegistryFile or None
+    """
+    if kind == 'redis':
+        return DatabaseBalancer(instance)
+    if kind == 'file':
+        path = conf.balancerRegistryFile
+        if instance is not None:
+            path += '.%d' % instance
+        return DeviceRegistryFile(path)
+    return None
+
+# --------------------------------------------------------------------
+
 class PacketReceiveManager:
     """
-     Factory for packet receivers classes
+     Distributes devices between packet receive shards.
+     Shard of the device is chosen by crc32 hash of its uid, so all packets
+     of the device are consumed and dispatched by the same shard, and
+     their order is kept.
+     If bucketsCount is set, devices are not listened one by one:
+     shards consume the fixed number of bucket queues (packets are sent
+     there by MessageBroker.getRoutingKey) and restore the order of every
+     device in their deques.
+     If registry is set, state of devices is saved there periodically
+     and restored before start, so queues of known devices are consumed
+     at once instead of waiting for their next request signals.
+    """
+    _shards = None
+    _bucketsCount = 0
+    _registry = None
+    # class of shards
+    shardClass = None
+
+    def __init__(self, shardsCount = None, bucketsCount = None,
+            registry = None):
+        """
+         Class initialization
+         @param shardsCount: Number of shards (conf.balancerShards)
+         @param bucketsCount: Number of bucket queues, 0 to listen queues
+           of devices (conf.balancerBuckets)
+         @param registry: Registry of devices (see getRegistry)
+        """
+        shardsCount = shardsCount or conf.balancerShards
+        if bucketsCount is None:
+            bucketsCount = conf.balancerBuckets
+        log.debug('%s::__init__(%s, %s)', self.__class__,
+            shardsCount, bucketsCount)
+        self._bucketsCount = bucketsCount
+        self._registry = registry
+        self.registryInterval = conf.balancerRegistryInterval
+        self._shards = []
+        windows = self.parseWindows(conf.balancerWindows)
+        shardClass = self.shardClass or PacketReceiveShard
+        for number in range(shardsCount):
+            self._shards.append(shardClass(number, windows = windows))
+        for bucket in self.getBuckets(bucketsCount):
+            shard = self.getBucketShard(bucket)
+            shard.addQueue(bucket, QUEUE_PREFIX + '.create.bucket.%d' % bucket)
+
+    @property
+    def shards(self):
+        return self._shards
+
+    def getBuckets(self, bucketsCount):
+        """
+         Returns bucket numbers, which are consumed by the manager
+         @param bucketsCount: Number of bucket queues
+         @return: iterable of int
+        """
+        return range(bucketsCount)
+
+    def getBucketShard(self, bucket):
+        """
+         Returns shard, which consumes the bucket queue
+         @param bucket: Bucket number
+         @return: PacketReceiveShard
+        """
+        return self._shards[bucket % len(self._shards)]
+
+    @staticmethod
+    def parseWindows(value):
+        """
+         Parses window sizes of particular devices
+         @param value: str like "uid1:8, uid2:16"
+         @return: dict of window sizes by device identifiers
+        """
+        windows = {}
+        for item in (value or '').split(','):
+            if ':' not in item: continue
+            uid, size = item.rsplit(':', 1)
+            windows[uid.strip()] = int(size)
+        return windows
+
+    def start(self):
+        """
+         Restores devices from the registry and starts receiver threads
+         of all shards
+         @return: self
+        """
+        if self._registry is not None:
+            self.restore()
+            self._threadRegistry = Thread(target = self.threadRegistryHandler)
+            self._threadRegistry.start()
+        for shard in self._shards:
+            shard.initReceiverThread()
+        return self
+
+    def restore(self):
+        """
+         Restores state of devices from the registry.
+         Must be called before start of receiver threads, so queues of all
+         of restored devices are consumed by the first consumer of a shard
+         @return: Number of restored devices
+        """
+        try:
+            devices = self._registry.load()
+        except Exception as E:
+            log.error('Balancer registry is not loaded: %s', E)
+            return 0
+        # devices are restored in order of their activity to keep
+        # the eviction order
+        for uid, state in sorted(devices.items(),
+                key = lambda item: item[1].get('activity') or 0):
+            self.getShard(uid).restoreDevice(uid, state,
+                not self._bucketsCount)
+        log.info('%d devices are restored from balancer registry',
+            len(devices))
+        return len(devices)
+
+    def save(self):
+        """
+         Saves state of devices of all shards to the registry
+         @return: Number of saved devices
+        """
+        devices = {}
+        for shard in self._shards:
+            devices.update(shard.getDevicesState())
+        try:
+            self._registry.save(devices)
+        except Exception as E:
+            log.error('Balancer registry is not saved: %s', E)
+        return len(devices)
+
+    def threadRegistryHandler(self):
+        """
+         Saves registry of devices every registryInterval seconds
+        """
+        while True:
+            time.sleep(self.registryInterval)
+            self.save()
+
+    def getShard(self, uid):
+        """
+         Returns shard of the device
+         @param uid: Device identifier
+         @return: PacketReceiveShard
+        """
+        if self._bucketsCount:
+            # shard of the bucket, which receives packets of the device
+            return self.getBucketShard(getBucket(uid, self._bucketsCount))
+        index = zlib.crc32(uid.encode()) % len(self._shards)
+        return self._shards[index]
+
+    def checkListeningForQueue(self, uid):
+        """
+         Checks if manager is already listening the queue for specified uid.
+         @param uid: Device identifier
+        """
+        if self._bucketsCount:
+            return
+        self.getShard(uid).checkListeningForQueue(uid)
+
+    def messageReceived(self, uid, sequence = None):
+        """
+         Mark sent messages as received and send next
+         @param uid: Device identifier
+         @param sequence: Sequence number of the received message
+        """
+        self.getShard(uid).messageReceived(uid, sequence)
+
+# --------------------------------------------------------------------
+
+class PacketReceiveShard:
+    """
+     Packet receive shard.
+     Has its own receiver thread, AMQP connection and consumer, which
+     consumes queues of devices of the shard, and its own packet deques.
+     Packets are acked by the receiver thread only, because kombu
+     channels are not thread-safe.
+     Dispatch locks of devices are expired by the receiver thread using
+     a heap of deadlines, so a device whose response was lost does not
+     wait for its next packet to be dispatched again.
+     State and queue subscription of devices, which are idle longer than
+     idleTtl, are dropped (the queue is subscribed again on the next
+     request signal of the device).
     """
     _queues = None
     _messages = None
     _queuesListNew = None
 
-    def __init__(self):
+    # timeout of waiting for packets (seconds), pending acks and new queues
+    # are processed at least once per this interval
+    drainTimeout = 1
+    # interval of idle devices eviction (seconds)
+    evictionInterval = 60
+
+    def __init__(self, number = 0, window = None, windows = None):
         """
          Class initialization
+         @param number: Shard number
+         @param window: Default window size (conf.balancerWindow)
+         @param windows: dict of window sizes by device identifiers
         """
+        self.number = number
+        self.threadName = 'ReceiverThread-%s' % number
         self._queues = {}
         self._messages = {}
         self._messagesLocks = {}
         self._queuesListNew = []
-        self.initReceiverThread()
+        self._acks = []
+        self._outgoing = []
+        self._timeouts = []
+        self._inflight = {}
+        self._sequences = {}
+        self._windows = dict(windows or {})
+        self.window = window or conf.balancerWindow
+        self._activity = OrderedDict()
+        self._queuesListRemoved = []
+        self._nextEviction = 0
+        self.idleTtl = conf.balancerIdleTtl
+        self.idleQueues = conf.balancerIdleQueues
+        self._lock = RLock()
+        self._sendLock = Lock()
 
     def initReceiverThread(self):
         """
          Initialize receiver thread
          @return:
         """
-        log.debug('%s::initReceiverThread()', self.__class__)
-        # starting request signal thread
+        log.debug('%s::initReceiverThread()', self.threadName)
         self._threadReceive = Thread(target = self.threadReceiveHandler)
         self._threadReceive.start()
 
     def threadReceiveHandler(self):
-        threadName = 'ReceiverThread'
+        threadName = self.threadName
         log.debug('%s::started', threadName)
         while True:
-            queues = []
-            for key in self._queues:
-                queues.append(self._queues[key])
+            with self._lock:
+                queues = list(self._queues.values())
+                self._queuesListNew = []
             if not queues:
+                self.checkTimeouts()
+                self.evictIdle()
                 time.sleep(2) # sleep for 2 seconds
                 continue
             try:
@@ -217,9 +513,14 @@ class PacketReceiveManager:
                             while True:
                                 conn.ensure_connection()
                                 try:
-                                    conn.drain_events(timeout = 5) # 5 seconds
+                                    conn.drain_events(
+                                        timeout = self.drainTimeout)
                                 except socket.timeout:
                                     pass
+                                self.processAcks()
+                                self.checkTimeouts()
+                                self.evictIdle()
+                                self.removeQueues(conn, consumer)
                                 self.appendNewQueues(consumer)
                     except Exception as E:
                         log.error('%s::%s', threadName, E)
@@ -234,11 +535,170 @@ class PacketReceiveManager:
          Check for new queues in the list
          @param consumer: Consumer instance
         """
-        if self._queuesListNew:
-            for queue in self._queuesListNew:
+        with self._lock:
+            queues = self._queuesListNew
+            self._queuesListNew = []
+        if queues:
+            for queue in queues:
                 consumer.add_queue(queue)
             consumer.consume()
-        self._queuesListNew = []
+
+    def removeQueues(self, conn, consumer):
+        """
+         Cancels consuming from queues of evicted devices.
+         Depending on idleQueues queues are kept, unbound or deleted
+         (only if they are empty and have no other consumers)
+         @param conn: BrokerConnection instance
+         @param consumer: Consumer instance
+        """
+        with self._lock:
+            queues = self._queuesListRemoved
+            self._queuesListRemoved = []
+        for queue in queues:
+            consumer.cancel_by_queue(queue.name)
+            if self.idleQueues not in ('unbind', 'delete'):
+                continue
+            # failed conditional delete closes the channel,
+            # so the consumer channel is not used
+            try:
+                with conn.channel() as channel:
+                    boundQueue = queue.bind(channel)
+                    if self.idleQueues == 'delete':
+                        boundQueue.delete(if_unused = True, if_empty = True)
+                    else:
+                        boundQueue.unbind_from(queue.exchange,
+                            queue.routing_key)
+            except Exception as E:
+                log.debug('%s::Queue %s is not removed: %s',
+                    self.threadName, queue.name, E)
+
+    def getDevicesState(self):
+        """
+         Returns state of known devices of the shard
+         @return: dict of device states by device identifiers
+        """
+        with self._lock:
+            return dict((uid, {
+                'activity': activity,
+                'lock': self._messagesLocks.get(uid),
+                'inflight': self._inflight.get(uid, 0),
+                'sequence': self._sequences.get(uid, 0)
+            }) for uid, activity in self._activity.items())
+
+    def restoreDevice(self, uid, state, listen = True):
+        """
+         Restores saved state of the device.
+         Saved lock is kept until response signal or its timeout, because
+         unacked packets of the device are delivered again and the first
+         of them may be still processed by the receiving side.
+         Sequence numbers are continued, so responses to packets sent before
+         restart do not acknowledge packets delivered after it
+         @param uid: Device identifier
+         @param state: dict of saved device state
+         @param listen: If True, queue of the device is consumed
+        """
+        with self._lock:
+            self._activity[uid] = state.get('activity') or time.time()
+            self._activity.move_to_end(uid)
+            if state.get('sequence'):
+                self._sequences[uid] = state['sequence']
+            lockTime = state.get('lock')
+            if lockTime:
+                self._messagesLocks[uid] = lockTime
+                self._inflight[uid] = state.get('inflight') or 0
+                heapq.heappush(self._timeouts,
+                    (lockTime + QUEUE_MAX_TIMEOUT, uid, lockTime))
+            if listen:
+                self.addQueue(uid, QUEUE_PREFIX + '.create.' + uid)
+
+    def touch(self, uid):
+        """
+         Marks device as active
+         @param uid: Device identifier
+        """
+        self._activity[uid] = time.time()
+        self._activity.move_to_end(uid)
+
+    def evictIdle(self, currentTime = None):
+        """
+         Drops state and queue subscription of devices idle longer than
+         idleTtl, which have no queued packets
+         @param currentTime: Current unix time
+         @return: Number of evicted devices
+        """
+        if currentTime is None:
+            currentTime = time.time()
+            if currentTime < self._nextEviction:
+                return 0
+            self._nextEviction = currentTime + self.evictionInterval
+        if not self.idleTtl:
+            return 0
+        evicted = 0
+        with self._lock:
+            activity = self._activity
+            while activity:
+                uid, lastTime = next(iter(activity.items()))
+                if currentTime - lastTime < self.idleTtl:
+                    break
+                if self._messages.get(uid) or self._inflight.get(uid):
+                    # packets are still waiting for responses
+                    activity.move_to_end(uid)
+                    activity[uid] = currentTime
+                    continue
+                del activity[uid]
+                for storage in (self._messages, self._messagesLocks,
+                        self._inflight, self._sequences):
+                    storage.pop(uid, None)
+                queue = self._queues.pop(uid, None)
+                if queue is not None:
+                    if queue in self._queuesListNew:
+                        self._queuesListNew.remove(queue)
+                    else:
+                        self._queuesListRemoved.append(queue)
+                evicted += 1
+        if evicted:
+            log.debug('%s::%d idle devices are evicted',
+                self.threadName, evicted)
+            metrics.increment('balancer.evictions', evicted)
+        return evicted
+
+    def processAcks(self):
+        """
+         Acks messages, which are processed by the receiving side
+        """
+        with self._lock:
+            acks = self._acks
+            self._acks = []
+        for message in acks:
+            message.ack()
+
+    def checkTimeouts(self, currentTime = None):
+        """
+         Expires dispatch locks older than QUEUE_MAX_TIMEOUT and sends
+         the window of the device again starting from its first packet
+         @param currentTime: Current unix time
+         @return: Number of expired locks
+        """
+        if currentTime is None:
+            currentTime = time.time()
+        expired = 0
+        with self._lock:
+            timeouts = self._timeouts
+            while timeouts and timeouts[0][0] <= currentTime:
+                deadline, uid, lockTime = heapq.heappop(timeouts)
+                if self._messagesLocks.get(uid) != lockTime:
+                    # lock is already cleared or renewed
+                    continue
+                expired += 1
+                log.debug('%s::%s is unlocked by timeout!',
+                    self.threadName, uid)
+                self._inflight[uid] = 0
+                self._messagesLocks.pop(uid, None)
+                self.sendMessages(uid)
+        self.flushMessages()
+        if expired:
+            metrics.increment('balancer.timeouts', expired)
+        return expired
 
     def threadReceiverOnMessage(self, body, message):
         """
@@ -246,7 +706,7 @@ class PacketReceiveManager:
          @param body: amqp message body
          @param message: message instance
         """
-        threadName = 'ReceiverThread'
+        threadName = self.threadName
         uid = 'unknown uid [!]'
         try:
             if isinstance(body, str):
@@ -255,15 +715,22 @@ class PacketReceiveManager:
                 uid = body['uid']
             if 'time' not in body:
                 raise Exception('Incorrect packet structure')
-            if uid not in self._messages:
-                self._messages[uid] = deque()
-            # store message to the queue
-            self._messages[uid].append({
-                "message": message,
-                "body": body
-            })
-            log.debug('%s::Packet %s added %s', threadName, body['time'], uid)
-            self.sendMessage(uid, body)
+            with self._lock:
+                if uid not in self._messages:
+                    self._messages[uid] = deque()
+                sequence = self._sequences.get(uid, 0) + 1
+                self._sequences[uid] = sequence
+                self.touch(uid)
+                # store message to the queue
+                self._messages[uid].append({
+                    "message": message,
+                    "body": body,
+                    "sequence": sequence
+                })
+                log.debug('%s::Packet %s added %s',
+                    threadName, body['time'], uid)
+                self.sendMessages(uid)
+            self.flushMessages()
         except Exception as E:
             log.error('%s::%s', threadName, E)
             message.ack()
@@ -275,64 +742,148 @@ class PacketReceiveManager:
          @param uid: Device identifier
          @return:
         """
-        if uid in self._queues: return
-        routingKey = QUEUE_PREFIX + '.create.' + uid
-        log.debug('--- ADDING QUEUE ---: %s', routingKey)
-        self._queues[uid] = Queue(
-            routingKey,
-            exchange = broker._exchanges['mon.device'],
-            routing_key = routingKey
-        )
-        self._queuesListNew.append(self._queues[uid])
+        with self._lock:
+            self.touch(uid)
+            self.addQueue(uid, QUEUE_PREFIX + '.create.' + uid)
 
-    def sendMessage(self, uid, body = None, ignoreFlag = False):
+    def addQueue(self, key, routingKey):
         """
-         Send message to the broker
+         Begins to consume from the queue if it is not consumed yet
+         @param key: Queue key (device identifier or bucket number)
+         @param routingKey: Queue name and routing key
+        """
+        with self._lock:
+            if key in self._queues: return
+            log.debug('--- ADDING QUEUE ---: %s', routingKey)
+            self._queues[key] = Queue(
+                routingKey,
+                exchange = broker._exchanges['mon.device'],
+                routing_key = routingKey
+            )
+            self._queuesListNew.append(self._queues[key])
+
+    def getWindow(self, uid):
+        """
+         Returns maximum number of sent and not yet received packets
+         of the device
+         @param uid: Device identifier
+         @return: int
+        """
+        return self._windows.get(uid, self.window)
+
+    def sendMessages(self, uid):
+        """
+         Queues packets of the device, which fit into its window, to be
+         published by flushMessages (must be called with the shard lock)
          @param uid: Device identifier
-         @param body: New packet body
-         @param ignoreFlag: Send message even if the checkFile is in progress
         """
-        threadName = 'ReceiverThread'
-        if not body:
-            self._messagesLocks.pop(uid, None)
-            log.debug('%s::%s lock file cleared', threadName, uid)
+        threadName = self.threadName
+        messages = self._messages.get(uid)
+        inflight = self._inflight.get(uid, 0)
+        window = self.getWindow(uid)
+        if not messages or inflight >= window:
+            log.debug('%s::%s is locked!', threadName, uid)
             return
+        while inflight < window and inflight < len(messages):
+            body = messages[inflight]['body']
+            if window > 1:
+                body[SEQUENCE_KEY] = messages[inflight]['sequence']
+            self._outgoing.append((uid, messages[inflight]['sequence'], body))
+            inflight += 1
+        self._inflight[uid] = inflight
+        self.lock(uid)
+
+    def flushMessages(self):
+        """
+         Publishes packets queued by sendMessages. The shard lock is not
+         held while publishing, so packets and responses of other devices
+         do not wait for the broker. Packets are published in the queued
+         order, the packet which is not sent (and following packets of its
+         device) stays in the window and is sent again on the next packet
+         of the device or on the lock timeout
+        """
+        with self._sendLock:
+            with self._lock:
+                outgoing = self._outgoing
+                self._outgoing = []
+            failed = set()
+            for uid, sequence, body in outgoing:
+                if uid in failed:
+                    continue
+                if broker.send([body], 'mon.device.packet.receive'):
+                    log.debug('%s::%s packet has been sent',
+                        self.threadName, uid)
+                    continue
+                log.error('%s::%s packet %s is not sent',
+                    self.threadName, uid, sequence)
+                failed.add(uid)
+                self.messageNotSent(uid, sequence)
+
+    def messageNotSent(self, uid, sequence):
+        """
+         Returns not sent packets of the device back to its window
+         @param uid: Device identifier
+         @param sequence: Sequence number of the first not sent packet
+        """
+        with self._lock:
+            messages = self._messages.get(uid) or ()
+            position = sum(1 for item in messages
+                if item['sequence'] < sequence)
+            self._inflight[uid] = min(self._inflight.get(uid, 0), position)
+            self._outgoing = [item for item in self._outgoing
+                if item[0] != uid]
 
+    def lock(self, uid):
+        """
+         Sets dispatch lock of the device and schedules its timeout
+         @param uid: Device identifier
+        """
         currentTime = time.time()
-        isLocked = uid in self._messagesLocks and not ignoreFlag
-        if isLocked:
-            lockTime = self._messagesLocks[uid]
-            isLocked = currentTime - lockTime < QUEUE_MAX_TIMEOUT
-            if not isLocked:
-                log.debug('%s::%s is unlocked by timeout!', threadName, uid)
-                body = self._messages[uid][0]['body']
-        if not isLocked:
-            self._messagesLocks[uid] = currentTime
-            broker.send([body], 'mon.device.packet.receive')
-            log.debug('%s::%s packet has been sent', threadName, uid)
-        else:
-            log.debug('%s::%s is locked!', threadName, uid)
+        self._messagesLocks[uid] = currentTime
+        heapq.heappush(self._timeouts,
+            (currentTime + QUEUE_MAX_TIMEOUT, uid, currentTime))
 
-    def messageReceived(self, uid):
+    def messageReceived(self, uid, sequence = None):
         """
-         Mark first message from queue as received and send next
+         Mark sent messages of the device as received and send next ones.
+         Messages are received in order: all of messages up to the given
+         sequence number are acknowledged, if sequence number is not
+         specified, the first message is acknowledged
          @param uid: Device identifier
+         @param sequence: Sequence number of the received message
         """
-        if uid not in self._messages:
-            self._messages[uid] = deque()
-        first = None
-        if self._messages[uid]:
-           first = self._messages[uid].popleft()
-        nextBody = None
-        if self._messages[uid]:
-            next = self._messages[uid][0]
-            nextBody = next['body']
-            log.debug('Got next message for %s: %s', uid, nextBody['time'])
-        else:
-            log.debug('Empty queue for %s', uid)
-        self.sendMessage(uid, nextBody, True)
-        if first:
-            first['message'].ack()
+        with self._lock:
+            if uid in self._activity:
+                self.touch(uid)
+            messages = self._messages.get(uid)
+            if not messages:
+                log.debug('Empty queue for %s', uid)
+                self._messagesLocks.pop(uid, None)
+                self._inflight.pop(uid, None)
+                return
+            received = 0
+            while messages:
+                if sequence is None:
+                    if received: break
+                elif messages[0]['sequence'] > sequence:
+                    break
+                self._acks.append(messages.popleft()['message'])
+                received += 1
+            inflight = max(self._inflight.get(uid, 0) - received, 0)
+            self._inflight[uid] = inflight
+            if messages:
+                log.debug('Got next message for %s: %s',
+                    uid, messages[0]['body']['time'])
+                if inflight:
+                    # receiving side is alive, renew the lock
+                    self.lock(uid)
+                self.sendMessages(uid)
+            else:
+                log.debug('Empty queue for %s', uid)
+                self._messagesLocks.pop(uid, None)
+                self._inflight.pop(uid, None)
+                log.debug('%s::%s lock file cleared', self.threadName, uid)
+        self.flushMessages()
 
 # --------------------------------------------------------------------
 
@@ -359,4 +910,235 @@ class PacketReceiver:
         """
          Refresh connection
         """
-        log.debug('%s[%s]::Refresh', 'PacketReceiver', self._uid)
\ No newline at end of file
+        log.debug('%s[%s]::Refresh', 'PacketReceiver', self._uid)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestMessage:
+    """ AMQP message stub """
+    acked = False
+
+    def ack(self):
+        self.acked = True
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.amqpConnection = conf.amqpConnection
+        conf.amqpConnection = 'memory://'
+
+    def tearDown(self):
+        broker.resetConnection()
+        conf.amqpConnection = self.amqpConnection
+
+    def getSentPackets(self):
+        routingKey = conf.environment + '.mon.device.packet.receive'
+        queue = broker.getQueue(routingKey, broker._exchanges['mon.device'])
+        packets = []
+        with BrokerConnection('memory://') as conn:
+            with conn.SimpleQueue(queue) as simpleQueue:
+                while simpleQueue.qsize():
+                    message = simpleQueue.get(timeout = 1)
+                    packets.append(message.payload)
+                    message.ack()
+        return packets
+
+    def test_getShard(self):
+        manager = PacketReceiveManager(4)
+        self.assertEqual(len(manager.shards), 4)
+        self.assertIs(manager.getShard('123'), manager.getShard('123'))
+        shards = set(manager.getShard(str(uid)) for uid in range(100))
+        self.assertEqual(len(shards), 4)
+        manager.checkListeningForQueue('123')
+        for shard in manager.shards:
+            self.assertEqual('123' in shard._queues,
+                shard is manager.getShard('123'))
+
+    def test_buckets(self):
+        manager = PacketReceiveManager(3, 8)
+        self.assertEqual([len(shard._queues) for shard in manager.shards],
+            [3, 3, 2])
+        for uid in ('1', '2', '355632000166323'):
+            bucket = getBucket(uid, 8)
+            shard = manager.getShard(uid)
+            self.assertIn(bucket, shard._queues)
+            manager.checkListeningForQueue(uid)
+            self.assertNotIn(uid, shard._queues)
+        buckets = conf.balancerBuckets
+        try:
+            conf.balancerBuckets = 8
+            self.assertEqual(broker.getRoutingKey('1'),
+                'mon.device.packet.create.bucket.%d' % getBucket('1', 8))
+        finally:
+            conf.balancerBuckets = buckets
+
+    def test_deleteSignalRequestQueue(self):
+        balancer = PacketReceiveBalancer()
+        signalQueue = balancer.getSignalRequestQueue()
+        with BrokerConnection('memory://') as conn:
+            # queue of the deployment without bucket queues
+            signalQueue(conn.default_channel).declare()
+            balancer.deleteSignalRequestQueue()
+            self.assertRaises(conn.channel_errors,
+                conn.default_channel.queue_declare, signalQueue.name,
+                passive = True)
+        # missing queue is not an error
+        balancer.deleteSignalRequestQueue()
+
+    def test_keepNonEmptySignalRequestQueue(self):
+        balancer = PacketReceiveBalancer()
+        signalQueue = balancer.getSignalRequestQueue()
+        with BrokerConnection('memory://') as conn:
+            channel = conn.default_channel
+            signalQueue(channel).declare()
+            # signal is not handled by the old deployment yet
+            channel.basic_publish(channel.prepare_message('{}'),
+                exchange = '', routing_key = signalQueue.name)
+            balancer.deleteSignalRequestQueue()
+            channel.queue_declare(signalQueue.name, passive = True)
+            channel.queue_purge(signalQueue.name)
+            channel.queue_delete(signalQueue.name)
+
+    def test_packetsOrder(self):
+        self.getSentPackets()
+        shard = PacketReceiveShard()
+        first, second = TestMessage(), TestMessage()
+        shard.threadReceiverOnMessage({'uid': 'b1', 'time': 't1'}, first)
+        shard.threadReceiverOnMessage({'uid': 'b1', 'time': 't2'}, second)
+        self.assertEqual(self.getSentPackets(), [{'uid': 'b1', 'time': 't1'}])
+        shard.messageReceived('b1')
+        # messages are acked by the receiver thread only
+        self.assertFalse(first.acked)
+        shard.processAcks()
+        self.assertTrue(first.acked)
+        self.assertEqual(self.getSentPackets(), [{'uid': 'b1', 'time': 't2'}])
+        shard.messageReceived('b1')
+        shard.processAcks()
+        self.assertTrue(second.acked)
+        self.assertNotIn('b1', shard._messagesLocks)
+
+    def test_checkTimeouts(self):
+        self.getSentPackets()
+        shard = PacketReceiveShard()
+        timeouts = metrics.get('balancer.timeouts')
+        shard.threadReceiverOnMessage({'uid': 'b2', 'time': 't1'},
+            TestMessage())
+        lockTime = shard._messagesLocks['b2']
+        self.assertEqual(shard.checkTimeouts(lockTime + 1), 0)
+        self.assertEqual(
+            shard.checkTimeouts(lockTime + QUEUE_MAX_TIMEOUT), 1)
+        self.assertEqual(metrics.get('balancer.timeouts'), timeouts + 1)
+        # the first packet is sent again
+        self.assertEqual(self.getSentPackets(),
+            [{'uid': 'b2', 'time': 't1'}] * 2)
+        # cleared lock does not expire
+        shard.messageReceived('b2')
+        self.assertEqual(shard.checkTimeouts(time.time() +
+            QUEUE_MAX_TIMEOUT * 2), 0)
+        self.assertEqual(shard._timeouts, [])
+
+    def test_window(self):
+        self.getSentPackets()
+        shard = PacketReceiveShard(window = 3)
+        messages = [TestMessage() for i in range(5)]
+        for i, message in enumerate(messages):
+            shard.threadReceiverOnMessage({'uid': 'b3', 'time': i}, message)
+        sent = self.getSentPackets()
+        self.assertEqual([p['time'] for p in sent], [0, 1, 2])
+        self.assertEqual([p[SEQUENCE_KEY] for p in sent], [1, 2, 3])
+        # ordered acknowledgement of the first two packets
+        shard.messageReceived('b3', 2)
+        shard.processAcks()
+        self.assertEqual([m.acked for m in messages],
+            [True, True, False, False, False])
+        self.assertEqual([p['time'] for p in self.getSentPackets()], [3, 4])
+        shard.messageReceived('b3')
+        shard.messageReceived('b3', 5)
+        shard.processAcks()
+        self.assertTrue(all(m.acked for m in messages))
+        self.assertNotIn('b3', shard._messagesLocks)
+        self.assertEqual(PacketReceiveManager.parseWindows('1: 8, b3:16'),
+            {'1': 8, 'b3': 16})
+
+    def test_sendFailure(self):
+        self.getSentPackets()
+        shard = PacketReceiveShard(window = 2)
+        send = broker.send
+        try:
+            broker.send = lambda packets, routingKey: False
+            shard.threadReceiverOnMessage({'uid': 'b8', 'time': 0},
+                TestMessage())
+            shard.threadReceiverOnMessage({'uid': 'b8', 'time': 1},
+                TestMessage())
+        finally:
+            broker.send = send
+        # not sent packets stay in the window
+        self.assertEqual(shard._inflight['b8'], 0)
+        self.assertEqual(self.getSentPackets(), [])
+        shard.threadReceiverOnMessage({'uid': 'b8', 'time': 2},
+            TestMessage())
+        self.assertEqual([p['time'] for p in self.getSentPackets()], [0, 1])
+        self.assertEqual(shard._inflight['b8'], 2)
+
+    def test_evictIdle(self):
+        self.getSentPackets()
+        shard = PacketReceiveShard()
+        shard.idleTtl = 100
+        shard.checkListeningForQueue('b4')
+        shard.checkListeningForQueue('b5')
+        shard._queuesListNew = []
+        shard.threadReceiverOnMessage({'uid': 'b4', 'time': 't1'},
+            TestMessage())
+        currentTime = time.time() + 100
+        # device with packet waiting for response is not evicted
+        self.assertEqual(shard.evictIdle(currentTime), 1)
+        self.assertEqual(list(shard._queues), ['b4'])
+        shard.messageReceived('b4')
+        self.assertEqual(shard.evictIdle(currentTime + 100), 1)
+        self.assertEqual(shard._queues, {})
+        self.assertEqual(shard._messages, {})
+        self.assertEqual(len(shard._activity), 0)
+        cancelled = []
+        class Consumer:
+            def cancel_by_queue(self, name): cancelled.append(name)
+        shard.removeQueues(None, Consumer())
+        self.assertEqual(cancelled, [QUEUE_PREFIX + '.create.b5',
+            QUEUE_PREFIX + '.create.b4'])
+
+    def test_registry(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as path:
+            registry = DeviceRegistryFile(os.path.join(path, 'registry.json'))
+            self.assertEqual(registry.load(), {})
+            manager = PacketReceiveManager(2, 0, registry)
+            manager.checkListeningForQueue('b6')
+            shard = manager.getShard('b7')
+            shard.threadReceiverOnMessage({'uid': 'b7', 'time': 't1'},
+                TestMessage())
+            lockTime = shard._messagesLocks['b7']
+            self.assertEqual(manager.save(), 2)
+            self.getSentPackets()
+            # state of devices is restored by a new manager
+            manager = PacketReceiveManager(2, 0, registry)
+            self.assertEqual(manager.restore(), 2)
+            shard = manager.getShard('b7')
+            self.assertIn('b7', shard._queues)
+            self.assertIn('b6', manager.getShard('b6')._queues)
+            self.assertEqual(shard._messagesLocks['b7'], lockTime)
+            # delivered again packet waits for the response
+            message = TestMessage()
+            shard.threadReceiverOnMessage({'uid': 'b7', 'time': 't1'},
+                message)
+            self.assertEqual(self.getSentPackets(), [])
+            self.assertEqual(shard._messages['b7'][0]['sequence'], 2)
+            shard.messageReceived('b7')
+            shard.processAcks()
+            self.assertTrue(message.acked)
+            self.assertEqual(shard.checkTimeouts(
+                lockTime + QUEUE_MAX_TIMEOUT), 0)
+            self.assertIsInstance(getRegistry('file'), DeviceRegistryFile)
+            self.assertIsNone(getRegistry('none'))
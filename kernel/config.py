@@ -30,6 +30,14 @@ try:
         "PIPE_HOSTNAME", conf.get("pipe", "hostname"))
     conf.hostIp = os.getenv(
         "PIPE_HOSTIP", conf.get("pipe", "hostip"))
+    conf.serverMode = os.getenv(
+        "PIPE_SERVER_MODE", conf.get("pipe", "serverMode",
+            fallback = "threading"))
+    conf.asyncWorkers = int(os.getenv(
+        "PIPE_ASYNC_WORKERS", conf.get("pipe", "asyncWorkers",
+            fallback = 32)))
+    conf.workers = int(options.workers or os.getenv(
+        "PIPE_WORKERS", conf.get("pipe", "workers", fallback = 1)))
 
     # redis settings
     conf.redisHost = os.getenv(
@@ -39,9 +47,93 @@ try:
     conf.redisPassword = os.getenv(
         "REDIS_PASS", conf.get("redis", "password"))
 
+    # serializer of device packets: json or pipe (lib.serializer);
+    # pipe makes messages smaller, but it is slower than json (see there)
+    conf.packetSerializer = os.getenv(
+        "PIPE_SERIALIZER", conf.get("pipe", "serializer", fallback = "json"))
+
+    # message transport of packets: amqp, redis or memory (tests only)
+    conf.messageTransport = os.getenv(
+        "PIPE_TRANSPORT", conf.get("pipe", "transport", fallback = "amqp"))
+
     # amqp settings
     conf.amqpConnection = os.getenv(
         "AMQP_CONNECTION", conf.get("amqp", "connection"))
+    conf.amqpConfirmPublish = os.getenv(
+        "AMQP_CONFIRM_PUBLISH", conf.get("amqp", "confirmPublish",
+            fallback = "1")) == "1"
+
+    # balancer settings
+    conf.balancerShards = int(os.getenv(
+        "PIPE_BALANCER_SHARDS", conf.get("balancer", "shards",
+            fallback = 4)))
+    conf.balancerBuckets = int(os.getenv(
+        "PIPE_BALANCER_BUCKETS", conf.get("balancer", "buckets",
+            fallback = 0)))
+    conf.balancerWindow = int(os.getenv(
+        "PIPE_BALANCER_WINDOW", conf.get("balancer", "window",
+            fallback = 1)))
+    conf.balancerWindows = os.getenv(
+        "PIPE_BALANCER_WINDOWS", conf.get("balancer", "windows",
+            fallback = ""))
+    conf.balancerIdleTtl = int(os.getenv(
+        "PIPE_BALANCER_IDLE_TTL", conf.get("balancer", "idleTtl",
+            fallback = 3600)))
+    conf.balancerIdleQueues = os.getenv(
+        "PIPE_BALANCER_IDLE_QUEUES", conf.get("balancer", "idleQueues",
+            fallback = "keep"))
+    conf.balancerInstance = int(os.getenv(
+        "PIPE_BALANCER_INSTANCE", conf.get("balancer", "instance",
+            fallback = 0)))
+    conf.balancerInstances = int(os.getenv(
+        "PIPE_BALANCER_INSTANCES", conf.get("balancer", "instances",
+            fallback = 1)))
+    conf.balancerRegistry = os.getenv(
+        "PIPE_BALANCER_REGISTRY", conf.get("balancer", "registry",
+            fallback = "redis"))
+    conf.balancerRegistryFile = os.getenv(
+        "PIPE_BALANCER_REGISTRY_FILE", conf.get("balancer", "registryFile",
+            fallback = "balancer.registry.json"))
+    conf.balancerRegistryInterval = int(os.getenv(
+        "PIPE_BALANCER_REGISTRY_INTERVAL", conf.get("balancer",
+            "registryInterval", fallback = 30)))
+
+    # interval of writing metrics to the log (seconds), 0 disables it
+    conf.metricsInterval = float(os.getenv(
+        "PIPE_METRICS_INTERVAL", conf.get("pipe", "metricsInterval",
+            fallback = 60)))
+
+    # packets thinning settings
+    conf.dedupeCacheSize = int(os.getenv(
+        "PIPE_DEDUPE_CACHE_SIZE", conf.get("pipe", "dedupeCacheSize",
+            fallback = 100000)))
+
+    # packets spool settings, empty path disables the spool
+    conf.spoolPath = os.getenv(
+        "PIPE_SPOOL_PATH", conf.get("pipe", "spoolPath", fallback = ""))
+    conf.spoolSegmentSize = int(os.getenv(
+        "PIPE_SPOOL_SEGMENT_SIZE", conf.get("pipe", "spoolSegmentSize",
+            fallback = 16777216)))
+    conf.spoolMaxSize = int(os.getenv(
+        "PIPE_SPOOL_MAX_SIZE", conf.get("pipe", "spoolMaxSize",
+            fallback = 1073741824)))
+    conf.spoolSyncInterval = float(os.getenv(
+        "PIPE_SPOOL_SYNC_INTERVAL", conf.get("pipe", "spoolSyncInterval",
+            fallback = 1)))
+
+    # background publisher settings
+    conf.publishQueueSize = int(os.getenv(
+        "PIPE_PUBLISH_QUEUE_SIZE", conf.get("pipe", "publishQueueSize",
+            fallback = 10000)))
+    conf.publishBatchSize = int(os.getenv(
+        "PIPE_PUBLISH_BATCH_SIZE", conf.get("pipe", "publishBatchSize",
+            fallback = 100)))
+    conf.publishLinger = float(os.getenv(
+        "PIPE_PUBLISH_LINGER", conf.get("pipe", "publishLinger",
+            fallback = 0.05)))
+    conf.publishTimeout = float(os.getenv(
+        "PIPE_PUBLISH_TIMEOUT", conf.get("pipe", "publishTimeout",
+            fallback = 5)))
 
     # default settings if not set up previously
     if not conf.hostIp:
@@ -65,6 +157,13 @@ except Exception as E:
     exit(1)
 
 try:
+    conf.allHandlers = options.allHandlers or \
+        os.getenv('PIPE_ALL_HANDLERS', '') == '1'
+    if conf.allHandlers:
+        # every listener reads its own configuration file
+        options.handler = None
+        options.handlerconf = None
+
     conf.handler = options.handler
     if options.handlerconf:
         conf.read(options.handlerconf)
@@ -0,0 +1,88 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Registry of devices of the packet receive balancer
+@copyright 2016, Maprox LLC
+'''
+
+import json
+from kernel.config import conf
+from kernel.database.abstract import DatabaseAbstract
+
+class DatabaseBalancer(DatabaseAbstract):
+    """
+     devices registry storage.
+     Balancer instances, which share the work (like instances of the streams
+     balancer), keep their devices under their own keys
+    """
+    _registryKey = None
+
+    def __init__(self, instance = None):
+        """
+         Constructor. Sets registry key
+         @param instance: Number of the balancer instance
+        """
+        self._registryKey = 'balancer_devices:' + conf.environment
+        if instance is not None:
+            self._registryKey += ':%d' % instance
+        DatabaseAbstract.__init__(self)
+
+    def load(self):
+        """
+         Returns saved state of devices
+         @return: dict of device states by device identifiers
+        """
+        devices = {}
+        for uid, state in self._store.hgetall(self._registryKey).items():
+            devices[uid.decode()] = json.loads(state.decode())
+        return devices
+
+    def save(self, devices):
+        """
+         Replaces saved state of devices
+         @param devices: dict of device states by device identifiers
+        """
+        pipe = self._store.pipeline()
+        pipe.delete(self._registryKey)
+        if devices:
+            pipe.hset(self._registryKey, mapping = dict(
+                (uid, json.dumps(state)) for uid, state in devices.items()))
+        pipe.execute()
+
+    def getLogName(self):
+        """ Returns name to write in logs """
+        return 'Balancer'
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._db = DatabaseBalancer()
+        self._db._registryKey = 'balancer_devices:UnitTest'
+
+    def tearDown(self):
+        self._db._store.close()
+
+    def test_registryKey(self):
+        db = DatabaseBalancer(1)
+        self.assertEqual(db._registryKey,
+            'balancer_devices:%s:1' % conf.environment)
+        db._store.close()
+
+    def test_storeUse(self):
+        devices = {
+            '1': {'activity': 1.5, 'lock': None, 'inflight': 0},
+            '2': {'activity': 2.5, 'lock': 2.0, 'inflight': 1}
+        }
+        try:
+            self._db.save(devices)
+        except:
+            print('\nRedis server is not running?\n')
+            return
+        self.assertEqual(self._db.load(), devices)
+        self._db.save({})
+        self.assertEqual(self._db.load(), {})
@@ -0,0 +1,191 @@
+# -*- coding: utf8 -*-
+'''
+@project   Maprox <http://www.maprox.net>
+@info      Redis streams storage
+@copyright 2016, Maprox LLC
+'''
+
+import redis
+from kernel.database.abstract import DatabaseAbstract
+
+def parseId(messageId):
+    """
+     Returns comparable stream message id
+     @param messageId: Stream message id (bytes or str, like b'1-0')
+     @return: tuple (milliseconds, sequence number)
+    """
+    if isinstance(messageId, bytes):
+        messageId = messageId.decode()
+    milliseconds, sequence = messageId.split('-')
+    return int(milliseconds), int(sequence)
+
+class DatabaseStreams(DatabaseAbstract):
+    """
+     redis streams of messages.
+     Streams are not limited by length on append, because MAXLEN drops
+     messages, which are not delivered to consumer groups yet. Consumers
+     remove acknowledged messages by trim()
+    """
+
+    def add(self, messages):
+        """
+         Appends messages to streams using one pipelined round-trip
+         @param messages: list of tuples (stream name, message fields)
+        """
+        pipe = self._store.pipeline(transaction = False)
+        for stream, fields in messages:
+            pipe.xadd(stream, fields)
+        pipe.execute()
+
+    def createGroup(self, stream, group, startId = '0'):
+        """
+         Creates consumer group of the stream (and the stream itself)
+         if it does not exist
+         @param stream: Stream name
+         @param group: Consumer group name
+         @param startId: Id of the last message, which is not read by
+           a new group ('0' to read all of messages, '$' to read new ones)
+        """
+        try:
+            self._store.xgroup_create(stream, group, id = startId,
+                mkstream = True)
+        except redis.ResponseError as E:
+            if 'BUSYGROUP' not in str(E):
+                raise
+
+    def claim(self, stream, group, consumer, count = 1000):
+        """
+         Takes all of pending messages of the stream group over
+         @param stream: Stream name
+         @param group: Consumer group name
+         @param consumer: Consumer name
+         @param count: Number of messages claimed by one round-trip
+         @return: list of tuples (message id, message fields) in order
+        """
+        messages = []
+        start = '0-0'
+        while True:
+            result = self._store.xautoclaim(stream, group, consumer, 0,
+                start_id = start, count = count)
+            messages.extend(item for item in result[1] if item[1])
+            start = result[0]
+            if start in (b'0-0', '0-0'):
+                return messages
+
+    def readGroup(self, group, consumer, streams, count = None, block = None):
+        """
+         Reads new messages of streams as a member of consumer group
+         @param group: Consumer group name
+         @param consumer: Consumer name
+         @param streams: list of stream names
+         @param count: Maximum number of messages of every stream
+         @param block: Time to wait for messages (milliseconds)
+         @return: list of tuples (stream name, list of (id, fields))
+        """
+        result = self._store.xreadgroup(group, consumer,
+            dict((stream, '>') for stream in streams),
+            count = count, block = block)
+        return [(stream.decode(), messages) for stream, messages in result]
+
+    def read(self, streams, count = None, block = None):
+        """
+         Reads messages of streams after given ids
+         @param streams: dict of last read ids by stream names
+         @param count: Maximum number of messages of every stream
+         @param block: Time to wait for messages (milliseconds)
+         @return: list of tuples (stream name, list of (id, fields))
+        """
+        result = self._store.xread(streams, count = count, block = block)
+        return [(stream.decode(), messages) for stream, messages in result]
+
+    def ack(self, group, messages):
+        """
+         Acknowledges messages of the consumer group using
+         one pipelined round-trip
+         @param group: Consumer group name
+         @param messages: list of tuples (stream name, message id)
+        """
+        ids = {}
+        for stream, messageId in messages:
+            ids.setdefault(stream, []).append(messageId)
+        pipe = self._store.pipeline(transaction = False)
+        for stream, streamIds in ids.items():
+            pipe.xack(stream, group, *streamIds)
+        pipe.execute()
+
+    def trim(self, stream):
+        """
+         Removes messages, which are delivered to and acknowledged by all
+         of consumer groups of the stream (XTRIM MINID up to the oldest
+         pending or not delivered message). Stream without groups
+         is not trimmed
+         @param stream: Stream name
+         @return: Number of removed messages
+        """
+        minId = None
+        for group in self._store.xinfo_groups(stream):
+            groupId = group['last-delivered-id']
+            if group['pending']:
+                groupId = self._store.xpending(stream, group['name'])['min']
+            if minId is None or parseId(groupId) < parseId(minId):
+                minId = groupId
+        if minId is None:
+            return 0
+        return self._store.xtrim(stream, minid = minId, approximate = False)
+
+    def close(self):
+        """ Closes connections of the store """
+        self._store.close()
+
+    def getLogName(self):
+        """ Returns name to write in logs """
+        return 'Streams'
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self._db = DatabaseStreams()
+        self._stream = 'UnitTest.stream'
+
+    def tearDown(self):
+        try:
+            self._db._store.delete(self._stream)
+        except:
+            pass
+        self._db.close()
+
+    def test_storeUse(self):
+        db = self._db
+        try:
+            db._store.delete(self._stream)
+        except:
+            print('\nRedis server is not running?\n')
+            return
+        db.createGroup(self._stream, 'group')
+        db.createGroup(self._stream, 'group')
+        db.add([(self._stream, {'body': '1'}), (self._stream, {'body': '2'})])
+        result = db.readGroup('group', 'first', [self._stream], count = 1)
+        self.assertEqual(len(result[0][1]), 1)
+        # pending message is taken over by another consumer
+        claimed = db.claim(self._stream, 'group', 'second')
+        self.assertEqual(claimed, result[0][1])
+        db.ack('group', [(self._stream, claimed[0][0])])
+        result = db.readGroup('group', 'second', [self._stream])
+        self.assertEqual(result[0][1][0][1], {b'body': b'2'})
+        self.assertEqual(len(db.read({self._stream: '0'})[0][1]), 2)
+        # the second message is pending, the first one is acknowledged
+        self.assertEqual(db.trim(self._stream), 1)
+        # not delivered messages of another group are kept
+        db.createGroup(self._stream, 'other')
+        db.ack('group', [(self._stream, result[0][1][0][0])])
+        self.assertEqual(db.trim(self._stream), 0)
+        self.assertEqual(len(db.read({self._stream: '0'})[0][1]), 1)
+
+    def test_parseId(self):
+        self.assertEqual(parseId(b'1526919030474-55'), (1526919030474, 55))
+        self.assertLess(parseId('9-0'), parseId('10-0'))
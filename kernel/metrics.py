@@ -0,0 +1,194 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Runtime metrics registry
+@copyright 2016, Maprox LLC
+"""
+
+import os
+import time
+from threading import Thread, Lock
+
+from kernel.config import conf
+from kernel.logger import log
+
+
+class MetricsRegistry:
+    """
+     Thread-safe registry of named counters.
+     One instance is shared by all listeners of the process.
+    """
+
+    def __init__(self):
+        """
+         Constructor
+        """
+        self._lock = Lock()
+        self._values = {}
+
+    def increment(self, name, value = 1):
+        """
+         Increments counter value
+         @param name: Counter name
+         @param value: Increment value
+         @return: new counter value
+        """
+        with self._lock:
+            value += self._values.get(name, 0)
+            self._values[name] = value
+        return value
+
+    def decrement(self, name, value = 1):
+        """
+         Decrements counter value
+         @param name: Counter name
+         @param value: Decrement value
+         @return: new counter value
+        """
+        return self.increment(name, -value)
+
+    def set(self, name, value):
+        """
+         Sets counter value
+         @param name: Counter name
+         @param value: New value
+        """
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name, defaultValue = 0):
+        """
+         Returns counter value
+         @param name: Counter name
+         @param defaultValue: Value if counter is not set
+         @return: counter value
+        """
+        with self._lock:
+            return self._values.get(name, defaultValue)
+
+    def getAll(self):
+        """
+         Returns a copy of all counters
+         @return: dict
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        """
+         Removes all counters
+        """
+        with self._lock:
+            self._values.clear()
+
+class MetricsReporter:
+    """
+     Writes counters of the registry to the log every interval seconds
+     (like "Metrics: balancer.timeouts=12 (+3), ..."), where changes
+     since the previous report are given in brackets
+    """
+
+    def __init__(self, registry, interval = 60):
+        """
+         Constructor
+         @param registry: MetricsRegistry instance
+         @param interval: Interval of reports (seconds), 0 disables them
+        """
+        self.registry = registry
+        self.interval = interval
+        self._previous = {}
+        self._lock = Lock()
+        self._thread = None
+        self._pid = None
+
+    def getReport(self):
+        """
+         Returns report of counters and remembers their values
+         @return: str or None if there are no counters
+        """
+        values = self.registry.getAll()
+        previous = self._previous
+        self._previous = values
+        if not values:
+            return None
+        return ', '.join('%s=%s (%+d)' % (name, values[name],
+            values[name] - previous.get(name, 0)) for name in sorted(values))
+
+    def report(self):
+        """
+         Writes counters to the log
+        """
+        report = self.getReport()
+        if report:
+            log.info('Metrics: %s', report)
+
+    def start(self):
+        """
+         Starts reporter thread if it is not started in this process
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = Thread(target = self.threadHandler, daemon = True)
+            self._thread.start()
+
+    def threadHandler(self):
+        """
+         Thread handler
+        """
+        while True:
+            time.sleep(self.interval)
+            self.report()
+
+# global metrics registry
+metrics = MetricsRegistry()
+# global reporter of metrics to the log
+reporter = MetricsReporter(metrics, conf.metricsInterval)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+from threading import Thread
+
+class TestCase(unittest.TestCase):
+
+    def test_counters(self):
+        registry = MetricsRegistry()
+        self.assertEqual(registry.get('a'), 0)
+        self.assertEqual(registry.increment('a'), 1)
+        self.assertEqual(registry.increment('a', 5), 6)
+        self.assertEqual(registry.decrement('a'), 5)
+        registry.set('b', 10)
+        self.assertEqual(registry.getAll(), {'a': 5, 'b': 10})
+        registry.reset()
+        self.assertEqual(registry.getAll(), {})
+
+    def test_threads(self):
+        registry = MetricsRegistry()
+        def worker():
+            for i in range(1000):
+                registry.increment('counter')
+        threads = [Thread(target = worker) for i in range(4)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(registry.get('counter'), 4000)
+
+    def test_reporter(self):
+        registry = MetricsRegistry()
+        reporter = MetricsReporter(registry, 0)
+        self.assertIsNone(reporter.getReport())
+        registry.increment('b.timeouts', 3)
+        registry.increment('a.packets')
+        self.assertEqual(reporter.getReport(),
+            'a.packets=1 (+1), b.timeouts=3 (+3)')
+        registry.increment('b.timeouts')
+        self.assertEqual(reporter.getReport(),
+            'a.packets=1 (+0), b.timeouts=4 (+1)')
+        # disabled reporter has no thread
+        reporter.start()
+        self.assertIsNone(reporter._thread)
@@ -62,4 +62,22 @@ options.add_option(
     default=None
 )
 
+options.add_option(
+    "-a",
+    "--all-handlers",
+    dest="allHandlers",
+    help="Listen all ports of conf/handlers/*.conf in one process",
+    action="store_true",
+    default=False
+)
+
+options.add_option(
+    "-w",
+    "--workers",
+    dest="workers",
+    help="Number of worker processes listening the same port",
+    metavar="WorkersCount",
+    default=None
+)
+
 (options, args) = options.parse_args()
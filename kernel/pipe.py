@@ -10,11 +10,15 @@ from kernel.config import conf
 from kernel.store import Store
 
 import json
+import queue
 import urllib.parse
 import urllib.request
+from concurrent.futures import Future
 
 import lib.falcon
-from lib.broker import broker
+from lib.publisher import publisher
+from lib.spool import spool
+from lib.dedupe import deduplicator, DEFAULT_WINDOW
 
 # RabbitMQ processing features
 
@@ -23,10 +27,17 @@ class Manager(Store):
     """
      Class implements communication with pipe-controller
     """
+    # minimal interval between packets of a device (seconds),
+    # it is set by the protocol handler
+    dedupeWindow = DEFAULT_WINDOW
 
     def send(self, obj):
         """
-         Sending data to the controller receiving packets from the devices
+         Sending data to the controller receiving packets from the devices.
+         It is fire-and-forget: the result reports only whether packets
+         are queued for sending. Packets, which are failed to be sent
+         later, are written to the spool if it is enabled, otherwise
+         the error is logged by the publisher
         """
         result = lib.falcon.FalconAnswer()
         try:
@@ -41,6 +52,9 @@ class Manager(Store):
                 return result
             # Let's send packets to AMQP broker
             self.sendPacketsViaBroker(packets)
+        except queue.Full:
+            result.error('503', ['Publisher queue is full'])
+            log.error('Publisher queue is full, packets are rejected')
         except Exception as E:
             result.error('500', ['Error sending packets: ' + str(E)])
             log.error(E)
@@ -48,15 +62,39 @@ class Manager(Store):
 
     def sendPacketsViaBroker(self, packets):
         """
-         Sends data to the message broker (AMQP)
+         Queues data for sending to the message broker (AMQP).
+         Packets are sent by the background publisher, so the handler
+         does not wait for the broker. Raises queue.Full if the publisher
+         queue is full for longer than conf.publishTimeout seconds.
+         If the spool is enabled, the publisher writes packets there when
+         publishing is failed and until the spool is replayed (see
+         PacketSpool.send), so the order of packets is kept. When the
+         publisher queue is full, the spool is degraded, so the queue is
+         drained to the spool, but the packets are rejected anyway, so
+         the handler thread does not wait twice
          @param packets: list of packets
-         @return:
+         @return: Future, its result is True when packets are sent
+           or spooled
         """
+        count = len(packets)
+        packets, accepted = deduplicator.filter(packets, self.dedupeWindow)
+        if len(packets) < count:
+            log.debug('Skipped %d packets, which are too close in time',
+                count - len(packets))
+        if not packets:
+            future = Future()
+            future.set_result(True)
+            return future
         try:
-            broker.send(packets)
-        except Exception as E:
-            #~print(E)
-            log.error(E)
+            future = publisher.publish(packets)
+        except queue.Full:
+            if spool.enabled:
+                spool.setDegraded()
+            raise
+        # times of packets are remembered when they are queued, so packets
+        # rejected here are not dropped when the device sends them again
+        deduplicator.commit(accepted)
+        return future
 
 class TestManager(Manager):
     stored_packets = []
@@ -0,0 +1,164 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Prefork workers supervisor
+@copyright 2016, Maprox LLC
+"""
+
+import os
+import time
+import signal
+
+from kernel.logger import log
+
+# minimal lifetime of a worker (seconds), which is not treated as a crash loop
+WORKER_MIN_LIFETIME = 1
+# delay before restarting a worker, which died too fast (seconds)
+WORKER_RESTART_DELAY = 5
+
+
+class PreforkSupervisor:
+    """
+     Forks worker processes and restarts them when they die.
+     Workers are expected to listen the same port with SO_REUSEPORT,
+     so the kernel balances incoming connections between them.
+     All modules imported before run() are shared by workers copy-on-write.
+    """
+
+    def __init__(self, workersCount):
+        """
+         Supervisor constructor
+         @param workersCount: Number of worker processes
+        """
+        self.workersCount = workersCount
+        self.workers = {}
+        self.restartsCount = 0
+        self.restartDelay = WORKER_RESTART_DELAY
+        self._stopping = False
+
+    def run(self):
+        """
+         Starts workers and supervises them.
+         Returns in the worker process only, the supervisor process
+         stays in this method until all of workers are stopped.
+         @return: True in the worker process, False when supervisor stops
+        """
+        log.info('Starting %s workers', self.workersCount)
+        for number in range(self.workersCount):
+            if self.spawn(number):
+                return True
+        signal.signal(signal.SIGTERM, self.onSignal)
+        signal.signal(signal.SIGINT, self.onSignal)
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self.workers:
+                continue
+            number, started = self.workers.pop(pid)
+            if self._stopping:
+                log.info('Worker #%s (pid %s) is stopped', number, pid)
+                continue
+            log.error('Worker #%s (pid %s) died with status %s, restarting',
+                number, pid, status)
+            if time.time() - started < WORKER_MIN_LIFETIME:
+                time.sleep(self.restartDelay)
+            if self._stopping:
+                continue
+            self.restartsCount += 1
+            if self.spawn(number):
+                return True
+        log.info('All workers are stopped')
+        return False
+
+    def spawn(self, number):
+        """
+         Forks a worker process
+         @param number: Worker number
+         @return: True in the worker process, False in the supervisor
+        """
+        pid = os.fork()
+        if pid == 0:
+            # worker process
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            self.workers = {}
+            log.info('Worker #%s is started (pid %s)', number, os.getpid())
+            return True
+        self.workers[pid] = (number, time.time())
+        return False
+
+    def onSignal(self, signum, frame):
+        """
+         Stops workers on SIGTERM/SIGINT
+        """
+        log.info('Supervisor received signal %s, stopping workers', signum)
+        self._stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import shutil
+import unittest
+import tempfile
+import multiprocessing
+
+def runTestSupervisor(directory, connection):
+    """
+     Runs supervisor of two workers, which just sleep.
+     The first worker crashes once
+     @param directory: Directory of the crash marker
+     @param connection: Pipe connection to send the result of supervisor
+    """
+    supervisor = PreforkSupervisor(2)
+    supervisor.restartDelay = 0
+    if supervisor.run():
+        # worker never returns to the code of the test runner
+        code = 0
+        try:
+            os.close(os.open(os.path.join(directory, 'crashed'),
+                os.O_CREAT | os.O_EXCL))
+            code = 1
+        except FileExistsError:
+            time.sleep(10)
+        finally:
+            os._exit(code)
+    connection.send((supervisor.restartsCount, supervisor.workers))
+
+class TestCase(unittest.TestCase):
+
+    def test_restartAndStop(self):
+        directory = tempfile.mkdtemp()
+        context = multiprocessing.get_context('fork')
+        receiver, sender = context.Pipe(False)
+        process = context.Process(target = runTestSupervisor,
+            args = (directory, sender))
+        try:
+            process.start()
+            marker = os.path.join(directory, 'crashed')
+            for _ in range(100):
+                if os.path.exists(marker): break
+                time.sleep(0.05)
+            # let the supervisor restart the crashed worker
+            time.sleep(0.5)
+            process.terminate()
+            self.assertTrue(receiver.poll(10))
+            restartsCount, workers = receiver.recv()
+            process.join(10)
+        finally:
+            if process.is_alive():
+                process.kill()
+                process.join()
+            receiver.close()
+            sender.close()
+            shutil.rmtree(directory)
+        self.assertEqual(process.exitcode, 0)
+        self.assertGreaterEqual(restartsCount, 1)
+        self.assertEqual(workers, {})
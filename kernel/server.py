@@ -5,6 +5,7 @@
 @copyright 2009-2016, Maprox LLC
 """
 
+import socket
 import traceback
 from threading import Thread
 from socketserver import TCPServer
@@ -41,7 +42,7 @@ class ClientThread(BaseRequestHandler):
     @property
     def handler(self) -> AbstractHandler:
         if not self.__handler:
-            self.__handler = HandlerClass(pipe.Manager(), self)
+            self.__handler = self.server.handlerClass(pipe.Manager(), self)
         return self.__handler
 
 
@@ -51,6 +52,17 @@ class ThreadingServer(ThreadingMixIn, TCPServer):
      Base class for tcp-server multi-threading
     """
     allow_reuse_address = True
+    reusePort = False
+    handlerClass = None
+
+    def server_bind(self):
+        """
+         Binds the socket, allowing several processes to listen
+         the same port if reusePort is set
+        """
+        if self.reusePort:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        TCPServer.server_bind(self)
 
 
 # ===========================================================================
@@ -59,25 +71,54 @@ class Server:
      Multi-threaded TCP-server
     """
 
-    def __init__(self, port):
+    def __init__(self, port, handlerClass = None, reusePort = False):
         """
          Server class constructor
          @param port: Listening port
+         @param handlerClass: Protocol handler class
+         @param reusePort: Share the port with other processes
         """
         log.debug("Server::__init__(%s)", port)
         self.host = ""
         self.port = port
-        self.server = ThreadingServer((self.host, self.port), ClientThread)
+        self.handlerClass = handlerClass or HandlerClass
+        self.server = ThreadingServer((self.host, self.port), ClientThread,
+            bind_and_activate = False)
+        self.server.handlerClass = self.handlerClass
+        self.server.reusePort = reusePort
+        try:
+            self.server.server_bind()
+            self.server.server_activate()
+        except Exception:
+            self.server.server_close()
+            raise
 
     def run(self):
         """
          Method which starts TCP-server
         """
         log.debug("Server::run()")
-        if not HandlerClass:
+        if not self.handlerClass:
             log.critical('No protocol handlers specified! (use --handler)')
             return
         server_thread = Thread(target=self.server.serve_forever)
         server_thread.setDaemon(False)
         server_thread.start()
         log.info("Server is started on port %s", self.port)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestCase(unittest.TestCase):
+
+    def test_reusePort(self):
+        first = Server(0, AbstractHandler, True)
+        port = first.server.server_address[1]
+        second = Server(port, AbstractHandler, True)
+        self.assertEqual(second.server.server_address[1], port)
+        second.server.server_close()
+        self.assertRaises(OSError, Server, port, AbstractHandler)
+        first.server.server_close()
@@ -7,7 +7,6 @@
 
 from kernel.logger import log
 from kernel.config import conf
-from kernel.server import Server
 
 
 class Starter:
@@ -15,6 +14,58 @@ class Starter:
      Base Class that starts tcp-server and other components.
     """
 
+    @staticmethod
+    def getListeners():
+        """
+         Loads protocol handlers to be started
+         @return: list of (port, handlerName, handlerClass) tuples
+        """
+        from lib.handlers.list import HandlerClass
+        from lib.handlers.list import loadListeners, HANDLERS_CONF_PATH
+        if conf.allHandlers:
+            listeners = loadListeners()
+            if not listeners:
+                raise Exception("No protocol handlers found in %s" %
+                    HANDLERS_CONF_PATH)
+            return listeners
+        # check specified port
+        if not conf.port:
+            raise Exception("Please specify port number! (use --port)")
+        if not HandlerClass:
+            raise Exception("No protocol handlers specified! (use --handler)")
+        return [(conf.port, conf.handler, HandlerClass)]
+
+    @staticmethod
+    def startListeners(listeners, reusePort = False):
+        """
+         Starts servers of the listeners in the current process.
+         Listeners share the message broker and the metrics registry.
+         @param listeners: list of (port, handlerName, handlerClass) tuples
+         @param reusePort: Share listening ports with other processes
+        """
+        from lib.broker import MessageBrokerThread
+        from lib.spool import spool
+        from kernel.metrics import reporter
+        # packets spooled by a stopped process are replayed at startup
+        if spool.enabled:
+            spool.start()
+        # counters of handlers, spool and publisher are written to the log
+        reporter.start()
+        # one AMQP commands thread for all of protocols
+        MessageBrokerThread(dict((handlerName, handlerClass)
+            for port, handlerName, handlerClass in listeners))
+        if conf.serverMode == 'asyncio':
+            from kernel.aioserver import AsyncServer
+            port, handlerName, handlerClass = listeners[0]
+            server = AsyncServer(port, handlerClass, reusePort)
+            for port, handlerName, handlerClass in listeners[1:]:
+                server.addListener(port, handlerClass)
+            server.run()
+        else:
+            from kernel.server import Server
+            for port, handlerName, handlerClass in listeners:
+                Server(port, handlerClass, reusePort).run()
+
     @staticmethod
     def run():
         """
@@ -22,9 +73,18 @@ class Starter:
         """
         log.debug('Starter::run()')
         try:
-            # check specified port
-            if not conf.port:
-                raise Exception("Please specify port number! (use --port)")
-            Server(conf.port).run()
+            from lib.transport import SERVER_TRANSPORTS
+            if conf.messageTransport not in SERVER_TRANSPORTS:
+                raise Exception("Message transport \"%s\" can not be used "
+                    "by the server (use %s)" % (conf.messageTransport,
+                    ' or '.join(SERVER_TRANSPORTS)))
+            # handler modules are loaded before fork to be shared by workers
+            listeners = Starter.getListeners()
+            reusePort = conf.workers > 1
+            if reusePort:
+                from kernel.prefork import PreforkSupervisor
+                if not PreforkSupervisor(conf.workers).run():
+                    return
+            Starter.startListeners(listeners, reusePort)
         except Exception as E:
             log.critical(E)
@@ -0,0 +1,427 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Packet receive load balancer on redis streams
+@copyright 2016, Maprox LLC
+"""
+
+import time
+from threading import Thread
+
+from kernel.logger import log
+from kernel.config import conf
+from kernel.database.streams import DatabaseStreams
+from lib.transport import RedisStreamsTransport
+from kernel.balancer import PacketReceiveBalancer, PacketReceiveManager, \
+    PacketReceiveShard, QUEUE_PREFIX, SEQUENCE_KEY, getRegistry
+
+# --------------------------------------------------------------------
+
+# consumer group of bucket streams
+STREAM_GROUP = QUEUE_PREFIX + '.balancer'
+# stream of response signals
+STREAM_RESPONSE = QUEUE_PREFIX + '.signal.response'
+# consumer group of the response stream of the balancer instance
+# (every instance reads all of response signals)
+RESPONSE_GROUP = STREAM_GROUP + '.response.%d'
+# interval of removing acknowledged messages from streams (seconds)
+TRIM_INTERVAL = 60
+
+# --------------------------------------------------------------------
+
+class StreamReceiveBalancer(PacketReceiveBalancer):
+    """
+     Packet receive load balancer, which works with redis streams
+     (conf.messageTransport = redis).
+     Packets of devices are read from bucket streams, so request signals
+     are not needed, and response signals are read from the response
+     stream by every balancer instance as a consumer group of its own,
+     so signals sent while the balancer is restarted are not lost
+    """
+    _threadSignalResponse = None
+    _trimTime = 0
+
+    def run(self):
+        """
+         Starts balancer
+         @return:
+        """
+        self._receiveManager = StreamReceiveManager(
+            registry = getRegistry(conf.balancerRegistry,
+                conf.balancerInstance)).start()
+        self._threadSignalResponse = Thread(
+            target = self.threadSignalResponseHandler)
+        self._threadSignalResponse.start()
+
+    def threadSignalResponseHandler(self):
+        threadName = 'SignalResponseThread'
+        log.debug('%s::started', threadName)
+        group = RESPONSE_GROUP % conf.balancerInstance
+        while True:
+            try:
+                store = DatabaseStreams()
+                # signals, which are written before the group is created,
+                # are not read, because devices are not dispatched yet
+                store.createGroup(STREAM_RESPONSE, group, '$')
+                self.onResponses(store, group,
+                    store.claim(STREAM_RESPONSE, group, 'balancer'))
+                while True:
+                    for stream, messages in store.readGroup(group,
+                            'balancer', [STREAM_RESPONSE], block = 1000):
+                        self.onResponses(store, group, messages)
+                    self.trimResponses(store)
+            except Exception as E:
+                log.error('%s::%s', threadName, E)
+                time.sleep(10) # sleep for 10 seconds after exception
+
+    def onResponses(self, store, group, messages):
+        """
+         Processes response signals and acknowledges them
+         @param store: DatabaseStreams instance
+         @param group: Consumer group name
+         @param messages: list of tuples (message id, fields)
+        """
+        for messageId, fields in messages:
+            self.onResponse(fields)
+        if messages:
+            store.ack(group, [(STREAM_RESPONSE, messageId)
+                for messageId, fields in messages])
+
+    def trimResponses(self, store, currentTime = None):
+        """
+         Removes response signals, which are acknowledged by all of
+         balancer instances, every TRIM_INTERVAL seconds
+         @param store: DatabaseStreams instance
+         @param currentTime: Current time, time.time() by default
+        """
+        if currentTime is None:
+            currentTime = time.time()
+        if currentTime - self._trimTime < TRIM_INTERVAL:
+            return
+        self._trimTime = currentTime
+        store.trim(STREAM_RESPONSE)
+
+    def onResponse(self, fields):
+        """
+         Executes when there is an answer in response stream
+         @param fields: dict of stream message fields
+        """
+        threadName = 'SignalResponseThread'
+        try:
+            body = RedisStreamsTransport.decode(fields)
+            uid = body.get('uid')
+            log.debug('%s:: < Signal for %s', threadName, uid)
+            if uid:
+                self._receiveManager.messageReceived(uid,
+                    body.get(SEQUENCE_KEY))
+        except Exception as E:
+            log.error('%s::%s', threadName, E)
+
+# --------------------------------------------------------------------
+
+class StreamMessage:
+    """
+     Message of a bucket stream.
+     Acknowledgement is queued and sent by the receiver thread of
+     the shard with XACK of other processed messages
+    """
+    __slots__ = ('shard', 'stream', 'id')
+
+    def __init__(self, shard, stream, messageId):
+        """
+         Constructor
+         @param shard: StreamReceiveShard instance
+         @param stream: Stream name
+         @param messageId: Stream message id
+        """
+        self.shard = shard
+        self.stream = stream
+        self.id = messageId
+
+    def ack(self):
+        with self.shard._lock:
+            self.shard._acks.append(self)
+
+class StreamReceiveShard(PacketReceiveShard):
+    """
+     Stream receive shard.
+     Reads its bucket streams as a consumer of STREAM_GROUP, packets are
+     dispatched to the receiving side by PacketReceiveShard logic, and
+     stream messages are acknowledged (XACK) when the receiving side
+     responds, so unanswered packets stay pending and are taken over
+     after restart
+    """
+
+    # maximum number of messages read from every stream at once
+    readCount = 100
+    _trimTime = 0
+    # True when pending messages of the previous run are taken over
+    _claimed = False
+
+    def __init__(self, number = 0, window = None, windows = None):
+        """
+         Class initialization
+         @param number: Shard number
+         @param window: Default window size (conf.balancerWindow)
+         @param windows: dict of window sizes by device identifiers
+        """
+        super(StreamReceiveShard, self).__init__(number, window, windows)
+        self.consumerName = 'balancer-%d' % number
+        self._store = None
+
+    def addQueue(self, key, routingKey):
+        """
+         Adds bucket stream to read
+         @param key: Bucket number
+         @param routingKey: Stream name
+        """
+        with self._lock:
+            self._queues[key] = routingKey
+
+    def threadReceiveHandler(self):
+        threadName = self.threadName
+        log.debug('%s::started', threadName)
+        while True:
+            try:
+                self._store = DatabaseStreams()
+                streams = list(self._queues.values())
+                for stream in streams:
+                    self._store.createGroup(stream, STREAM_GROUP)
+                if not self._claimed:
+                    self.claimPending(streams)
+                log.debug('%s::Reading %d streams', threadName, len(streams))
+                while True:
+                    self.readMessages(streams)
+                    self.processAcks()
+                    self.trimStreams(streams)
+                    self.checkTimeouts()
+                    self.evictIdle()
+            except Exception as E:
+                log.error('%s::%s', threadName, E)
+                time.sleep(30) # sleep for 30 seconds after exception
+
+    def claimPending(self, streams):
+        """
+         Takes over messages, which were read but not acknowledged before
+         restart. They are dispatched again in their order.
+         It is done once at start: pending messages of the running shard
+         are kept in its deques, so they are not taken over again after
+         reconnection
+         @param streams: list of stream names
+        """
+        for stream in streams:
+            for messageId, fields in self._store.claim(stream, STREAM_GROUP,
+                    self.consumerName):
+                self.onStreamMessage(stream, messageId, fields)
+        self._claimed = True
+
+    def readMessages(self, streams):
+        """
+         Reads new messages of streams (one round-trip for all of them)
+         @param streams: list of stream names
+        """
+        for stream, messages in self._store.readGroup(STREAM_GROUP,
+                self.consumerName, streams, count = self.readCount,
+                block = int(self.drainTimeout * 1000)):
+            for messageId, fields in messages:
+                self.onStreamMessage(stream, messageId, fields)
+
+    def onStreamMessage(self, stream, messageId, fields):
+        """
+         Executes when there is a packet in bucket stream
+         @param stream: Stream name
+         @param messageId: Stream message id
+         @param fields: dict of stream message fields
+        """
+        message = StreamMessage(self, stream, messageId)
+        try:
+            body = RedisStreamsTransport.decode(fields)
+        except Exception as E:
+            log.error('%s::%s', self.threadName, E)
+            message.ack()
+            return
+        self.threadReceiverOnMessage(body, message)
+
+    def processAcks(self):
+        """
+         Acknowledges messages, which are processed by the receiving side
+        """
+        with self._lock:
+            acks = self._acks
+            self._acks = []
+        if acks:
+            self._store.ack(STREAM_GROUP,
+                [(message.stream, message.id) for message in acks])
+
+    def trimStreams(self, streams, currentTime = None):
+        """
+         Removes acknowledged messages from bucket streams every
+         TRIM_INTERVAL seconds. Pending messages and messages, which are
+         not delivered yet, are kept
+         @param streams: list of stream names
+         @param currentTime: Current time, time.time() by default
+        """
+        if currentTime is None:
+            currentTime = time.time()
+        if currentTime - self._trimTime < TRIM_INTERVAL:
+            return
+        self._trimTime = currentTime
+        for stream in streams:
+            self._store.trim(stream)
+
+# --------------------------------------------------------------------
+
+class StreamReceiveManager(PacketReceiveManager):
+    """
+     Distributes bucket streams between stream receive shards.
+     Balancer instances share one consumer group, but to keep the order
+     of packets of a device every bucket is read by one instance only:
+     instance N of M reads buckets, whose number modulo M is N.
+    """
+    shardClass = StreamReceiveShard
+
+    def __init__(self, shardsCount = None, bucketsCount = None,
+            registry = None, instance = None, instances = None):
+        """
+         Class initialization
+         @param shardsCount: Number of shards (conf.balancerShards)
+         @param bucketsCount: Number of bucket streams (conf.balancerBuckets)
+         @param registry: Registry of devices (see getRegistry)
+         @param instance: Number of this balancer instance
+           (conf.balancerInstance)
+         @param instances: Number of balancer instances
+           (conf.balancerInstances)
+        """
+        if bucketsCount is None:
+            bucketsCount = conf.balancerBuckets
+        if not bucketsCount:
+            raise Exception('Streams balancer needs [balancer] buckets')
+        self.instance = conf.balancerInstance if instance is None \
+            else instance
+        self.instances = instances or conf.balancerInstances
+        super(StreamReceiveManager, self).__init__(shardsCount,
+            bucketsCount, registry)
+
+    def getBuckets(self, bucketsCount):
+        """
+         Returns bucket numbers, which are read by this instance
+         @param bucketsCount: Number of bucket streams
+         @return: iterable of int
+        """
+        return range(self.instance, bucketsCount, self.instances)
+
+    def getBucketShard(self, bucket):
+        """
+         Returns shard, which reads the bucket stream
+         @param bucket: Bucket number
+         @return: StreamReceiveShard
+        """
+        return self._shards[(bucket // self.instances) % len(self._shards)]
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+from kernel.balancer import QUEUE_MAX_TIMEOUT
+from lib.broker import broker, getBucket
+
+class TestStreams:
+    """ Redis streams storage stub """
+
+    def __init__(self, pending = None):
+        self.pending = pending or []
+        self.acks = []
+        self.trimmed = []
+
+    def createGroup(self, stream, group, startId = '0'):
+        pass
+
+    def trim(self, stream):
+        self.trimmed.append(stream)
+
+    def claim(self, stream, group, consumer):
+        return self.pending
+
+    def ack(self, group, messages):
+        self.acks.extend(messages)
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.messageTransport = conf.messageTransport
+        conf.messageTransport = 'memory'
+
+    def tearDown(self):
+        broker.getTransport().clear()
+        conf.messageTransport = self.messageTransport
+
+    def getSentPackets(self):
+        transport = broker.getTransport()
+        routingKey = conf.environment + '.mon.device.packet.receive'
+        packets = []
+        while transport.qsize(routingKey):
+            packets.append(transport.get(routingKey, 0))
+        return packets
+
+    def test_getBuckets(self):
+        manager = StreamReceiveManager(2, 8, instance = 1, instances = 2)
+        self.assertEqual([sorted(shard._queues) for shard in manager.shards],
+            [[1, 5], [3, 7]])
+        self.assertEqual(manager.shards[0]._queues[1],
+            QUEUE_PREFIX + '.create.bucket.1')
+        self.assertIs(manager.getShard('1'),
+            manager.getBucketShard(getBucket('1', 8)))
+        self.assertRaises(Exception, StreamReceiveManager, 2, 0)
+
+    def test_streamMessages(self):
+        shard = StreamReceiveShard()
+        shard._store = TestStreams([
+            (b'1-0', {b'body': b'{"uid": "s1", "time": "t1"}'}),
+            (b'2-0', {b'body': b'{"uid": "s1", "time": "t2"}'}),
+            (b'3-0', {b'body': b'bad json'})
+        ])
+        shard.claimPending(['bucket'])
+        self.assertTrue(shard._claimed)
+        self.assertEqual(self.getSentPackets(), [{'uid': 's1', 'time': 't1'}])
+        shard.processAcks()
+        self.assertEqual(shard._store.acks, [('bucket', b'3-0')])
+        shard.messageReceived('s1')
+        shard.processAcks()
+        self.assertEqual(shard._store.acks[1:], [('bucket', b'1-0')])
+        self.assertEqual(self.getSentPackets(), [{'uid': 's1', 'time': 't2'}])
+        # not answered packet stays pending until the lock timeout
+        lockTime = shard._messagesLocks['s1']
+        self.assertEqual(shard.checkTimeouts(lockTime + QUEUE_MAX_TIMEOUT), 1)
+        self.assertEqual(self.getSentPackets(), [{'uid': 's1', 'time': 't2'}])
+        self.assertEqual(len(shard._store.acks), 2)
+
+    def test_trimStreams(self):
+        shard = StreamReceiveShard()
+        shard._store = TestStreams()
+        shard.trimStreams(['b1', 'b2'], 1000)
+        shard.trimStreams(['b1', 'b2'], 1000 + TRIM_INTERVAL - 1)
+        self.assertEqual(shard._store.trimmed, ['b1', 'b2'])
+        shard.trimStreams(['b1', 'b2'], 1000 + TRIM_INTERVAL)
+        self.assertEqual(len(shard._store.trimmed), 4)
+
+    def test_responses(self):
+        balancer = StreamReceiveBalancer()
+        balancer._receiveManager = StreamReceiveManager(1, 1,
+            instance = 0, instances = 1)
+        shard = balancer._receiveManager.getShard('s1')
+        shard.threadReceiverOnMessage({'uid': 's1', 'time': 't1'}, None)
+        shard.threadReceiverOnMessage({'uid': 's1', 'time': 't2'}, None)
+        self.assertEqual(len(self.getSentPackets()), 1)
+        store = TestStreams()
+        balancer.onResponses(store, 'group', [
+            (b'1-0', {b'body': b'{"uid": "s1"}'}),
+            (b'2-0', {b'body': b'bad json'})
+        ])
+        # all of signals are acknowledged, broken ones too
+        self.assertEqual(store.acks,
+            [(STREAM_RESPONSE, b'1-0'), (STREAM_RESPONSE, b'2-0')])
+        self.assertEqual(self.getSentPackets(), [{'uid': 's1', 'time': 't2'}])
+        balancer.trimResponses(store, TRIM_INTERVAL)
+        balancer.trimResponses(store, TRIM_INTERVAL + 1)
+        self.assertEqual(store.trimmed, [STREAM_RESPONSE])
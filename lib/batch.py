@@ -0,0 +1,192 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Batch decoder of records with identical layout
+@copyright 2016, Maprox LLC
+"""
+
+from struct import calcsize
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# minimal number of records, which are decoded by batch.
+# Fewer records are decoded faster one by one
+MIN_RECORDS = 8
+
+# numpy types of struct codes
+_types = {
+    'b': 'i1', 'B': 'u1',
+    'h': 'i2', 'H': 'u2',
+    'i': 'i4', 'I': 'u4',
+    'l': 'i4', 'L': 'u4',
+    'q': 'i8', 'Q': 'u8',
+    'f': 'f4', 'd': 'f8'
+}
+
+# numpy byte orders of struct byte orders
+_byteOrders = {'<': '<', '>': '>', '!': '>', '=': '='}
+
+def isAvailable(count = None):
+    """
+     Returns True if records can be decoded by batch
+     @param count: Number of records
+     @return: bool
+    """
+    return numpy is not None and (count is None or count >= MIN_RECORDS)
+
+def getType(code, byteOrder = '<'):
+    """
+     Returns numpy type of struct code
+     @param code: struct code of one value, like 'H' or '7s'
+     @param byteOrder: struct byte order character
+     @return: str
+    """
+    if code.endswith('s'):
+        return 'S%d' % calcsize(code)
+    return _byteOrders[byteOrder] + _types[code]
+
+def getDtype(layout):
+    """
+     Returns numpy structured type of the record layout.
+     Fields with None name are skipped
+     @param layout: lib.packets.RecordLayout instance
+     @return: numpy.dtype
+    """
+    names, formats, offsets = [], [], []
+    offset = 0
+    for field in layout.fields:
+        if field[0]:
+            names.append(field[0])
+            formats.append(getType(field[1], layout.byteOrder))
+            offsets.append(offset)
+        offset += calcsize(layout.byteOrder + field[1])
+    return numpy.dtype({'names': names, 'formats': formats,
+        'offsets': offsets, 'itemsize': layout.size})
+
+def decode(layout, data, count = None, transforms = None):
+    """
+     Decodes records of the layout at once.
+     Buffer is viewed as numpy structured array, and transforms of the
+     layout are applied to whole columns: numeric scales are vectorized,
+     other callables are applied to every value, unless vectorized
+     version is given in transforms
+     @param layout: lib.packets.RecordLayout instance
+     @param data: Buffer of records (bytes or memoryview)
+     @param count: Number of records, all of the buffer by default
+     @param transforms: dict of vectorized transforms by field names
+     @return: dict of columns (numpy arrays or lists) by field names
+    """
+    transforms = transforms or {}
+    array = numpy.frombuffer(data, getDtype(layout),
+        -1 if count is None else count)
+    columns = {}
+    for field in layout.fields:
+        name = field[0]
+        if not name:
+            continue
+        column = array[name]
+        if column.dtype.kind in 'iu' and column.dtype.itemsize < 8:
+            # calculations must not overflow small types
+            column = column.astype(numpy.int64)
+        transform = field[2] if len(field) > 2 else None
+        if name in transforms:
+            column = transforms[name](column)
+        elif callable(transform):
+            column = [transform(value) for value in column.tolist()]
+        elif transform is not None:
+            column = layout.getTransform(transform)(column)
+        columns[name] = column
+    return columns
+
+def toRecords(columns):
+    """
+     Returns records of columns
+     @param columns: dict of columns (numpy arrays or lists) by names
+     @return: list of dicts with python values
+    """
+    names = list(columns)
+    values = [column.tolist() if hasattr(column, 'tolist') else column
+        for column in columns.values()]
+    return [dict(zip(names, record)) for record in zip(*values)]
+
+def convertCoordinates(values):
+    """
+     Vectorized convertCoordinate() of protocols, which inserts decimal
+     point after the second character of the value (55123456 is
+     55.123456). Division by power of ten gives the same float as
+     parsing of the decimal string
+     @param values: numpy array of int
+     @return: numpy array of float
+    """
+    values = values.astype(numpy.int64)
+    powers = 10 ** numpy.arange(19, dtype = numpy.int64)
+    # number of characters of the value (minus sign is a character)
+    length = numpy.searchsorted(powers, numpy.abs(values), side = 'right')
+    length = numpy.maximum(length, 1) + (values < 0)
+    return values / 10.0 ** numpy.maximum(length - 2, 0)
+
+def toDatetimes(values, unit = 's'):
+    """
+     Returns UTC datetime objects of unix time values
+     @param values: numpy array of int
+     @param unit: Unit of values ('s' or 'ms')
+     @return: list of datetime
+    """
+    return values.astype(numpy.int64).astype(
+        'datetime64[%s]' % unit).tolist()
+
+def getBit(values, bit):
+    """
+     Returns bit values of the column
+     @param values: numpy array of int
+     @param bit: Bit number
+     @return: numpy array of 0 and 1
+    """
+    return (values >> bit) & 1
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+from datetime import datetime
+from struct import pack
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class TestCase(unittest.TestCase):
+
+    def test_decode(self):
+        from lib.packets import RecordLayout
+        layout = RecordLayout([
+            ('number', 'H'),
+            (None, '3s'),
+            ('latitude', 'l', 0.000001),
+            ('odometer', 'L', 100),
+            ('flag', 'B', bool),
+            ('time', 'L')
+        ], '>')
+        self.assertEqual(getDtype(layout).itemsize, layout.size)
+        data = b''.join(pack('>H3slLBL', i, b'abc', 55788660 - i,
+            4000000000, i % 2, 1365045754 + i) for i in range(10))
+        columns = decode(layout, data, transforms = {'time': toDatetimes})
+        self.assertEqual(toRecords(columns),
+            [dict(record, time = datetime.utcfromtimestamp(record['time']))
+                for record in layout.unpackAll(data)])
+        self.assertEqual(len(toRecords(decode(layout, data, 3))), 3)
+
+    def test_convertCoordinates(self):
+        values = [55123456, 37654321, 0, 5, -5, -551234567, 123, 4294967295]
+        result = convertCoordinates(numpy.array(values)).tolist()
+        for value, converted in zip(values, result):
+            text = str(value)
+            self.assertEqual(converted, float(text[:2] + '.' + text[2:]))
+
+    def test_toDatetimes(self):
+        self.assertEqual(toDatetimes(numpy.array([1185345998335]), 'ms'),
+            [datetime.utcfromtimestamp(1185345998335 / 1000)])
+        self.assertEqual(getBit(numpy.array([5, 2]), 2).tolist(), [1, 0])
+        self.assertTrue(isAvailable(MIN_RECORDS))
+        self.assertFalse(isAvailable(MIN_RECORDS - 1))
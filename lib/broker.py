@@ -5,29 +5,50 @@
 @copyright 2013, Maprox LLC
 """
 
-from datetime import datetime
-from threading import Thread
+from threading import Thread, Lock, current_thread
 from kernel.config import conf
 from kernel.logger import log
+from lib.transport import AmqpTransport, getTransport
 
 from kombu import BrokerConnection, Exchange, Queue
 
+import os
 import re
 import json
 import time
+import socket
+import zlib
 #import hashlib
 
 COMMAND_STATUS_CREATED = 1
 COMMAND_STATUS_SUCCESS = 2
 COMMAND_STATUS_ERROR = 3
+# prefix of routing keys of commands and command updates, they are always
+# sent by AMQP, because consumers of commands are AMQP ones
+COMMAND_ROUTING_KEY = 'mon.device.command.'
+
+# correct device identifier
+RE_UID = re.compile('[\w-]+')
+
+def getBucket(uid, bucketsCount):
+    """
+     Returns bucket number of the device
+     @param uid: device identifier
+     @param bucketsCount: Number of buckets
+     @return: int
+    """
+    return zlib.crc32(str(uid).encode()) % bucketsCount
 
 class MessageBroker:
     """
-     RabbitMQ message broker
+     Message broker.
+     Packets are published by the transport of conf.messageTransport,
+     commands are received from RabbitMQ
     """
 
     _exchanges = None
     _commands = None
+    _transport = None
 
     def __init__(self):
         """
@@ -39,106 +60,135 @@ class MessageBroker:
             'mon.device': Exchange('mon.device', 'topic', durable = True),
             'n.work': Exchange('n.work', 'topic', durable = True)
         }
+        self._amqpTransport = AmqpTransport()
+        self._lock = Lock()
+        self._commandsLock = Lock()
+        self._handlerUids = {}
+        self._commandThread = MessageBrokerCommandThread(self)
+
+    def getTransport(self):
+        """
+         Returns transport of conf.messageTransport.
+         Transport is recreated when conf.messageTransport is changed
+         @return: AbstractTransport
+        """
+        with self._lock:
+            transport = self._transport
+            if transport is None or \
+                    transport.name != conf.messageTransport:
+                if transport is not None:
+                    transport.reset()
+                if conf.messageTransport == AmqpTransport.name:
+                    transport = self._amqpTransport
+                else:
+                    transport = getTransport(conf.messageTransport)
+                self._transport = transport
+            return transport
+
+    def getConnection(self):
+        """
+         Returns long-lived AMQP connection (see AmqpTransport)
+         @return: BrokerConnection
+        """
+        return self._amqpTransport.getConnection()
+
+    def resetConnection(self):
+        """
+         Closes connections of transports, they are opened again
+         on the next send()
+        """
+        transport = self._transport
+        if transport is not None and transport is not self._amqpTransport:
+            transport.reset()
+        self._amqpTransport.reset()
+
+    def getProducer(self):
+        """
+         Acquires AMQP producer from the pool (see AmqpTransport)
+         @return: kombu.Producer
+        """
+        return self._amqpTransport.getProducer()
+
+    def getQueue(self, routingKey, exchange):
+        """
+         Returns cached AMQP queue instance for the routing key
+         @param routingKey: str
+         @param exchange: Exchange instance
+         @return: Queue
+        """
+        return self._amqpTransport.getQueue(routingKey, exchange)
 
     def getRoutingKey(self, imei):
         """
-         Returns routing key name by device imei
+         Returns routing key name by device imei.
+         If conf.balancerBuckets is set, packets of all devices are sent
+         to the fixed number of bucket queues instead of device queues
          @param imei: device identifier
         """
+        if conf.balancerBuckets:
+            return 'mon.device.packet.create.bucket.%d' % \
+                getBucket(imei, conf.balancerBuckets)
         return 'mon.device.packet.create.%s' % imei
 
     def send(self, packets, routing_key = None, exchangeName = None):
         """
-         Sends packets to the message broker
+         Sends packets to the message broker.
+         Packets of devices are sent by the transport of
+         conf.messageTransport, commands, command updates and messages of
+         other exchanges (like SMS messages of n.work) are sent by AMQP,
+         where their consumers are
          @param packets: list of dict
          @param routing_key: str
          @param exchangeName: str
+         @return: True if packets are sent (and confirmed by the broker)
         """
         exchange = self._exchanges['mon.device']
         if (exchangeName is not None) and (exchangeName in self._exchanges):
             exchange = self._exchanges[exchangeName]
 
+        # packets of devices are serialized by conf.packetSerializer,
+        # other messages by json
+        serializer = None if routing_key else conf.packetSerializer
+        messages = []
+        routingKeys = {}
+        for packet in packets:
+            uid = None if 'uid' not in packet else packet['uid']
+
+            # we should check uid for correctness
+            uidIsCorrect = uid is not None and RE_UID.match(uid)
+
+            if uidIsCorrect and uid in routingKeys:
+                routingKey = routingKeys[uid]
+            else:
+                routingKey = routing_key
+                if not routing_key:
+                    if not uidIsCorrect: continue # skip incorrect uid
+                    routingKey = self.getRoutingKey(uid)
+
+                routingKey = conf.environment + '.' + routingKey
+                if uidIsCorrect:
+                    routingKeys[uid] = routingKey
+            messages.append((routingKey, packet))
+
+        isControl = exchange is not self._exchanges['mon.device'] or \
+            (routing_key or '').startswith(COMMAND_ROUTING_KEY)
+        transport = self._amqpTransport if isControl else \
+            self.getTransport()
         try:
-            with BrokerConnection(conf.amqpConnection) as conn:
-                log.debug('BROKER: Connect to %s' % conf.amqpConnection)
-                conn.connect()
-                connChannel = conn.channel()
-                queuesConfig = {}
-
-                # spike-nail START
-                timePrev = None
-                # spike-nail END
-
-                reUid = re.compile('[\w-]+')
-                for packet in packets:
-                    uid = None if 'uid' not in packet else packet['uid']
-
-                    # we should check uid for correctness
-                    uidIsCorrect = uid is not None and reUid.match(uid)
-
-                    timeCurr = None
-                    if 'time' in packet:
-                        timeCurr = packet['time']
-
-                    if uidIsCorrect and uid in queuesConfig:
-                        config = queuesConfig[uid]
-                    else:
-                        routingKey = routing_key
-                        if not routing_key:
-                            if not uidIsCorrect: continue # skip incorrect uid
-                            routingKey = self.getRoutingKey(uid)
-
-                        routingKey = conf.environment + '.' + routingKey
-                        config = {
-                            'routingKey': routingKey,
-                            'queue': Queue(
-                                routingKey,
-                                exchange = exchange,
-                                routing_key = routingKey
-                            )
-                        }
-                        if uidIsCorrect:
-                            queuesConfig[uid] = config
-
-                    # spike-nail START
-                    if timePrev and timeCurr:
-                        fmtDate = "%Y-%m-%dT%H:%M:%S.%f"
-                        t1 = datetime.strptime(timeCurr, fmtDate)
-                        t2 = datetime.strptime(timePrev, fmtDate)
-                        if t2 > t1:
-                            tt = t1
-                            t1 = t2
-                            t2 = tt
-                        if (t1 - t2).seconds < 10:
-                            log.debug('Skip packet with time = ' + timeCurr)
-                            continue # skip this packet if it's too close
-                    # spike-nail END
-
-                    with conn.Producer(channel = connChannel) as producer:
-                        conn.ensure_connection()
-                        producer.publish(
-                            packet,
-                            exchange = exchange,
-                            routing_key = config['routingKey'],
-                            declare = [config['queue']],
-                            retry = True
-                        )
-                    if uid:
-                        msg = 'Packet for "%s" is sent. ' % uid
-                        if 'time' in packet:
-                            msg += 'packet[\'time\'] = ' + timeCurr
-
-                            # spike-nail START
-                            timePrev = packet['time']
-                            # spike-nail END
-
-                        log.debug(msg)
-                    else:
-                        log.debug('Message is sent via message broker')
-                conn.release()
+            transport.publish(exchange, messages, serializer)
         except Exception as E:
             log.exception('Error during packet send: %s', E)
-        log.debug('BROKER: Disconnected')
+            transport.reset()
+            return False
+
+        for routingKey, packet in messages:
+            uid = packet.get('uid')
+            if uid:
+                log.debug('Packet for "%s" is sent. packet[\'time\'] = %s',
+                    uid, packet.get('time'))
+            else:
+                log.debug('Message is sent via message broker')
+        return True
 
     def amqpCommandUpdate(self, handler, status, data):
         """
@@ -188,39 +238,16 @@ class MessageBroker:
 
     def getCommands(self, handler):
         """
-         Receives packets from the message broker.
-         Runs until receives packet or timeout passes
+         Returns received command for the handler's device.
+         Commands are delivered into local storage by the command thread,
+         so no message broker round-trip is made here
          @param handler: AbstractHandler
-         @return: received packets
+         @return: command dict or None
         """
-        content = None
-        try:
-            with BrokerConnection(conf.amqpConnection) as conn:
-                routing_key = conf.environment + '.mon.device.command.' + \
-                    str(handler.uid)
-                log.debug('[%s] Check commands queue %s',
-                    handler.handlerId, routing_key)
-                command_queue = Queue(
-                    routing_key,
-                    exchange = self._exchanges['mon.device'],
-                    routing_key = routing_key)
-
-                conn.connect()
-                with conn.Consumer([command_queue],
-                    callbacks = [self.onCommand]):
-                    conn.ensure_connection()
-                    conn.drain_events(timeout = 1)
-                    command = self.getCommand(handler)
-                    if command:
-                        log.debug('[%s] We got command: %s',
-                            handler.handlerId, command)
-                        content = command
-                    else:
-                        log.debug('[%s] No commands found', handler.handlerId)
-                conn.release()
-        except Exception as E:
-            log.exception('[%s] %s', handler.handlerId, E)
-        return content
+        command = self.getCommand(handler)
+        if command:
+            log.debug('[%s] We got command: %s', handler.handlerId, command)
+        return command
 
     def onCommand(self, body, message):
         """
@@ -241,9 +268,10 @@ class MessageBroker:
         if isinstance(command, str):
             command = json.loads(command)
         uid = command["uid"]
-        if uid not in self._commands:
-            self._commands[uid] = {}
-        self._commands[uid][command['guid']] = command
+        with self._commandsLock:
+            if uid not in self._commands:
+                self._commands[uid] = {}
+            self._commands[uid][command['guid']] = command
         return command
 
     def getCommand(self, handler):
@@ -251,9 +279,10 @@ class MessageBroker:
          Returns an AMQP message from local buffer
          @param handler: AbstractHandler
         """
-        if (handler.uid in self._commands) and self._commands[handler.uid]:
-            for guid in self._commands[handler.uid]:
-                return self._commands[handler.uid][guid]
+        with self._commandsLock:
+            commands = self._commands.get(handler.uid)
+            if commands:
+                return next(iter(commands.values()))
         return None
 
     def clearCommand(self, command):
@@ -263,8 +292,11 @@ class MessageBroker:
         """
         uid = command['uid']
         guid = command['guid']
-        if (uid in self._commands) and (guid in self._commands[uid]):
-            del self._commands[uid][guid]
+        with self._commandsLock:
+            if (uid in self._commands) and (guid in self._commands[uid]):
+                del self._commands[uid][guid]
+                if not self._commands[uid]:
+                    del self._commands[uid]
 
     def handlerInitialize(self, handler):
         """
@@ -275,71 +307,111 @@ class MessageBroker:
 
     def handlerUpdate(self, handler):
         """
-         Update of handler
+         Update of handler.
+         Subscribes the command thread to the commands queue of
+         the handler's device when device is identified
          @param handler: AbstractHandler
          @return:
         """
+        if not handler.getThread():
+            # handler is not connected to a device
+            return
+        uid = handler.uid
+        previousUid = self._handlerUids.pop(handler.handlerId, None)
+        if previousUid == uid:
+            self._handlerUids[handler.handlerId] = uid
+            return
+        if previousUid:
+            self._commandThread.unsubscribe(previousUid)
+        if uid:
+            self._handlerUids[handler.handlerId] = uid
+            self._commandThread.subscribe(uid)
 
     def handlerFinalize(self, handler):
         """
-         Finalization of handler
+         Finalization of handler.
+         Unsubscribes from the commands queue of the handler's device
          @param handler: AbstractHandler
          @return:
         """
+        uid = self._handlerUids.pop(handler.handlerId, None)
+        if uid:
+            self._commandThread.unsubscribe(uid)
 
 # --------------------------------------------------------------------
 
 class MessageBrokerThread:
     """
-     Message broker thread for receiving AMQP commands for a protocol
+     Message broker thread for receiving AMQP commands for protocols.
+     One thread (and one AMQP connection) serves all given protocols.
     """
 
-    _protocolHandlerClass = None
-    _protocolAlias = None
+    _protocolHandlers = None
     _thread = None
 
-    def __init__(self, protocolHandlerClass, protocolAlias):
+    def __init__(self, protocolHandlers):
         """
          Creates broker thread for listening AMQP commands sent to
-         the specified protocol (usually for sms transport)
-         @param protocolHandlerClass: protocol handler class
-         @param protocolAlias: protocol alias
+         the specified protocols (usually for sms transport)
+         @param protocolHandlers: dict of protocol handler classes
+           by protocol alias
         """
-        log.debug('%s::__init__(%s)', self.__class__, protocolAlias)
-        self._protocolHandlerClass = protocolHandlerClass
-        self._protocolAlias = protocolAlias
+        log.debug('%s::__init__(%s)', self.__class__,
+            ', '.join(protocolHandlers))
+        self._protocolHandlers = protocolHandlers
         # starting amqp thread
         self._thread = Thread(target = self.threadHandler)
         self._thread.start()
 
+    def getRoutingKey(self, protocolAlias):
+        """
+         Returns routing key of the protocol commands queue
+         @param protocolAlias: protocol alias
+        """
+        return conf.environment + '.mon.device.command.' + protocolAlias
+
     def threadHandler(self):
         """
          Thread handler
         """
-        commandRoutingKey = conf.environment + '.mon.device.command.' + \
-            self._protocolAlias
-        commandQueue = Queue(
-            commandRoutingKey,
-            exchange = broker._exchanges['mon.device'],
-            routing_key = commandRoutingKey
-        )
+        commandQueues = []
+        for protocolAlias in self._protocolHandlers:
+            commandRoutingKey = self.getRoutingKey(protocolAlias)
+            commandQueues.append(Queue(
+                commandRoutingKey,
+                exchange = broker._exchanges['mon.device'],
+                routing_key = commandRoutingKey
+            ))
         while True:
             try:
                 with BrokerConnection(conf.amqpConnection) as conn:
                     conn.connect()
                     conn.ensure_connection()
                     log.debug('[%s] Connected to %s',
-                        self._protocolAlias, conf.amqpConnection)
-                    with conn.Consumer([commandQueue],
+                        ', '.join(self._protocolHandlers),
+                        conf.amqpConnection)
+                    with conn.Consumer(commandQueues,
                             callbacks = [self.onCommand]):
                         while True:
                             conn.ensure_connection()
                             conn.drain_events()
                     conn.release()
             except Exception as E:
-                log.exception('[%s] %s', self._protocolAlias, E)
+                log.exception('[%s] %s',
+                    ', '.join(self._protocolHandlers), E)
                 time.sleep(60) # sleep for 60 seconds after exception
 
+    def getProtocolHandlerClass(self, message):
+        """
+         Returns protocol handler class for the received message
+         @param message: message instance
+        """
+        routingKey = message.delivery_info.get('routing_key')
+        for protocolAlias, handlerClass in self._protocolHandlers.items():
+            if routingKey == self.getRoutingKey(protocolAlias):
+                return handlerClass
+        return None
+
     def onCommand(self, body, message):
         """
          Executes when command is received from queue
@@ -347,10 +419,16 @@ class MessageBrokerThread:
          @param message: message instance
         """
         import kernel.pipe as pipe
-        log.debug('[%s] Received command = %s', self._protocolAlias, body)
+        log.debug('Received command = %s', body)
 
+        handlerClass = self.getProtocolHandlerClass(message)
+        if not handlerClass:
+            log.error('No protocol handler for %s',
+                message.delivery_info.get('routing_key'))
+            message.ack()
+            return
         command = broker.storeCommand(body)
-        handler = self._protocolHandlerClass(pipe.Manager(), False)
+        handler = handlerClass(pipe.Manager(), False)
         handler.processCommand(command)
         message.ack()
 
@@ -358,8 +436,256 @@ class MessageBrokerThread:
 
 class MessageBrokerCommandThread:
     """
-     Message broker thread for receiving AMQP commands for particular device
+     Message broker thread for receiving AMQP commands for connected devices.
+     One consumer (and one AMQP connection) per process is subscribed to
+     commands queues of identified devices. Received commands are put
+     into local storage of the broker, where handlers look them up.
+     Kombu consumer is not thread-safe, so subscriptions of handler
+     threads are applied by the consumer thread between drain_events() calls.
     """
-    pass
 
-broker = MessageBroker()
\ No newline at end of file
+    # interval of applying new subscriptions (seconds)
+    drainTimeout = 1
+    # delay before reconnection after error (seconds)
+    reconnectDelay = 5
+
+    def __init__(self, broker):
+        """
+         Constructor
+         @param broker: MessageBroker instance
+        """
+        self._broker = broker
+        self._lock = Lock()
+        self._subscriptions = {}
+        self._pending = {}
+        self._thread = None
+        self._pid = None
+
+    def getRoutingKey(self, uid):
+        """
+         Returns routing key of the device commands queue
+         @param uid: device identifier
+        """
+        return conf.environment + '.mon.device.command.' + str(uid)
+
+    def subscribe(self, uid):
+        """
+         Subscribes to the commands queue of the device
+         @param uid: device identifier
+        """
+        with self._lock:
+            count = self._subscriptions.get(uid, 0)
+            self._subscriptions[uid] = count + 1
+            if not count:
+                self._pending[uid] = True
+        self.start()
+
+    def unsubscribe(self, uid):
+        """
+         Unsubscribes from the commands queue of the device,
+         when the last handler of the device is finalized
+         @param uid: device identifier
+        """
+        with self._lock:
+            count = self._subscriptions.get(uid, 0) - 1
+            if count > 0:
+                self._subscriptions[uid] = count
+            elif uid in self._subscriptions:
+                del self._subscriptions[uid]
+                self._pending[uid] = False
+
+    @property
+    def subscriptions(self):
+        return self._subscriptions
+
+    def start(self):
+        """
+         Starts consumer thread if it is not started in this process
+        """
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            # subscriptions are re-applied on (re)connect
+            self._pending = {}
+            self._thread = Thread(target = self.threadHandler, daemon = True)
+            self._thread.start()
+
+    def stop(self):
+        """
+         Stops consumer thread
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._thread = None
+        thread.join()
+
+    def isRunning(self):
+        """
+         Returns True in the current consumer thread until stop() is called
+        """
+        return self._thread is current_thread()
+
+    def applySubscriptions(self, consumer):
+        """
+         Adds and cancels queues of the consumer
+         @param consumer: kombu.Consumer
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if not pending:
+            return
+        exchange = self._broker._exchanges['mon.device']
+        for uid, subscribe in pending.items():
+            routingKey = self.getRoutingKey(uid)
+            if subscribe:
+                log.debug('Subscribe to commands queue %s', routingKey)
+                consumer.add_queue(
+                    self._broker.getQueue(routingKey, exchange))
+            else:
+                log.debug('Unsubscribe from commands queue %s', routingKey)
+                consumer.cancel_by_queue(routingKey)
+        consumer.consume()
+
+    def threadHandler(self):
+        """
+         Thread handler
+        """
+        while self.isRunning():
+            try:
+                with BrokerConnection(conf.amqpConnection) as conn:
+                    conn.ensure_connection()
+                    log.debug('Commands consumer is connected to %s',
+                        conf.amqpConnection)
+                    with conn.Consumer([],
+                            callbacks = [self._broker.onCommand]) as consumer:
+                        with self._lock:
+                            self._pending = dict((uid, True)
+                                for uid in self._subscriptions)
+                        while self.isRunning():
+                            self.applySubscriptions(consumer)
+                            try:
+                                conn.drain_events(timeout = self.drainTimeout)
+                            except socket.timeout:
+                                pass
+            except Exception as E:
+                log.exception('Commands consumer error: %s', E)
+                time.sleep(self.reconnectDelay)
+
+broker = MessageBroker()
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.amqpConnection = conf.amqpConnection
+        conf.amqpConnection = 'memory://'
+
+    def tearDown(self):
+        broker._commandThread.stop()
+        broker.resetConnection()
+        conf.amqpConnection = self.amqpConnection
+
+    def getReceivedPackets(self, uid):
+        queue = broker.getQueue(
+            conf.environment + '.' + broker.getRoutingKey(uid),
+            broker._exchanges['mon.device'])
+        packets = []
+        with BrokerConnection('memory://') as conn:
+            with conn.SimpleQueue(queue) as simpleQueue:
+                while simpleQueue.qsize():
+                    message = simpleQueue.get(timeout = 1)
+                    packets.append(message.payload)
+                    message.ack()
+        return packets
+
+    def test_sendReusesConnection(self):
+        broker.send([{'uid': 'test-pool', 'n': 1}, {'uid': None, 'n': 2}])
+        connection = broker.getConnection()
+        broker.send([{'uid': 'test-pool', 'n': 3}])
+        self.assertIs(broker.getConnection(), connection)
+        self.assertEqual(self.getReceivedPackets('test-pool'),
+            [{'uid': 'test-pool', 'n': 1}, {'uid': 'test-pool', 'n': 3}])
+
+    def test_connectionUrlChange(self):
+        connection = broker.getConnection()
+        conf.amqpConnection = 'memory://localhost/'
+        self.assertIsNot(broker.getConnection(), connection)
+        broker.resetConnection()
+        self.assertIsNone(broker._amqpTransport._connection)
+
+    def waitForCommand(self, handler):
+        for _ in range(100):
+            command = broker.getCommands(handler)
+            if command: return command
+            time.sleep(0.02)
+        return None
+
+    def test_commandThread(self):
+        class Handler:
+            handlerId = 'test'
+            uid = 'test-commands'
+            def getThread(self): return True
+        handler = Handler()
+        commandThread = broker._commandThread
+        commandThread.drainTimeout = 0.05
+        broker.send([{'uid': handler.uid, 'guid': '1', 'command': 'test'}],
+            routing_key = 'mon.device.command.' + handler.uid)
+        broker.handlerUpdate(handler)
+        broker.handlerUpdate(handler)
+        self.assertEqual(commandThread.subscriptions, {handler.uid: 1})
+        command = self.waitForCommand(handler)
+        self.assertEqual(command['guid'], '1')
+        broker.clearCommand(command)
+        self.assertIsNone(broker.getCommands(handler))
+        broker.handlerFinalize(handler)
+        self.assertEqual(commandThread.subscriptions, {})
+
+    def test_memoryTransport(self):
+        messageTransport = conf.messageTransport
+        try:
+            conf.messageTransport = 'memory'
+            transport = broker.getTransport()
+            self.assertEqual(transport.name, 'memory')
+            self.assertTrue(broker.send([{'uid': 'test-memory', 'n': 1},
+                {'uid': 'bad uid!', 'n': 2}]))
+            routingKey = conf.environment + '.' + \
+                broker.getRoutingKey('test-memory')
+            self.assertEqual(transport.qsize(routingKey), 1)
+            self.assertEqual(transport.get(routingKey, 0),
+                {'uid': 'test-memory', 'n': 1})
+            # command updates are sent by AMQP whatever the transport is
+            self.assertTrue(broker.send([{'guid': '1', 'status': 2}],
+                routing_key = 'mon.device.command.update'))
+            routingKey = conf.environment + '.mon.device.command.update'
+            self.assertEqual(transport.qsize(routingKey), 0)
+            queue = broker.getQueue(routingKey, broker._exchanges['mon.device'])
+            with BrokerConnection('memory://') as conn:
+                with conn.SimpleQueue(queue) as simpleQueue:
+                    message = simpleQueue.get(timeout = 1)
+                    self.assertEqual(message.payload,
+                        {'guid': '1', 'status': 2})
+                    message.ack()
+        finally:
+            conf.messageTransport = messageTransport
+        self.assertIs(broker.getTransport(), broker._amqpTransport)
+
+    def test_packetSerializer(self):
+        packetSerializer = conf.packetSerializer
+        packet = {'uid': 'test-serializer',
+            'time': '2013-04-04T03:22:34.000000', 'sensors': {'sos': 1}}
+        try:
+            conf.packetSerializer = 'pipe'
+            broker.send([packet])
+        finally:
+            conf.packetSerializer = packetSerializer
+        # consumer decodes the packet by its content type
+        self.assertEqual(self.getReceivedPackets('test-serializer'), [packet])
@@ -0,0 +1,195 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Receive buffer of the connection
+@copyright 2016, Maprox LLC
+"""
+
+# default size of the buffer
+DEFAULT_BUFFER_SIZE = 8192
+
+
+class ReceiveBuffer:
+    """
+     Reusable buffer of received data.
+     Socket data is read directly into the bytearray (recv_into), parsers
+     get memoryview windows into it and mark parsed data as consumed.
+     Consumed bytes are reclaimed by moving the unparsed remainder
+     to the beginning of the buffer only when there is no free space.
+     Bytes under memoryviews, which are kept by parsed packets (like
+     rawDataTail), are never overwritten: a new bytearray is allocated
+     instead of compaction while such views exist.
+    """
+
+    def __init__(self, size = DEFAULT_BUFFER_SIZE):
+        """
+         Buffer constructor
+         @param size: Initial size of the buffer
+        """
+        self._data = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def capacity(self):
+        return len(self._data)
+
+    def view(self):
+        """
+         Returns memoryview of unconsumed data.
+         The view is valid until the next write to the buffer.
+         @return: memoryview
+        """
+        return memoryview(self._data)[self._start:self._end]
+
+    def isExported(self):
+        """
+         Returns True if memoryviews of the buffer exist.
+         Bytearray with exported buffer can not be resized, so it is
+         checked by appending and removing of one byte
+         @return: bool
+        """
+        try:
+            self._data.append(0)
+        except BufferError:
+            return True
+        del self._data[-1]
+        return False
+
+    def read(self):
+        """
+         Returns unconsumed data as bytes and clears the buffer
+         @return: bytes
+        """
+        data = bytes(self.view())
+        self.clear()
+        return data
+
+    def consume(self, size):
+        """
+         Marks data as parsed
+         @param size: Number of bytes from the beginning of unconsumed data
+        """
+        self._start = min(self._start + size, self._end)
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def clear(self):
+        """
+         Removes all data from the buffer
+        """
+        self._start = self._end = 0
+
+    def reserve(self, size):
+        """
+         Makes room for size bytes at the end of the buffer
+         @param size: Number of bytes
+        """
+        if len(self._data) - self._end >= size:
+            return
+        length = self._end - self._start
+        capacity = len(self._data)
+        if capacity - length < size:
+            capacity = max(capacity * 2, length + size)
+        elif not self.isExported():
+            # compaction: move unconsumed data to the beginning
+            capacity = None
+        if capacity is None:
+            self._data[:length] = self._data[self._start:self._end]
+        else:
+            # a new bytearray is allocated instead of resizing or
+            # compaction, because memoryviews of the old one may exist
+            data = bytearray(capacity)
+            data[:length] = self._data[self._start:self._end]
+            self._data = data
+        self._start = 0
+        self._end = length
+
+    def append(self, data):
+        """
+         Appends data to the buffer
+         @param data: bytes-like object
+        """
+        size = len(data)
+        self.reserve(size)
+        self._data[self._end:self._end + size] = data
+        self._end += size
+
+    def recvInto(self, sock, size):
+        """
+         Receives data from the socket directly into the buffer
+         @param sock: socket object
+         @param size: Maximum number of bytes to receive
+         @return: Number of received bytes
+        """
+        self.reserve(size)
+        with memoryview(self._data) as view:
+            received = sock.recv_into(view[self._end:self._end + size], size)
+        self._end += received
+        return received
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+import socket
+
+class TestCase(unittest.TestCase):
+
+    def test_appendConsume(self):
+        buffer = ReceiveBuffer(8)
+        buffer.append(b'01234')
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(buffer.view(), b'01234')
+        buffer.consume(3)
+        self.assertEqual(buffer.view(), b'34')
+        # compaction, no reallocation
+        buffer.append(b'56789')
+        self.assertEqual(buffer.capacity, 8)
+        self.assertEqual(buffer.view(), b'3456789')
+        # growing
+        buffer.append(b'abc')
+        self.assertEqual(buffer.capacity, 16)
+        self.assertEqual(buffer.read(), b'3456789abc')
+        self.assertEqual(len(buffer), 0)
+
+    def test_growWithExportedView(self):
+        buffer = ReceiveBuffer(4)
+        buffer.append(b'0123')
+        view = buffer.view()
+        buffer.append(b'4567')
+        self.assertEqual(view, b'0123')
+        self.assertEqual(buffer.view(), b'01234567')
+
+    def test_compactWithExportedView(self):
+        buffer = ReceiveBuffer(8)
+        buffer.append(b'012345')
+        # like rawDataTail of a parsed packet
+        tail = buffer.view()[4:]
+        buffer.consume(4)
+        buffer.append(b'6789')
+        self.assertEqual(tail, b'45')
+        self.assertEqual(buffer.capacity, 8)
+        self.assertEqual(buffer.view(), b'456789')
+        self.assertFalse(buffer.isExported())
+        del tail
+        buffer.consume(2)
+        buffer.append(b'abcd')
+        self.assertEqual(buffer.view(), b'6789abcd')
+
+    def test_recvInto(self):
+        left, right = socket.socketpair()
+        try:
+            buffer = ReceiveBuffer(4)
+            left.sendall(b'0123456789')
+            received = 0
+            while received < 10:
+                received += buffer.recvInto(right, 4)
+            self.assertEqual(buffer.view(), b'0123456789')
+        finally:
+            left.close()
+            right.close()
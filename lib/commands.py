@@ -22,15 +22,34 @@ class AbstractCommand(object):
     _commandData = None
     """ Command initial data """
 
-    def __init__(self, params = None, commandData = None):
+    _config = None
+    """ Listener settings """
+
+    def __init__(self, params = None, commandData = None, config = None):
         """
          Initialize command with specific params
          @param params: dict
+         @param commandData: dict
+         @param config: dict Listener settings
          @return:
         """
         self._commandData = commandData
+        self._config = config or {}
         self.setParams(params)
 
+    def getConfigOption(self, key, defaultValue = None):
+        """
+         Returns listener configuration option by its key
+         @param key: Configuration key
+         @param defaultValue: Default value if key is not found
+         @return: mixed
+        """
+        if key in self._config:
+            return self._config[key]
+        if conf.has_section('settings'):
+            return conf['settings'].get(key, defaultValue)
+        return defaultValue
+
     def setParams(self, params):
         """
          Set command params if needed.
@@ -79,7 +98,8 @@ class AbstractCommandConfigure(AbstractCommand):
         if isinstance(data, str): data = json.loads(data)
         dictSetItemIfNotSet(data, 'identifier', '')
         # host and port part of input
-        dictSetItemIfNotSet(data, 'port', str(conf.port))
+        dictSetItemIfNotSet(data, 'port',
+            str(self._config.get('port', conf.port)))
         dictSetItemIfNotSet(data, 'host', conf.hostIp\
             if self.hostNameNotSupported else conf.hostName)
         # check if supplied host, but protocol does not support host
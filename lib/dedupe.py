@@ -0,0 +1,239 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Thinning of device packets by time
+@copyright 2016, Maprox LLC
+"""
+
+import calendar
+from datetime import datetime
+from collections import OrderedDict
+from threading import Lock
+
+from kernel.config import conf
+
+# default minimal interval between packets of a device (seconds)
+DEFAULT_WINDOW = 10
+
+
+def getEpoch(value):
+    """
+     Returns unix time of the packet time.
+     Packet time is a datetime or a string of '%Y-%m-%dT%H:%M:%S.%f'
+     format, the string is read by fixed offsets instead of strptime()
+     @param value: datetime or str
+     @return: int or None if value is incorrect
+    """
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    try:
+        return calendar.timegm((int(value[0:4]), int(value[5:7]),
+            int(value[8:10]), int(value[11:13]), int(value[14:16]),
+            int(value[17:19])))
+    except (TypeError, ValueError):
+        return None
+
+
+# keys of plain position packets, only such packets are thinned
+POSITION_KEYS = frozenset(('uid', 'uid2', 'time', 'time_rtc', 'time_send',
+    'latitude', 'longitude', 'altitude', 'speed', 'azimuth',
+    'satellitescount', 'hdop', 'vdop', 'pdop', 'odometer', 'sensors'))
+# sensors of events, packets with not empty values of them are not thinned
+EVENT_SENSORS = ('sos', 'alarm_code', 'alarm_cause', 'message',
+    'button_pressed_id', 'critical_angle', 'critical_vibration')
+
+
+def isPosition(packet):
+    """
+     Returns True if packet is a plain position packet.
+     Packets with other keys (like images of AbstractHandler.sendImages)
+     and packets of events are never dropped
+     @param packet: dict
+     @return: bool
+    """
+    if not POSITION_KEYS.issuperset(packet):
+        return False
+    sensors = packet.get('sensors')
+    if isinstance(sensors, dict):
+        for name in EVENT_SENSORS:
+            if sensors.get(name):
+                return False
+    return True
+
+
+class PacketDeduplicator:
+    """
+     Drops position packets of a device, which are closer in time than
+     the window to the last accepted packet of the same device.
+     Last accepted time is kept for every uid between store() calls,
+     the number of uids is bounded by LRU eviction.
+    """
+
+    def __init__(self, maxSize = 100000):
+        """
+         Constructor
+         @param maxSize: Maximum number of uids to remember
+        """
+        self.maxSize = maxSize
+        self._times = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._times)
+
+    def accept(self, uid, epoch, window, accepted = None):
+        """
+         Returns True if packet should be sent.
+         Time of the packet is remembered in the accepted dict if it is
+         given (see commit), otherwise at once
+         @param uid: Device identifier
+         @param epoch: int Unix time of the packet
+         @param window: Minimal interval between packets (seconds)
+         @param accepted: dict of accepted, but not committed times by uids
+         @return: bool
+        """
+        times = self._times
+        with self._lock:
+            previous = times.get(uid)
+            if uid in times:
+                times.move_to_end(uid)
+        if accepted and uid in accepted:
+            previous = accepted[uid]
+        if previous is not None and abs(epoch - previous) < window:
+            return False
+        if accepted is None:
+            self.commit({uid: epoch})
+        else:
+            accepted[uid] = epoch
+        return True
+
+    def commit(self, accepted):
+        """
+         Remembers times of accepted packets.
+         It is called when packets are queued for sending, so packets,
+         which are rejected, are not dropped when the device sends
+         them again
+         @param accepted: dict of times by uids
+        """
+        times = self._times
+        with self._lock:
+            for uid, epoch in accepted.items():
+                times[uid] = epoch
+                times.move_to_end(uid)
+            while len(times) > self.maxSize:
+                times.popitem(last = False)
+
+    def filter(self, packets, window = DEFAULT_WINDOW):
+        """
+         Returns position packets, which are not too close in time to
+         previous ones, and other packets
+         @param packets: list of dict
+         @param window: Minimal interval between packets (seconds)
+         @return: tuple (list of dict, dict of accepted times by uids),
+           accepted times must be given to commit()
+        """
+        accepted = {}
+        if not window:
+            return packets, accepted
+        result = []
+        for packet in packets:
+            uid = packet.get('uid')
+            epoch = getEpoch(packet['time']) if 'time' in packet else None
+            if uid is None or epoch is None or not isPosition(packet) or \
+                    self.accept(uid, epoch, window, accepted):
+                result.append(packet)
+        return result, accepted
+
+    def clear(self):
+        """
+         Forgets all of stored times
+        """
+        with self._lock:
+            self._times.clear()
+
+# global deduplicator of device packets
+deduplicator = PacketDeduplicator(conf.dedupeCacheSize)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestCase(unittest.TestCase):
+
+    def test_getEpoch(self):
+        self.assertEqual(getEpoch('2013-04-04T03:22:34.000000'), 1365045754)
+        self.assertEqual(getEpoch(datetime(2013, 4, 4, 3, 22, 34)),
+            1365045754)
+        self.assertIsNone(getEpoch('bad time'))
+        self.assertIsNone(getEpoch(None))
+
+    def test_filter(self):
+        deduplicator = PacketDeduplicator()
+        packets = [
+            {'uid': '1', 'time': '2013-04-04T03:22:30.000000'},
+            {'uid': '1', 'time': '2013-04-04T03:22:35.000000'},
+            {'uid': '2', 'time': '2013-04-04T03:22:35.000000'},
+            {'uid': '1', 'time': '2013-04-04T03:22:40.000000'},
+            {'uid': '1'}
+        ]
+        result, accepted = deduplicator.filter(packets)
+        self.assertEqual(result,
+            [packets[0], packets[2], packets[3], packets[4]])
+        # times are remembered by commit only
+        self.assertEqual(len(deduplicator), 0)
+        deduplicator.commit(accepted)
+        self.assertEqual(deduplicator.filter([
+            {'uid': '1', 'time': '2013-04-04T03:22:45.000000'}]), ([], {}))
+        self.assertEqual(deduplicator.filter(packets[1:2], 0)[0],
+            packets[1:2])
+
+    def test_filterEvents(self):
+        deduplicator = PacketDeduplicator()
+        time = '2013-04-04T03:22:30.000000'
+        deduplicator.commit(deduplicator.filter([
+            {'uid': '1', 'time': time, 'latitude': 55.1,
+                'sensors': {'sos': 0}}])[1])
+        packets = [
+            {'uid': '1', 'time': time, 'images': []},
+            {'uid': '1', 'time': time, 'sensors': {'sos': 1}},
+            {'uid': '1', 'time': time, 'sensors': {'alarm_code': 3}},
+            {'uid': '1', 'time': time, 'sensors': {'sos': 0}}
+        ]
+        self.assertEqual(deduplicator.filter(packets)[0], packets[:3])
+        self.assertTrue(isPosition({'uid': '1', 'time': time,
+            'latitude': 55.1, 'sensors': {'sos': 0}}))
+
+    def test_lruEviction(self):
+        deduplicator = PacketDeduplicator(2)
+        deduplicator.accept('1', 0, 10)
+        deduplicator.accept('2', 0, 10)
+        self.assertFalse(deduplicator.accept('1', 5, 10))
+        deduplicator.accept('3', 0, 10)
+        self.assertEqual(len(deduplicator), 2)
+        # uid '2' is evicted, so its packet is accepted
+        self.assertTrue(deduplicator.accept('2', 5, 10))
+
+    def test_commitWhenQueued(self):
+        import queue
+        import kernel.pipe as pipe
+        class TestPublisher:
+            full = True
+            def publish(self, packets):
+                if self.full: raise queue.Full()
+                return packets
+        manager = pipe.Manager()
+        packets = [{'uid': 'dedupe-1', 'time': '2013-04-04T03:22:30.000000'}]
+        modulePublisher = pipe.publisher
+        try:
+            pipe.publisher = TestPublisher()
+            self.assertRaises(queue.Full, manager.sendPacketsViaBroker,
+                packets)
+            # the device sends rejected packets again
+            pipe.publisher.full = False
+            self.assertEqual(manager.sendPacketsViaBroker(packets), packets)
+            self.assertTrue(manager.sendPacketsViaBroker(packets).result())
+        finally:
+            pipe.publisher = modulePublisher
+            deduplicator.clear()
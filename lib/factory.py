@@ -6,6 +6,7 @@
 """
 
 from lib.commands import *
+from lib.packets import iterPacketsFromBuffer
 
 # ---------------------------------------------------------------------------
 
@@ -36,20 +37,55 @@ class AbstractPacketFactory(AbstractFactory):
     """
      Abstract packet factory
     """
+    def getFrameSize(self, data):
+        """
+         Returns size of the packet at the beginning of data.
+         Only header and length of the packet are read, packet instance
+         is not created. Override in child classes.
+         @param data: Input binary data (bytes or memoryview)
+         @return: int size of the packet (it is greater than len(data) if
+           the packet is not received completely; if even the length is not
+           received, size of the header and length fields is returned)
+           or None if packet size can not be determined without parsing
+        """
+        return None
+
+    def getFramesSize(self, data):
+        """
+         Returns size of complete packets at the beginning of data
+         @param data: Input binary data (bytes or memoryview)
+         @return: tuple (size of complete packets,
+           size required for the next incomplete packet or 0)
+        """
+        view = memoryview(data)
+        length = len(view)
+        offset = 0
+        while offset < length:
+            size = self.getFrameSize(view[offset:])
+            if not size:
+                # packets can not be framed, the rest is parsed as is
+                return length, 0
+            if offset + size > length:
+                return offset, size
+            offset += size
+        return offset, 0
+
+    def iterPacketsFromBuffer(self, data = None):
+        """
+         Yields BasePacket instances from data.
+         Buffer is walked once, packets get memoryview windows of it.
+         @param data: Input binary data
+        """
+        if not data: return
+        yield from iterPacketsFromBuffer(self.getInstance, data)
+
     def getPacketsFromBuffer(self, data = None):
         """
          Returns an array of BasePacket instances from data
          @param data: Input binary data
          @return: array of BasePacket instances (empty array if no packet found)
         """
-        packets = []
-        while True:
-            packet = self.getInstance(data)
-            if not packet: break
-            data = packet.rawDataTail
-            packets.append(packet)
-            if not data or len(data) == 0: break
-        return packets
+        return list(self.iterPacketsFromBuffer(data))
 
 # ---------------------------------------------------------------------------
 
@@ -71,6 +107,6 @@ class AbstractCommandFactory(AbstractFactory):
         commandClassName = getCommandClassByAlias(data["command"], self.module)
         if commandClassName:
             params = {} if not "params" in data else data["params"]
-            return commandClassName(params, data)
+            return commandClassName(params, data, self.config)
         else:
             return None
@@ -13,7 +13,10 @@ import socket
 from kernel.utils import NeedMoreDataException
 from kernel.logger import log
 from kernel.config import conf
+from kernel.metrics import metrics
 from lib.broker import broker
+from lib.buffer import ReceiveBuffer
+from lib.dedupe import DEFAULT_WINDOW
 
 
 class AbstractHandler(object):
@@ -23,7 +26,11 @@ class AbstractHandler(object):
     _packetsFactory = None # packets factory link
     _commandsFactory = None # commands factory link
 
-    _buffer = None # buffer of the current dispatch loop (for storage save)
+    _alias = None # protocol alias of the listener
+    _settings = None # listener settings (None to use global configuration)
+
+    _buffer = None # receive buffer of the connection (lib.buffer)
+    _frameSize = 0 # size of the incomplete packet in the buffer
     _uid = None # identifier of currently connected device
 
     def __init__(self, store, clientThread):
@@ -35,6 +42,9 @@ class AbstractHandler(object):
         self.__handlerId = binascii.hexlify(os.urandom(4)).decode()
         self.__store = store
         self.__thread = clientThread
+        if store is not None:
+            store.dedupeWindow = self.getDedupeWindow()
+        metrics.increment(self.alias + '.handlers')
         self.initialization()
 
     def __del__(self):
@@ -65,6 +75,10 @@ class AbstractHandler(object):
     def handlerId(self):
         return self.__handlerId
 
+    @property
+    def alias(self):
+        return self._alias or conf.handler or ''
+
     @property
     def uid(self):
         return self._uid
@@ -88,10 +102,8 @@ class AbstractHandler(object):
           clientThread thread of the socket;
         """
         log.debug('[%s] dispatch()', self.handlerId)
-        buffer = self.recv()
-        while len(buffer) > 0:
-            self.processData(buffer)
-            buffer = self.recv()
+        while self.recvIntoBuffer() > 0:
+            self.processBuffer()
         log.debug('[%s] dispatch() - EXIT (empty buffer?)', self.handlerId)
 
     def needProcessCommands(self):
@@ -101,6 +113,15 @@ class AbstractHandler(object):
         """
         return self.uid
 
+    def getBuffer(self):
+        """
+         Returns receive buffer of the connection
+         @return: lib.buffer.ReceiveBuffer
+        """
+        if self._buffer is None:
+            self._buffer = ReceiveBuffer(conf.socketPacketLength)
+        return self._buffer
+
     def processData(self, data):
         """
          Processing of data from socket / storage.
@@ -108,22 +129,57 @@ class AbstractHandler(object):
          @param data: Data from socket
         """
         if self._packetsFactory:
-            try:
-                if self._buffer is None:
-                    self._buffer = b''
-                self._buffer += data
-                protocolPackets = (
-                    self._packetsFactory.getPacketsFromBuffer(self._buffer)
-                )
-                for protocolPacket in protocolPackets:
-                    self.processProtocolPacket(protocolPacket)
-                self._buffer = None
-            except NeedMoreDataException as E:
-                log.info('[%s] Need more data...', self.handlerId)
-                return
-            except Exception as E:
-                log.error("[%s] processData error: %s", self.handlerId, E)
+            self.getBuffer().append(data)
+            return self.processBuffer()
+
+        return self.__processCommandsIfNeeded()
 
+    def processBuffer(self):
+        """
+         Processing of data received into the receive buffer.
+         Packets are parsed from a memoryview of the buffer, handlers
+         without packets factory get received data in processData()
+        """
+        buffer = self.getBuffer()
+        if not self._packetsFactory:
+            return self.processData(buffer.read())
+
+        # packets are parsed only when they are received completely
+        if len(buffer) < self._frameSize:
+            log.info('[%s] Need more data...', self.handlerId)
+            return
+        data = buffer.view()
+        size, self._frameSize = self._packetsFactory.getFramesSize(data)
+        if not size:
+            log.info('[%s] Need more data...', self.handlerId)
+            return
+
+        try:
+            protocolPackets = (
+                self._packetsFactory.getPacketsFromBuffer(data[:size])
+            )
+            for protocolPacket in protocolPackets:
+                self.processProtocolPacket(protocolPacket)
+            buffer.consume(size)
+        except NeedMoreDataException as E:
+            # the frame is received completely, so it is malformed and
+            # would stall the connection if it was left in the buffer
+            log.error("[%s] Incorrect frame of %s bytes is dropped: %s",
+                self.handlerId, size, E)
+            buffer.consume(size)
+            self._frameSize = 0
+        except Exception as E:
+            log.error("[%s] processData error: %s", self.handlerId, E)
+            buffer.clear()
+            self._frameSize = 0
+
+        return self.__processCommandsIfNeeded()
+
+    def __processCommandsIfNeeded(self):
+        """
+         Processes AMQP commands if device is identified
+         @return: self
+        """
         log.debug('[%s] Checking handler commands', self.handlerId)
         if not self.needProcessCommands():
             return self
@@ -140,6 +196,26 @@ class AbstractHandler(object):
         """
         pass
 
+    def recvIntoBuffer(self):
+        """
+         Receiving data from socket directly into the receive buffer
+         @return: Number of received bytes (0 if connection is closed)
+        """
+        sock = self.getThread().request
+        sock.settimeout(60)
+        while True:
+            try:
+                received = self.getBuffer().recvInto(sock,
+                    conf.socketPacketLength)
+            except socket.timeout:
+                self.processEvents()
+                continue
+            except Exception as E:
+                log.debug('[%s] %s', self.handlerId, E)
+                return 0
+            log.debug('[%s] Received %s bytes', self.handlerId, received)
+            return received
+
     def recv(self):
         """
          Receiving data from socket
@@ -193,6 +269,7 @@ class AbstractHandler(object):
          @param packets: A list of packets
          @return: Instance of lib.falcon.answer.FalconAnswer
         """
+        metrics.increment(self.alias + '.packets', len(packets))
         result = self.getStore().send(packets)
         if result.isSuccess():
             log.debug('[%s] store() ... OK', self.handlerId)
@@ -262,6 +339,20 @@ class AbstractHandler(object):
             packet['sensors'] = sensor.copy()
         return self
 
+    @classmethod
+    def getSettings(cls):
+        """
+         Returns settings of the listener
+         @return: dict
+        """
+        if cls._settings is not None:
+            return cls._settings
+        settings = {}
+        if conf.has_section('settings'):
+            settings.update(conf['settings'])
+        settings['port'] = conf.port
+        return settings
+
     def getConfigOption(self, key, defaultValue = None):
         """
          Returns configuration option by its key
@@ -269,11 +360,21 @@ class AbstractHandler(object):
          @param defaultValue: Default value if key is not found
          @return: mixed
         """
+        if self._settings is not None:
+            return self._settings.get(key, defaultValue)
         if conf.has_section('settings'):
             section = conf['settings']
             return section.get(key, defaultValue)
         return defaultValue
 
+    def getDedupeWindow(self):
+        """
+         Returns minimal interval between stored packets of the device.
+         Set dedupeWindow = 0 in the handler settings to store all packets
+         @return: int seconds
+        """
+        return int(self.getConfigOption('dedupeWindow', DEFAULT_WINDOW))
+
     def processCommands(self):
         """
          Processing AMQP commands for current device
@@ -392,4 +493,4 @@ class AbstractHandler(object):
         log.debug('%s::initAmqpThread() / %s', cls, protocol)
         # start message broker thread for receiving sms commands
         from lib.broker import MessageBrokerThread
-        MessageBrokerThread(cls, protocol)
+        MessageBrokerThread({protocol: cls})
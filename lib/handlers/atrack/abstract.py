@@ -24,12 +24,7 @@ class AtrackHandler(AbstractHandler):
          @return:
         """
         super(AtrackHandler, self).initialization()
-        config = {}
-        if conf.has_section('settings'):
-            section = conf['settings']
-            for key in section.keys():
-                config[key] = section[key]
-        self._packetsFactory = packets.PacketFactory(config)
+        self._packetsFactory = packets.PacketFactory(self.getSettings())
 
     def processProtocolPacket(self, protocolPacket):
         """
@@ -9,6 +9,7 @@ from datetime import datetime
 from struct import *
 import lib.bits as bits
 import lib.crc16 as crc16
+import lib.batch as batch
 from lib.packets import *
 from lib.factory import AbstractPacketFactory
 import re
@@ -207,7 +208,7 @@ class PacketCommandResponse(BinaryPacket):
         """
         data = self.rawData
         # let's work with text data
-        data = data.decode()
+        data = bytes(data).decode()
 
         rc = re.compile(self.re_command, flags = re.IGNORECASE)
         rp = re.compile(self.re_params, flags = re.IGNORECASE)
@@ -302,6 +303,138 @@ class PacketData(BasePacket):
         'SM': ('>H' 'speed_max')
     }
 
+    # layouts of position items by time formats
+    _itemLayouts = {}
+
+    # fields of item time by time formats: unix time or year, month,
+    # day, hour, minute and second
+    _timeFields = {
+        0: ('L', datetime.utcfromtimestamp),
+        1: ('7s', lambda value: datetime(*getStruct('>HBBBBB').unpack(value)))
+    }
+
+    # layout of temperatures, which are read after driver id
+    _layoutTemperature = RecordLayout([
+        ('ext_temperature_0', 'h'),
+        ('ext_temperature_1', 'h')
+    ], '>')
+
+    # layouts of whole items by custom information with lists of their
+    # string fields, which are used by batch decoder
+    _batchLayouts = {}
+
+    @classmethod
+    def getBatchLayout(cls, customInfo = ''):
+        """
+         Returns layout of items, which have empty strings (driver id,
+         message and strings of custom information). Terminators of
+         strings are read as byte fields
+         @param customInfo: Custom information format
+         @return: tuple (RecordLayout, list of string field names) or None
+           if custom information has unsupported fields
+        """
+        if customInfo in cls._batchLayouts:
+            return cls._batchLayouts[customInfo]
+        fields = list(cls.getItemLayout(0).fields)
+        fields.extend([
+            ('driver_id', 'B'),
+            ('ext_temperature_0', 'h'),
+            ('ext_temperature_1', 'h'),
+            ('message', 'B')
+        ])
+        strings = ['driver_id', 'message']
+        result = None
+        for field in customInfo.split('%'):
+            if not field or field not in cls.customInfoTable: continue
+            info = cls.customInfoTable[field]
+            if len(info) != 2: break
+            fmt, alias = info
+            if alias in [item[0] for item in fields]: break
+            if not fmt:
+                fields.append((alias, 'B'))
+                strings.append(alias)
+                continue
+            transform = None
+            if alias in ['can_total_fuel_consumption']:
+                transform = 0.1
+            if alias in ['ext_battery_voltage', 'int_battery_voltage']:
+                transform = 100
+            fields.append((alias, fmt.lstrip('>'), transform))
+        else:
+            result = (RecordLayout(fields, '>'), strings)
+        cls._batchLayouts[customInfo] = result
+        return result
+
+    def getItemsByBatch(self, buffer):
+        """
+         Decodes items at once (see lib.batch).
+         All of items must have empty strings and unix time format
+         @param buffer: Binary data of items
+         @return: list of dicts or None if batch decoding is not available
+        """
+        if self.timeFormat != 0 or not batch.isAvailable():
+            return None
+        batchLayout = self.getBatchLayout(self.customInfo)
+        if batchLayout is None:
+            return None
+        layout, strings = batchLayout
+        if not buffer or len(buffer) % layout.size or \
+                not batch.isAvailable(len(buffer) // layout.size):
+            return None
+        count = len(buffer) // layout.size
+        columns = batch.decode(layout, buffer, count, {
+            'time': batch.toDatetimes,
+            'time_rtc': batch.toDatetimes,
+            'time_send': batch.toDatetimes
+        })
+        # the first item with not empty string has its first character
+        # instead of terminator
+        for name in strings:
+            if columns[name].any():
+                return None
+            columns[name] = [''] * count
+        itemColumns = {}
+        for name in ('time', 'time_rtc', 'time_send', 'longitude', 'latitude',
+                'azimuth', 'report_id', 'odometer', 'hdop', 'speed'):
+            itemColumns[name] = columns.pop(name)
+        dInp = columns.pop('din')
+        dOut = columns.pop('dout')
+        for i in range(0, 8):
+            columns['din%d' % i] = batch.getBit(dInp, i)
+            columns['dout%d' % i] = batch.getBit(dOut, i)
+        items = batch.toRecords(itemColumns)
+        for item, sensor in zip(items, batch.toRecords(columns)):
+            item['sensors'] = sensor
+        return items
+
+    @classmethod
+    def getItemLayout(cls, timeFormat = 0):
+        """
+         Returns layout of the fixed part of position item
+         @param timeFormat: Time format of the item
+         @return: RecordLayout
+        """
+        layout = cls._itemLayouts.get(timeFormat)
+        if layout is None:
+            timeCode, timeTransform = cls._timeFields[timeFormat]
+            layout = RecordLayout([
+                ('time', timeCode, timeTransform),
+                ('time_rtc', timeCode, timeTransform),
+                ('time_send', timeCode, timeTransform),
+                ('longitude', 'l', 0.000001),
+                ('latitude', 'l', 0.000001),
+                ('azimuth', 'H'),
+                ('report_id', 'B'),
+                ('odometer', 'L', 100),
+                ('hdop', 'H', 0.1),
+                ('din', 'B'),
+                ('speed', 'H'),
+                ('dout', 'B'),
+                ('ain0', 'H')
+            ], '>')
+            cls._itemLayouts[timeFormat] = layout
+        return layout
+
     @property
     def unitId(self):
         if self._rebuild: self._build()
@@ -347,38 +480,33 @@ class PacketData(BasePacket):
         self.__sequenceId = seqId
         self.__unitId = str(unitId)
 
+        # archive items of the same layout are decoded at once
+        buffer = self._body[10:]
+        self.__items = self.getItemsByBatch(buffer)
+        if self.__items is not None:
+            return
+
         # store current offset
         savedOffset = self._offset
         self._offset = 0
 
-        buffer = self._body[10:]
+        layout = self.getItemLayout(self.timeFormat)
         self.__items = []
         while self._offset < len(buffer):
-            item = {}
             sensor = {}
-            item['time'] = self.getTimeFromBuffer(buffer)
-            item['time_rtc'] = self.getTimeFromBuffer(buffer)
-            item['time_send'] = self.getTimeFromBuffer(buffer)
-            item['longitude'] = self.readFrom('>l', buffer) / 1000000
-            item['latitude'] = self.readFrom('>l', buffer) / 1000000
-            item['azimuth'] = self.readFrom('>H', buffer)
-            item['report_id'] = self.readFrom('>B', buffer)
-            item['odometer'] = self.readFrom('>L', buffer) * 100
-            item['hdop'] = self.readFrom('>H', buffer) / 10
-            dInp = self.readFrom('>B', buffer)
-            item['speed'] = self.readFrom('>H', buffer)
-            dOut = self.readFrom('>B', buffer)
+            item = self.readLayout(layout, buffer)
+            dInp = item.pop('din')
+            dOut = item.pop('dout')
             # digital inputs and outputs
             for i in range(0, 8):
                 sensor['din%d' % i] = int(bits.bitTest(dInp, i))
                 sensor['dout%d' % i] = int(bits.bitTest(dOut, i))
 
-            sensor['ain0'] = self.readFrom('>H', buffer)
+            sensor['ain0'] = item.pop('ain0')
             sensor['driver_id'] =\
                 buffer[self._offset:].split(b'\x00')[0].decode()
             self._offset += len(sensor['driver_id']) + 1
-            sensor['ext_temperature_0'] = self.readFrom('>h', buffer)
-            sensor['ext_temperature_1'] = self.readFrom('>h', buffer)
+            sensor.update(self.readLayout(self._layoutTemperature, buffer))
             sensor['message'] =\
                 buffer[self._offset:].split(b'\x00')[0].decode()
             self._offset += len(sensor['message']) + 1
@@ -453,6 +581,33 @@ class PacketFactory(AbstractPacketFactory):
      Packet factory
     """
 
+    def getPositionReportPrefix(self):
+        """
+         Returns prefix of position report packets
+         @return: bytes
+        """
+        if 'positionReportPrefix' in self.config:
+            return self.config['positionReportPrefix'].encode()
+        return PacketData.headerPrefix
+
+    def getFrameSize(self, data):
+        """
+         Returns size of the packet at the beginning of data.
+         Text command responses can not be framed by length.
+         @param data: Input binary data
+         @return: int or None
+        """
+        if len(data) < 2:
+            return 2
+        if data[:2] == PacketKeepAlive.headerPrefix:
+            return 12
+        pcd_HeaderPrefix = self.getPositionReportPrefix()
+        if data[:len(pcd_HeaderPrefix)] == pcd_HeaderPrefix:
+            if len(data) < 6:
+                return 6
+            return 6 + unpack('>H', data[4:6])[0]
+        return None
+
     def getInstance(self, data = None):
         """
           Returns a packet instance by its number
@@ -463,9 +618,7 @@ class PacketFactory(AbstractPacketFactory):
         # read prefix
         pka_HeaderPrefix = PacketKeepAlive.headerPrefix
         pcr_HeaderPrefix = PacketCommandResponse.headerPrefix
-        pcd_HeaderPrefix = PacketData.headerPrefix
-        if 'positionReportPrefix' in self.config:
-            pcd_HeaderPrefix = self.config['positionReportPrefix'].encode()
+        pcd_HeaderPrefix = self.getPositionReportPrefix()
         if data[:len(pka_HeaderPrefix)] == pka_HeaderPrefix:
             CLASS = PacketKeepAlive
         elif data[:len(pcr_HeaderPrefix)] == pcr_HeaderPrefix:
@@ -519,6 +672,20 @@ class TestCase(unittest.TestCase):
         self.assertEqual(pka.rawData,
             b'\xfe\x02\x00\x01A\x04\xd8\xdd\x8f(\x00\x16')
 
+    def test_frameSize(self):
+        keepAlive = b'\xfe\x02\x00\x01A\x04\xd8\xdd\x8f(\x00\x01'
+        data = b'@P\x07(\x00U\x00\x04\x00\x01A\x04\xd8\xdd\x8f)Q\x97' + \
+            b'\xd7\x7fQ\x97\xd7\x7fQ\x99\xcb\xc3\x02=B\xd3\x03Sjc\x01' + \
+            b'\x13\x02\x00\x00\x0bP\x00\x0b\x00\x00\x00\x00\x00\x00' + \
+            b'\x00\x00\x00\x00\x00\x00\x06\x00\x82\x0br\x8f\x1ew\x00' + \
+            b'\x00a\xaa\x14\x00\x00\x00\xbd\x00\x00\x08\x00\x00\x00' + \
+            b'\x00\x00\x00\xff\xd8\x00\x00\x00\x00\x00\x00'
+        self.assertEqual(self.factory.getFrameSize(keepAlive), 12)
+        self.assertEqual(self.factory.getFrameSize(data), len(data))
+        self.assertEqual(self.factory.getFrameSize(b'$OK\r\n'), None)
+        self.assertEqual(self.factory.getFramesSize(keepAlive + data[:10]),
+            (12, len(data)))
+
     def test_commandResponse(self):
         packets = self.factory.getPacketsFromBuffer(b'$OK\r\n')
         p = packets[0]
@@ -596,3 +763,22 @@ class TestCase(unittest.TestCase):
         self.assertEqual(p.sequenceId, 4)
         self.assertEqual(p.unitId, '352964050784041')
         self.assertEqual(len(p.items), 1)
+
+    @unittest.skipUnless(batch.isAvailable(), 'numpy is not installed')
+    def test_itemsBatch(self):
+        p = self.factory.getPacketsFromBuffer(
+            b'@P\x07(\x00U\x00\x04\x00\x01A\x04\xd8\xdd\x8f)Q\x97\xd7\x7f' +
+            b'Q\x97\xd7\x7fQ\x99\xcb\xc3\x02=B\xd3\x03Sjc\x01\x13\x02\x00' +
+            b'\x00\x0bP\x00\x0b\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00' +
+            b'\x00\x00\x06\x00\x82\x0br\x8f\x1ew\x00\x00a\xaa\x14\x00\x00' +
+            b'\x00\xbd\x00\x00\x08\x00\x00\x00\x00\x00\x00\xff\xd8\x00\x00' +
+            b'\x00\x00\x00\x00'
+        )[0]
+        item = p.body[10:]
+        count = batch.MIN_RECORDS
+        self.assertIsNone(p.getItemsByBatch(item * (count - 1)))
+        self.assertEqual(p.getItemsByBatch(item * count), p.items * count)
+        # not empty driver id
+        offset = p.getItemLayout(0).size
+        other = item[:offset] + b'A' + item[offset:-1]
+        self.assertIsNone(p.getItemsByBatch(item * (count - 1) + other))
@@ -29,7 +29,8 @@ class AutolinkHandler(AbstractHandler):
         """
         super(AutolinkHandler, self).initialization()
         self._packetsFactory = packets.PacketFactory()
-        self._commandsFactory = commands.CommandFactory()
+        self._commandsFactory = commands.CommandFactory(
+            self.getSettings())
 
     def processProtocolPacket(self, protocolPacket):
         """
@@ -141,15 +141,15 @@ class Package(AutolinkPacket):
         """
         # It is sad that we don't know the length
         # of the packet, so let's determine it by parsing packets
-        buffer = self._rawData[2:]
+        cursor = BufferCursor(self._rawData)
+        cursor.skip(2)
         self.__packets = []
-        self._length = 1
         while True:
-            packet = Packet(buffer)
-            buffer = packet.rawDataTail
+            packet = Packet(cursor.tail())
+            cursor.skipPacket(packet)
             self.__packets.append(packet)
-            self._length += len(packet.rawData) # increase package length
-            if not buffer or (buffer[:1] == b'\x5d'): break
+            if not cursor or (cursor.peek(1) == b'\x5d'): break
+        self._length = cursor.offset - 1 # sequence number and packets
 
     @property
     def sequenceNum(self):
@@ -337,7 +337,7 @@ class PacketFactory(AbstractPacketFactory):
         if data is None: return
 
         # read packetId
-        packetPrefix = data[:1]
+        packetPrefix = bytes(data[:1])
 
         CLASS = self.getClass(packetPrefix)
         if not CLASS:
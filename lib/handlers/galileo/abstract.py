@@ -33,7 +33,8 @@ class GalileoHandler(AbstractHandler):
         """
         super(GalileoHandler, self).initialization()
         self._packetsFactory = packets.PacketFactory()
-        self._commandsFactory = commands.CommandFactory()
+        self._commandsFactory = commands.CommandFactory(
+            self.getSettings())
 
     def needCommandProcessing(self):
         """
@@ -280,6 +281,60 @@ class TestCase(unittest.TestCase):
         for packet in protocolPackets:
             self.assertEqual(packet.header, 1)
 
+    def test_processDataByChunks(self):
+        data = b'\x01\x17\x80\x01\n\x02w\x03868204000728070\x042\x00' + \
+               b'\x84\x90\x01"\x00\x03868204000728070\x042\x00\xe0' + \
+               b'\x01\x00\x00\x00\xe1\x08Photo ok\x13\xf6'
+        received = []
+        self.handler.processProtocolPacket = received.append
+        self.handler.processData(data[:2])
+        self.handler.processData(data[2:30])
+        self.assertEqual(len(received), 1)
+        self.assertIsInstance(received[0].rawData, bytes)
+        self.handler.processData(data[30:40])
+        self.assertEqual(len(received), 1)
+        self.assertEqual(self.handler._frameSize, 39)
+        self.handler.processData(data[40:])
+        self.assertEqual(len(received), 2)
+        self.assertEqual(received[1].getTag(0xe1).getValue(), 'Photo ok')
+        self.assertEqual(len(self.handler.getBuffer()), 0)
+
+    def test_malformedFrame(self):
+        from kernel.utils import NeedMoreDataException
+        data = b'\x01\x17\x80\x01\n\x02w\x03868204000728070\x042\x00' + \
+               b'\x84\x90'
+        received = []
+        handler = self.handler
+        handler.processProtocolPacket = received.append
+        def getPacketsFromBuffer(data):
+            raise NeedMoreDataException('Not enough data in buffer')
+        handler._packetsFactory.getPacketsFromBuffer = getPacketsFromBuffer
+        handler.processData(data)
+        # complete frame, which can not be parsed, is dropped
+        self.assertEqual(len(handler.getBuffer()), 0)
+        del handler._packetsFactory.getPacketsFromBuffer
+        handler.processData(data)
+        self.assertEqual(len(received), 1)
+
+    def test_dispatch(self):
+        import socket
+        import kernel.pipe as pipe
+        class ClientThread:
+            request = None
+        left, right = socket.socketpair()
+        thread = ClientThread()
+        thread.request = right
+        handler = GalileoHandler(pipe.TestManager(), thread)
+        received = []
+        handler.processProtocolPacket = received.append
+        left.sendall(b'\x01\x17\x80\x01\n\x02w\x03868204000728070' +
+            b'\x042\x00\x84\x90')
+        left.close()
+        handler.dispatch()
+        right.close()
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0].crc, 36996)
+
     def test_packetNewTracker(self):
         data = b'\x01\xaa\x03\x03868204001578425\x042\x00\x10\xe7\x04 ' + \
                b'$\x17\x11Q0\x10\x00\x00\x00\x00\x00\x00\x00\x003\x00' + \
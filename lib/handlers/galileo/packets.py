@@ -11,6 +11,7 @@ import lib.crc16 as crc16
 import lib.handlers.galileo.tags as tags
 
 from kernel.utils import NeedMoreDataException
+from lib.packets import iterPacketsFromBuffer
 from lib.factory import AbstractPacketFactory
 
 # ---------------------------------------------------------------------------
@@ -37,13 +38,7 @@ class BasePacket(object):
          @param data: Input binary data
          @return array of BasePacket instances (empty array if no packet)
         """
-        packets = []
-        while True:
-            packet = cls(data)
-            data = packet.rawDataTail
-            packets.append(packet)
-            if len(data) == 0: break
-        return packets
+        return list(iterPacketsFromBuffer(cls, data))
 
     def __init__(self, data = None):
         """
@@ -129,28 +124,33 @@ class BasePacket(object):
 
         # read header and length
         archive = False
+        if len(buffer) < 3:
+            raise NeedMoreDataException('Not enough data in buffer')
         header, length = unpack("<BH", buffer[:3])
         if self.isHalved(header):
             archive = bits.bitTest(length, 15)
             length = bits.bitClear(length, 15)
 
-        if length > len(buffer) + 5:
+        if length + 5 > len(buffer):
             raise NeedMoreDataException('Not enough data in buffer')
 
-        crc = unpack("<H", buffer[length + 3:length + 5])[0]
-        crc_data = buffer[:length + 3]
+        # the packet is copied from the buffer (it can be a memoryview
+        # of the receive buffer), the tail is not copied
+        rawData = bytes(buffer[:length + 5])
+        crc = unpack("<H", rawData[length + 3:length + 5])[0]
+        crc_data = memoryview(rawData)[:length + 3]
         if not self.isCorrectCrc(crc_data, crc):
             raise Exception('Crc Is incorrect!')
 
         # now let's read packet data
         # but before this, check tagsdata length
-        body = buffer[3:length + 3]
+        body = rawData[3:length + 3]
         if len(body) != length:
             raise Exception('Body length Is incorrect!')
 
         # apply new data
         self.__rawDataTail = buffer[length + 5:]
-        self.__rawData = buffer[:length + 5]
+        self.__rawData = rawData
         self.__archive = archive
         self.__header = header
         self.__length = length
@@ -318,7 +318,20 @@ class Packet(BasePacket):
         return self
 
 class PacketFactory(AbstractPacketFactory):
-    
+
+    def getFrameSize(self, data):
+        """
+         Returns size of the packet at the beginning of data
+         @param data: Input binary data
+         @return: int
+        """
+        if len(data) < 3:
+            return 3
+        header, length = unpack("<BH", data[:3])
+        if Packet.isHalved(None, header):
+            length = bits.bitClear(length, 15)
+        return length + 5
+
     def getInstance(self, data = None):
         if data == None: return
         return Packet(data)
@@ -374,6 +387,17 @@ class TestCase(unittest.TestCase):
         self.assertEqual(packet.hasTag(0xe2), False)
         self.assertEqual(packet.getTag(0xe1).getValue(), 'Photo ok')
 
+    def test_frameSize(self):
+        factory = PacketFactory()
+        data = b'\x01\x17\x80\x01\n\x02w\x03868204000728070\x042\x00' + \
+            b'\x84\x90\x0F\x02\x00\x00\x00\x71\xB9'
+        self.assertEqual(factory.getFrameSize(data[:1]), 3)
+        self.assertEqual(factory.getFrameSize(data), 28)
+        self.assertEqual(factory.getFrameSize(data[28:]), 7)
+        self.assertEqual(factory.getFramesSize(data[:30]), (28, 3))
+        self.assertEqual(factory.getFramesSize(data[:32]), (28, 7))
+        self.assertEqual(factory.getFramesSize(data), (35, 0))
+
     def test_packetTail(self):
         packets = Packet.getPacketsFromBuffer(
           b'\x01\x17\x80\x01\n\x02w\x03868204000728070\x042\x00\x84\x90' +
@@ -13,19 +13,26 @@ import lib.bits as bits
 
 # ---------------------------------------------------------------------------
 
-class Tag(object):
+class TagType(type):
+    """
+     Metaclass of tags.
+     Tags keep their state in slots of the Tag class, so tag classes
+     get empty __slots__ unless they declare their own
+    """
+
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault('__slots__', ())
+        return super(TagType, mcs).__new__(mcs, name, bases, namespace)
+
+class Tag(object, metaclass = TagType):
     """
      Default galileo protocol tag
     """
+    __slots__ = ('__rawdata', '__value', '__convert')
 
     # protected
     _rawdatalength = 0
 
-    # private
-    __rawdata = None
-    __value = None
-    __convert = True
-
     @classmethod
     def getNumber(cls):
         """
@@ -72,6 +79,8 @@ class Tag(object):
         """
          Constructor
         """
+        self.__value = None
+        self.__convert = True
         if isinstance(data, bytes):
             self.setRawData(data)
         else:
@@ -1239,6 +1248,7 @@ class TestCase(unittest.TestCase):
     def test_tag4(self):
         tag = Tag.getInstance(4, b'\x03\x04')
         self.assertEqual(tag.getValue(), 1027)
+        self.assertFalse(hasattr(tag, '__dict__'))
 
     def test_tag32(self):
         tag = Tag.getInstance(32, b'\x13\x04\xAF\x4F') # 2012-05-13 00:45:07
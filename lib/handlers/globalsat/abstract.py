@@ -94,9 +94,9 @@ class GlobalsatHandler(AbstractHandler):
          @return:
         """
         super(GlobalsatHandler, self).initialization()
-        self._commandsFactory = CommandFactory()
+        self._commandsFactory = CommandFactory(self.getSettings())
         self.reportFormat = truncateChecksum(
-            conf.get('settings', "reportFormat"))
+            self.getConfigOption("reportFormat"))
         self.__compileRegularExpressions()
 
     def __compileRegularExpressions(self):
@@ -23,11 +23,11 @@ class GloblasatCommandConfigure(AbstractCommandConfigure):
          @param config: request data
          @return: string
         """
-        initialConfig = conf.get('settings', 'initialConfig')
+        initialConfig = self.getConfigOption('initialConfig')
         if initialConfig:
             initialConfig = ',' + initialConfig
         ret = "GSS,{0},3,0".format(config['identifier'])
-        ret += ',O3=' + conf.get('settings', 'reportFormat')
+        ret += ',O3=' + self.getConfigOption('reportFormat')
         ret += initialConfig
         ret += ',D1=' + str(config['gprs']['apn'] or '')
         ret += ',D2=' + str(config['gprs']['username'] or '')
@@ -59,7 +59,7 @@ class Handler(AbstractHandler):
          Initialization of the handler
          @return:
         """
-        self._commandsFactory = CommandFactory()
+        self._commandsFactory = CommandFactory(self.getSettings())
         self.__compileRegularExpressions()
 
     def __getRegularExpression(self, expression, patterns):
@@ -25,7 +25,8 @@ class ImeHandler(AbstractHandler):
         """
         super(ImeHandler, self).initialization()
         self._packetsFactory = packets.PacketFactory()
-        self._commandsFactory = commands.CommandFactory()
+        self._commandsFactory = commands.CommandFactory(
+            self.getSettings())
 
     def processProtocolPacket(self, protocolPacket):
         """
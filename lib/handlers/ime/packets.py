@@ -286,6 +286,19 @@ class PacketFactory(AbstractPacketFactory):
     """
      Packet factory
     """
+    def getFrameSize(self, data):
+        """
+         Returns size of the packet at the beginning of data.
+         Length of the packet includes its prefix, length and checksum.
+         @param data: Input binary data
+         @return: int or None
+        """
+        if len(data) < 4:
+            return 4
+        if data[:2] != b'$$':
+            return None
+        return unpack('>H', data[2:4])[0]
+
     def getInstance(self, data = None):
         """
           Returns a tag instance by its number
@@ -293,7 +306,8 @@ class PacketFactory(AbstractPacketFactory):
         if data is None: return
 
         # read packetId
-        data = data[data.find(b'$$'):]
+        if data[:2] != b'$$':
+            data = data[bytes(data).find(b'$$'):]
 
         if not data:
             raise Exception('Packet is not found')
@@ -329,6 +343,14 @@ class TestCase(unittest.TestCase):
         self.assertEqual(packet.deviceImei, '13612345678')
         self.assertEqual(packet.command, CMD_LOGIN)
 
+    def test_frameSize(self):
+        data = b'\x24\x24\x00\x11\x13\x61\x23\x45\x67\x8f' + \
+            b'\xff\x50\x00\x05\xd8\x0d\x0a'
+        self.assertEqual(self.factory.getFrameSize(data[:3]), 4)
+        self.assertEqual(self.factory.getFrameSize(data), 17)
+        self.assertEqual(self.factory.getFramesSize(data + data[:5]),
+            (17, 17))
+
     def test_checkDataPacket(self):
         packets = self.factory.getPacketsFromBuffer(
             b'\x24\x24\x00\x60\x12\x34\x56\xFF\xFF\xFF\xFF\x99'
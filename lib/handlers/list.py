@@ -5,22 +5,112 @@
 @copyright 2009-2016, Maprox LLC
 """
 
+import os
+import glob
+from configparser import ConfigParser
+
 from kernel.logger import log
 from kernel.config import conf
 
-# Load modules
-HandlerClass = None
-handlerName = conf.handler
-if handlerName:
+# directory with protocol handlers configuration files
+HANDLERS_CONF_PATH = 'conf/handlers'
+
+
+def loadHandlerClass(handlerName):
+    """
+     Returns protocol handler class by its name
+     @param handlerName: Protocol handler name, e.g. "galileo.default"
+     @return: Handler class or None if it can not be loaded
+    """
     handlerClassPath = "lib.handlers." + handlerName
     try:
         pkg = __import__(handlerClassPath, globals(), locals(), ['Handler'])
         if (hasattr(pkg, 'Handler')):
-            HandlerClass = getattr(pkg, 'Handler')
-            HandlerClass.initAmqpThread(handlerName)
-            log.info("Protocol is loaded: " + HandlerClass.__doc__)
-        else:
-            log.error("Class 'Handler' in not found in module %s",
-                handlerClassPath)
+            return getattr(pkg, 'Handler')
+        log.error("Class 'Handler' in not found in module %s",
+            handlerClassPath)
     except Exception as E:
         log.error("Protocol '%s' loading error: %s", handlerClassPath, E)
+    return None
+
+
+def loadListeners(path = HANDLERS_CONF_PATH):
+    """
+     Reads all protocol handlers configuration files from the path
+     and loads their handler classes.
+     Each listener gets its own handler class with settings
+     of its configuration file.
+     @param path: Directory with *.conf files
+     @return: list of (port, handlerName, handlerClass) tuples
+    """
+    listeners = []
+    ports = {}
+    for fileName in sorted(glob.glob(os.path.join(path, '*.conf'))):
+        handlerConf = ConfigParser()
+        handlerConf.optionxform = str
+        try:
+            handlerConf.read(fileName)
+            port = handlerConf.getint('general', 'port')
+            settings = {}
+            if handlerConf.has_section('settings'):
+                settings.update(handlerConf['settings'])
+        except Exception as E:
+            log.error("Error reading %s: %s", fileName, E)
+            continue
+        handlerName = settings.get('handler') or \
+            os.path.basename(fileName)[:-len('.conf')]
+        if port in ports:
+            log.error("Port %s of '%s' is already used by '%s'",
+                port, handlerName, ports[port])
+            continue
+        baseClass = loadHandlerClass(handlerName)
+        if not baseClass:
+            continue
+        settings['handler'] = handlerName
+        settings['port'] = port
+        handlerClass = type(baseClass.__name__, (baseClass,), {
+            '__doc__': baseClass.__doc__,
+            '__module__': baseClass.__module__,
+            '_alias': handlerName,
+            '_settings': settings
+        })
+        ports[port] = handlerName
+        listeners.append((port, handlerName, handlerClass))
+        log.info("Protocol is loaded: %s (port %s)", handlerName, port)
+    return listeners
+
+
+# Load modules
+# (AMQP threads are started by kernel.starter.Starter, after workers fork)
+HandlerClass = None
+handlerName = conf.handler
+if handlerName and not conf.allHandlers:
+    HandlerClass = loadHandlerClass(handlerName)
+    if HandlerClass:
+        log.info("Protocol is loaded: " + HandlerClass.__doc__)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestCase(unittest.TestCase):
+
+    def test_loadListeners(self):
+        listeners = loadListeners()
+        names = [name for port, name, handlerClass in listeners]
+        self.assertIn('galileo.default', names)
+        self.assertIn('atrack.ax5', names)
+        ports = [port for port, name, handlerClass in listeners]
+        self.assertEqual(len(ports), len(set(ports)))
+        for port, name, handlerClass in listeners:
+            self.assertEqual(handlerClass._settings['port'], port)
+            self.assertEqual(handlerClass.getSettings()['handler'], name)
+        # classes of different listeners do not share settings
+        classes = dict((name, cls) for port, name, cls in listeners)
+        self.assertEqual(
+            classes['globalsat.tr203'].getSettings()['reportFormat'],
+            'SPRAB27GHKLMNO*U!')
+        self.assertNotIn('reportFormat',
+            classes['galileo.default'].getSettings())
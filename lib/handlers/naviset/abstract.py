@@ -32,11 +32,14 @@ class NavisetHandler(AbstractHandler):
         """
         super(NavisetHandler, self).initialization()
         self._packetsFactory = packets.PacketFactory()
-        self._commandsFactory = commands.CommandFactory()
+        self._commandsFactory = commands.CommandFactory(
+            self.getSettings())
 
     def processProtocolPacket(self, protocolPacket):
         """
          Process naviset packet.
+         Packet is acknowledged by its checksum, records are decoded
+         after that by translate()
          @type protocolPacket: packets.Packet
          @param protocolPacket: Naviset protocol packet
         """
@@ -155,11 +158,11 @@ class NavisetHandler(AbstractHandler):
         if (protocolPacket == None): return packetsList
         if not isinstance(protocolPacket, packets.PacketData):
             return packetsList
-        if (len(protocolPacket.items) == 0):
+        if protocolPacket.itemsCount == 0:
             return packetsList
-        for item in protocolPacket.items:
+        for params in protocolPacket.itemsParams:
             packet = {'uid': self.uid}
-            packet.update(item.params)
+            packet.update(params)
             packet['time'] = packet['time'].strftime('%Y-%m-%dT%H:%M:%S.%f')
             # sensors
             sensor = packet['sensors'] or {}
@@ -9,6 +9,7 @@ from datetime import datetime
 from struct import unpack, pack
 import lib.bits as bits
 import lib.crc16 as crc16
+import lib.batch as batch
 from lib.packets import *   
 from lib.factory import AbstractPacketFactory
 
@@ -180,10 +181,7 @@ class PacketData(PacketNumbered):
         super(PacketData, self)._parseBody()
         self.__dataStructure = unpack('<H', self._body[2:4])[0]
         self.__itemsData = self._body[4:]
-        self.__items = PacketDataItem.getDataItemsFromBuffer(
-            self.__itemsData,
-            self.__dataStructure
-        )
+        self.__items = None
 
     def _buildBody(self):
         """
@@ -196,21 +194,86 @@ class PacketData(PacketNumbered):
 
     @property
     def items(self):
+        """
+         Items are decoded on first access, so the packet is acknowledged
+         by its checksum before records are decoded
+        """
+        if self.__items is None:
+            self.__items = PacketDataItem.getDataItemsFromBuffer(
+                self.__itemsData,
+                self.__dataStructure
+            )
         return self.__items
 
+    @property
+    def itemsCount(self):
+        return len(self.__itemsData or b'') // \
+            PacketDataItem.getLength(self.__dataStructure)
+
+    @property
+    def itemsParams(self):
+        """
+         Returns params of items.
+         Archive packets are decoded by batch if numpy is available
+         @return: list of dicts
+        """
+        if self.__items is None:
+            params = PacketDataItem.getParamsByBatch(
+                self.__itemsData, self.__dataStructure)
+            if params is not None:
+                return params
+        return [item.params for item in self.items]
+
 # ---------------------------------------------------------------------------
 
 class PacketDataItem:
     """
-      Item of data packet of naviset messaging protocol
+      Item of data packet of naviset messaging protocol.
+      Items are created for every record of archive packets, so their
+      state is kept in slots
     """
-    # private properties
-    __rawData = None
-    __rawDataTail = None
-    __dataStructure = 0
-    __number = 0
-    __params = None
-    __additional = None
+    __slots__ = ('__rawData', '__rawDataTail', '__dataStructure',
+        '__number', '__params', '__additional')
+
+    # layout of the head of the item
+    __layoutHead = RecordLayout([
+        ('number', 'H'),
+        ('time', 'L', datetime.utcfromtimestamp),
+        ('satellitescount', 'B'),
+        ('latitude', 'L', convertCoordinate),
+        ('longitude', 'L', convertCoordinate),
+        ('speed', 'H', 0.1),
+        ('azimuth', 'H', lambda value: int(round(value / 10))),
+        ('altitude', 'H'),
+        ('hdop', 'B', 0.1)
+    ])
+
+    # layouts of head and additional data by data structures,
+    # which are used by batch decoder
+    __batchLayouts = {}
+
+    # fields of additional data
+    __dsFields = {
+        0: [('status', 'B')],
+        1: [('ext_battery_voltage', 'H'), ('int_battery_voltage', 'H')],
+        2: [('int_temperature', 'b')],
+        3: [('din', 'B'), ('dout', 'B')],
+        4: [('ain0', 'H'), ('ain1', 'H')],
+        5: [('ain2', 'H'), ('ain3', 'H')],
+        6: [('ain4', 'H'), ('ain5', 'H')],
+        7: [('ain6', 'H'), ('ain7', 'H')],
+        8: [('ext_temperature_%d' % i, 'b') for i in range(0, 4)],
+        9: [('ext_temperature_%d' % i, 'b') for i in range(4, 8)],
+        10: [('ibutton_low', 'H'), ('ibutton_high', 'I')],
+        11: [('fin0', 'H'), ('fin1', 'H')],
+        12: [('omnicomm_fuel_0', 'H'), ('omnicomm_fuel_1', 'H')],
+        13: [('omnicomm_temperature_0', 'b'),
+             ('omnicomm_temperature_1', 'b')],
+        14: [('can_fuel', 'B'), ('can_rpm', 'H'),
+             ('can_coolant_temperature', 'b')],
+        15: [('can_total_fuel_consumption', 'L', 0.5),
+             ('can_total_mileage', 'L', 5)]
+    }
 
     # additional data sizes map
     __dsMap = {
@@ -241,8 +304,11 @@ class PacketDataItem:
         """
         super(PacketDataItem, self).__init__()
         self.__rawData = data
+        self.__rawDataTail = None
         self.__dataStructure = ds
+        self.__number = 0
         self.__params = {}
+        self.__additional = None
         self.__parse()
 
     @classmethod
@@ -263,6 +329,94 @@ class PacketDataItem:
                 size += cls.__dsMap[key]
         return size
 
+    @classmethod
+    def getLength(cls, ds = None):
+        """
+         Returns length of the item
+         @param ds: Data structure definition (2 byte)
+         @return: Size of the item in bytes
+        """
+        return cls.__layoutHead.size + cls.getAdditionalDataLength(ds)
+
+    @classmethod
+    def getBatchLayout(cls, ds = None):
+        """
+         Returns layout of the whole item
+         @param ds: Data structure definition (2 byte)
+         @return: RecordLayout
+        """
+        layout = cls.__batchLayouts.get(ds)
+        if layout is None:
+            fields = list(cls.__layoutHead.fields)
+            for key in range(0, 16):
+                if bits.bitTest(ds or 0, key):
+                    fields.extend(cls.__dsFields[key])
+            layout = RecordLayout(fields)
+            cls.__batchLayouts[ds] = layout
+        return layout
+
+    @classmethod
+    def getParamsByBatch(cls, data, ds = None):
+        """
+         Decodes params of items at once (see lib.batch)
+         @param data: Input binary data
+         @param ds: Data structure definition (2 byte)
+         @return: list of dicts or None if batch decoding is not available
+        """
+        layout = cls.getBatchLayout(ds)
+        if not data or len(data) % layout.size or \
+                not batch.isAvailable(len(data) // layout.size):
+            return None
+        columns = batch.decode(layout, data, transforms = {
+            'time': batch.toDatetimes,
+            'latitude': batch.convertCoordinates,
+            'longitude': batch.convertCoordinates,
+            'azimuth': lambda values: batch.numpy.round(values / 10).astype(
+                batch.numpy.int64)
+        })
+        del columns['number']
+        params = {}
+        for name in ('time', 'satellitescount', 'latitude', 'longitude',
+                'speed', 'azimuth', 'altitude', 'hdop'):
+            params[name] = columns.pop(name)
+
+        # additional data (see parseAdditionalData)
+        sensors = columns
+        if 'status' in sensors:
+            status = sensors.pop('status')
+            statusBits = ['bad_ext_voltage', 'moving', 'armed',
+                'gsm_sim_card_1_enabled', 'gsm_sim_card_2_enabled',
+                'gsm_no_gprs_connection']
+            for bit, name in enumerate(statusBits):
+                sensors[name] = batch.getBit(status, bit)
+            sensors['sat_antenna_connected'] = 1 - batch.getBit(status, 6)
+        for name in ('din', 'dout'):
+            if name in sensors:
+                values = sensors.pop(name)
+                for i in range(0, 8):
+                    sensors['%s%d' % (name, i)] = batch.getBit(values, i)
+        if 'ibutton_low' in sensors:
+            sensors['ibutton_0'] = sensors.pop('ibutton_low') | \
+                (sensors.pop('ibutton_high') << 16)
+        if 'can_fuel' in sensors:
+            sensors['can_fuel_percent'] = batch.numpy.minimum(
+                sensors.pop('can_fuel') * 0.4, 100)
+        # missing temperature sensors are not set
+        temperatures = [name for name in sensors
+            if name.startswith('ext_temperature_')]
+        absent = dict((name, (sensors[name] <= -100).tolist())
+            for name in temperatures)
+
+        result = batch.toRecords(params)
+        sensorsList = batch.toRecords(sensors) if sensors \
+            else [{} for item in result]
+        for index, sensor in enumerate(sensorsList):
+            for name in temperatures:
+                if absent[name][index]:
+                    del sensor[name]
+            result[index]['sensors'] = sensor
+        return result
+
     @classmethod
     def getDataItemsFromBuffer(cls, data = None, ds = None):
         """
@@ -270,13 +424,7 @@ class PacketDataItem:
          @param data: Input binary data
          @return: array of PacketDataItem instances (empty array if not found)
         """
-        items = []
-        while True:
-            item = cls(data, ds)
-            data = item.rawDataTail
-            items.append(item)
-            if data is None or len(data) == 0: break
-        return items
+        return list(iterPacketsFromBuffer(lambda tail: cls(tail, ds), data))
 
     @classmethod
     def parseProtocolStatus(cls, status):
@@ -364,9 +512,7 @@ class PacketDataItem:
         return sensors
 
     def convertCoordinate(self, coord):
-        result = str(coord)
-        result = result[:2] + '.' + result[2:]
-        return float(result)
+        return convertCoordinate(coord)
 
     def __parse(self):
         """
@@ -379,29 +525,18 @@ class PacketDataItem:
         if buffer is None: return
         if len(buffer) < length: return
 
-        self.__number = unpack("<H", buffer[:2])[0]
-        self.__params['time'] = datetime.utcfromtimestamp(
-            unpack("<L", buffer[2:6])[0]) #- timedelta(hours=4)
-        self.__params['satellitescount'] = unpack("<B", buffer[6:7])[0]
-        self.__params['latitude'] = self.convertCoordinate(
-            unpack("<L", buffer[7:11])[0])
-        self.__params['longitude'] = self.convertCoordinate(
-            unpack("<L", buffer[11:15])[0])
-        self.__params['speed'] = unpack("<H", buffer[15:17])[0] / 10
-        self.__params['azimuth'] = int(round(
-            unpack("<H", buffer[17:19])[0] / 10))
-        self.__params['altitude'] = unpack("<H", buffer[19:21])[0]
-        self.__params['hdop'] = unpack("<B", buffer[21:22])[0] / 10
-        self.__additional = buffer[22:length]
+        self.__params = self.__layoutHead.unpack(buffer)
+        self.__number = self.__params.pop('number')
+        self.__additional = bytes(buffer[22:length])
         self.__params['sensors'] = self.parseAdditionalData()
 
         # apply new data
         self.__rawDataTail = buffer[length:]
-        self.__rawData = buffer[:length]
+        self.__rawData = bytes(buffer[:length])
 
     @property
     def length(self):
-        return 22 + self.getAdditionalDataLength(self.__dataStructure)
+        return self.getLength(self.__dataStructure)
 
     @property
     def rawData(self):
@@ -1118,6 +1253,19 @@ class PacketFactory(AbstractPacketFactory):
             return None
         return classes[number]
 
+    def getFrameSize(self, data):
+        """
+         Returns size of the packet at the beginning of data
+         @param data: Input binary data
+         @return: int
+        """
+        if len(data) < 2:
+            return 2
+        length = unpack("<H", data[:2])[0]
+        length = bits.bitClear(length, 15)
+        length = bits.bitClear(length, 14)
+        return 2 + length + calcsize(NavisetBase._fmtChecksum)
+
     def getInstance(self, data = None):
         """
           Returns a tag instance by its number
@@ -1191,6 +1339,14 @@ class TestCase(unittest.TestCase):
             b'\x12\x00\x22\x00012896001609129\x05$6')
         self.assertEqual(packet.checksum, 13860)
 
+    def test_frameSize(self):
+        data = b'\x12\x00\x01\x00012896001609129\x06\x9f\xb9' + \
+            b'\x12\x00\x22\x00012896001609129\x05$6'
+        self.assertEqual(self.factory.getFrameSize(data[:1]), 2)
+        self.assertEqual(self.factory.getFrameSize(data), 22)
+        self.assertEqual(self.factory.getFramesSize(data[:30]), (22, 22))
+        self.assertEqual(self.factory.getFramesSize(data), (44, 0))
+
     def test_packetTail(self):
         packets = self.factory.getPacketsFromBuffer(
             b'\x12\x00\x01\x00012896001609129\x06\x9f\xb9' +
@@ -1268,6 +1424,9 @@ class TestCase(unittest.TestCase):
         self.assertEqual(len(packets), 1)
         packet = packets[0]
         self.assertEqual(isinstance(packet, PacketData), True)
+        # items are decoded on first access
+        self.assertIsNone(packet._PacketData__items)
+        self.assertEqual(packet.itemsCount, 12)
         self.assertEqual(len(packet.items), 12)
         packetItem = packet.items[3]
         self.assertEqual(isinstance(packetItem, PacketDataItem), True)
@@ -1287,6 +1446,20 @@ class TestCase(unittest.TestCase):
         self.assertEqual(
             packetItem2.params['sensors']['sat_antenna_connected'], 1)
 
+    @unittest.skipIf(not batch.isAvailable(), 'numpy is not installed')
+    def test_itemsBatch(self):
+        import random
+        generator = random.Random(1)
+        for ds in (0, 0x0003, 0xFFFF):
+            length = PacketDataItem.getLength(ds)
+            data = bytes(generator.getrandbits(8)
+                for i in range(length * batch.MIN_RECORDS))
+            items = PacketDataItem.getDataItemsFromBuffer(data, ds)
+            self.assertEqual(PacketDataItem.getParamsByBatch(data, ds),
+                [item.params for item in items])
+        self.assertIsNone(PacketDataItem.getParamsByBatch(data[:length], ds))
+        self.assertIsNone(PacketDataItem.getParamsByBatch(data[1:], ds))
+
     def test_commandAnswerGetImage(self):
         data = b'\x05\x80\x14\x00\xb1\x46\x00\x03\x84'
         packets = self.factory.getPacketsFromBuffer(data)
@@ -21,6 +21,7 @@ class TeltonikaHandler(AbstractHandler):
      Base handler for Teltonika FMXXXXX protocol
     """
     __headPacketRawData = None # private buffer for headPacket data
+    _configuration = None # sent configuration and packet waiting for answer
 
     def initialization(self):
         """
@@ -29,11 +30,14 @@ class TeltonikaHandler(AbstractHandler):
         """
         super(TeltonikaHandler, self).initialization()
         self._packetsFactory = packets.PacketFactory()
-        self._commandsFactory = commands.CommandFactory()
+        self._commandsFactory = commands.CommandFactory(
+            self.getSettings())
 
     def processProtocolPacket(self, protocolPacket):
         """
          Process teltonika packet.
+         Packet is acknowledged by its items count, records are decoded
+         after that by translate()
          @type protocolPacket: packets.Packet
          @param protocolPacket: Teltonika protocol packet
         """
@@ -49,9 +53,17 @@ class TeltonikaHandler(AbstractHandler):
             return log.error('HeadPack is not found!')
 
         # try to configure this tracker
-        if self.configure():
+        if self.configure(protocolPacket):
             return
 
+        self.processReceivedPacket(protocolPacket)
+
+    def processReceivedPacket(self, protocolPacket):
+        """
+         Acknowledges and stores teltonika packet
+         @type protocolPacket: packets.Packet
+         @param protocolPacket: Teltonika protocol packet
+        """
         # sends the acknowledgment
         self.sendAcknowledgement(protocolPacket)
 
@@ -66,22 +78,42 @@ class TeltonikaHandler(AbstractHandler):
         log.info(observerPackets)
         self.store(observerPackets)
 
-    def configure(self):
+    def configure(self, protocolPacket):
+        """
+         Sends configuration of the tracker if there is one.
+         The answer is not waited for here (it would block the worker
+         of the asyncio server), it is checked by processBuffer when it
+         is received, and the packet is processed after that
+         @param protocolPacket: Teltonika protocol packet
+         @return: True if configuration is sent
+        """
         current_db = db.get(self.uid)
         if not current_db.has('config'):
             return False
         data = current_db.get('config')
         self.send(data)
         log.debug('Configuration data sent = %s', data)
-        config = packets.TeltonikaConfiguration(data)
-        answer = b''
-        try:
-            log.debug('Waiting for the answer from device...')
-            answer = self.recv()
-        except Exception as E:
-            log.error(E)
+        self._configuration = (
+            packets.TeltonikaConfiguration(data), protocolPacket)
         current_db.remove('config')
-        return config.isCorrectAnswer(answer)
+        log.debug('Waiting for the answer from device...')
+        return True
+
+    def processBuffer(self):
+        """
+         Checks the answer for sent configuration before parsing packets
+        """
+        if not self._configuration:
+            return super(TeltonikaHandler, self).processBuffer()
+        config, protocolPacket = self._configuration
+        self._configuration = None
+        answer = self.getBuffer().read()
+        if config.isCorrectAnswer(answer):
+            log.info('[%s] Configuration is accepted', self.handlerId)
+            return self
+        log.error('[%s] Incorrect configuration answer', self.handlerId)
+        self.processReceivedPacket(protocolPacket)
+        return self
 
     def receiveImage(self, packet):
         """
@@ -100,11 +132,11 @@ class TeltonikaHandler(AbstractHandler):
         if protocolPacket == None: return packetsList
         if not isinstance(protocolPacket, packets.PacketData):
             return packetsList
-        if (len(protocolPacket.AvlDataArray.items) == 0):
+        if protocolPacket.AvlDataArray.itemsCount == 0:
             return packetsList
-        for item in protocolPacket.AvlDataArray.items:
+        for params in protocolPacket.AvlDataArray.itemsParams:
             packet = {'uid': self.uid}
-            packet.update(item.params)
+            packet.update(params)
             packet['time'] = packet['time'].strftime('%Y-%m-%dT%H:%M:%S.%f')
             if not 'hdop' in packet:
                 packet['hdop'] = 1 # temporarily manual value of hdop
@@ -136,7 +168,7 @@ class TeltonikaHandler(AbstractHandler):
         if isinstance(packet, packets.PacketHead):
             return b'\x01'
         else:
-            return pack('>L', len(packet.AvlDataArray.items))
+            return pack('>L', packet.AvlDataArray.itemsCount)
 
     @classmethod
     def packString(cls, value):
@@ -159,6 +191,44 @@ class TestCase(unittest.TestCase):
         self.handler = TeltonikaHandler(pipe.TestManager(), None)
         pass
 
+    def test_configure(self):
+        global db
+        sent = []
+        class Storage:
+            config = {'config': b'\x00\x15\x0F\x00\x02\x00\x0c\x00\x06' +
+                b'SAMPLE\x04\x00\x00\x041024'}
+            def has(self, key): return key in self.config
+            def get(self, key): return self.config[key]
+            def remove(self, key): self.config.pop(key)
+        class Database:
+            def get(self, uid): return Storage()
+        h = self.handler
+        h.send = lambda data: sent.append(data)
+        processed = []
+        h.processReceivedPacket = processed.append
+        database = db
+        try:
+            db = Database()
+            h.uid = '012896001609129'
+            packet = h._packetsFactory.getInstance(b'\x00\x0f012896001609129')
+            # configuration is sent without waiting for the answer
+            self.assertTrue(h.configure(packet))
+            self.assertEqual(len(sent), 1)
+            self.assertFalse(h.configure(packet))
+        finally:
+            db = database
+        # the answer is checked when it is received
+        h.getBuffer().append(b'\x0f\x00\x15')
+        h.processBuffer()
+        self.assertIsNone(h._configuration)
+        self.assertEqual(processed, [])
+        self.assertEqual(len(h.getBuffer()), 0)
+        # packet is processed after incorrect answer
+        h._configuration = (packets.TeltonikaConfiguration(sent[0]), packet)
+        h.getBuffer().append(b'\x01')
+        h.processBuffer()
+        self.assertEqual(processed, [packet])
+
     def test_packetAcknowledgement(self):
         h = self.handler
         data = b'\x00\x00\x00\x00\x00\x00\x00\x2c\x08\x01\x00\x00\x01\x13' +\
@@ -167,6 +237,9 @@ class TestCase(unittest.TestCase):
                b'\x03\x00\x01\x46\x00\x00\x01\x5d\x00\x01\x00\x00\xcf\x77'
         packet = packets.PacketData(data)
         self.assertEqual(h.getAckPacket(packet), b'\x00\x00\x00\x01')
+        # acknowledgement does not decode records
+        self.assertIsNone(packet.AvlDataArray._items)
+        self.assertEqual(len(packet.AvlDataArray.items), 1)
         packet = h._packetsFactory.getInstance(b'\x00\x0f012896001609129')
         self.assertEqual(h.getAckPacket(packet), b'\x01')
 
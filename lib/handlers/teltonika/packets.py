@@ -8,6 +8,7 @@
 from datetime import datetime, timedelta
 import lib.crc16 as crc16
 import lib.bits as bits
+import lib.batch as batch
 from lib.packets import *
 from lib.factory import AbstractPacketFactory
 
@@ -116,8 +117,35 @@ class AvlDataArray(SolidBinaryPacket):
 
     @property
     def items(self):
+        """
+         Items are decoded on first access, so the packet is acknowledged
+         by its items count before records are decoded
+        """
+        if self._items is None and self._body is not None:
+            self._items = AvlData.getAvlDataListFromBuffer(
+                self._body, self._codecId)
         return self._items
 
+    @property
+    def itemsCount(self):
+        if self._rebuild: self._build()
+        return self._itemsCount
+
+    @property
+    def itemsParams(self):
+        """
+         Returns params of items.
+         Archive packets are decoded by batch if numpy is available
+         @return: list of dicts
+        """
+        if self._items is None and self._body is not None and \
+                self._codecId == 8:
+            params = AvlDataCodec8.getParamsByBatch(self._body,
+                self._itemsCount)
+            if params is not None:
+                return params
+        return [item.params for item in self.items]
+
     @property
     def codecId(self):
         if self._rebuild: self._build()
@@ -144,11 +172,9 @@ class AvlDataArray(SolidBinaryPacket):
         self._itemsCount = unpack(fmt,
             buffer[self._offset:self._offset + fmtLength])[0]
         self._offset += 1
-        # body
+        # body, Avl data items are retrieved from it by items property
         self._body = self._rawData[self._offset:-1]
-        # retrieving Avl data items
-        self._items = AvlData.getAvlDataListFromBuffer(
-            self._body, self._codecId)
+        self._items = None
         self._tail = self._rawData[-1:]
         # last byte must be equal to self._itemsCount
         lastByte = unpack(fmt, self._tail)[0]
@@ -164,9 +190,10 @@ class AvlData(BinaryPacket):
     """
       Item of data packet of naviset messaging protocol
     """
+    __slots__ = ('_params', '_ioElement', '_sensors')
+
     # protected properties
-    _params = None
-    _ioElement = None
+    _slotDefaults = {'_params': None, '_ioElement': None, '_sensors': None}
 
     @property
     def params(self):
@@ -189,9 +216,7 @@ class AvlData(BinaryPacket):
         self._rebuild = True
 
     def convertCoordinate(self, coord):
-        result = str(coord)
-        result = result[:2] + '.' + result[2:]
-        return float(result)
+        return convertCoordinate(coord)
 
     def _parseBody(self):
         """
@@ -200,6 +225,17 @@ class AvlData(BinaryPacket):
         """
         return super(AvlData, self)._parseBody()
 
+    def _parseTail(self):
+        """
+         Cuts the tail of the buffer.
+         Body of the item is its raw data, so it must not keep
+         a memoryview of the whole buffer of items
+         @return: self
+        """
+        super(AvlData, self)._parseTail()
+        self._body = self._rawData
+        return self
+
     @classmethod
     def getAvlDataListFromBuffer(cls, data, codecId):
         """
@@ -209,13 +245,7 @@ class AvlData(BinaryPacket):
          @return: array of AvlData instances (empty array if no AvlData found)
         """
         AvlClass = AvlDataCodec7 if codecId == 7 else AvlDataCodec8
-        items = []
-        while True:
-            item = AvlClass(data)
-            data = item.rawDataTail
-            items.append(item)
-            if len(data) == 0: break
-        return items
+        return list(iterPacketsFromBuffer(AvlClass, data))
 
 # ---------------------------------------------------------------------------
 
@@ -223,6 +253,74 @@ class AvlDataCodec8(AvlData):
     """
       Item of data packet of naviset messaging protocol with codec \x08
     """
+    __slots__ = ()
+
+    # layout of time, priority and GPS element
+    _layoutGps = RecordLayout([
+        ('time', 'Q', lambda value: datetime.utcfromtimestamp(value / 1000)),
+        ('priority', 'B'),
+        ('longitude', 'l', convertCoordinate),
+        ('latitude', 'l', convertCoordinate),
+        ('altitude', 'H'),
+        ('azimuth', 'H'),
+        ('satellitescount', 'B'),
+        ('speed', 'H')
+    ], '>')
+
+    # layouts of items by sizes of IO elements, which are used by
+    # batch decoder
+    _batchLayouts = {}
+
+    @classmethod
+    def getBatchLayout(cls, data):
+        """
+         Returns layout of items with IO elements of the first item
+         @param data: Input binary data
+         @return: RecordLayout or None if the first item is incomplete
+        """
+        offset = cls._layoutGps.size + 2 # event IO ID and total IO count
+        counts = []
+        for size in (1, 2, 4, 8):
+            if offset >= len(data):
+                return None
+            counts.append(data[offset])
+            offset += 1 + data[offset] * (1 + size)
+        counts = tuple(counts)
+        layout = cls._batchLayouts.get(counts)
+        if layout is None:
+            fields = list(cls._layoutGps.fields)
+            fields.extend([(None, 'B'), (None, 'B')])
+            for size, count in zip((1, 2, 4, 8), counts):
+                fields.append(('io%d' % size, 'B'))
+                fields.append((None, '%ds' % (count * (1 + size))))
+            layout = RecordLayout(fields, '>')
+            cls._batchLayouts[counts] = layout
+        return layout
+
+    @classmethod
+    def getParamsByBatch(cls, data, count):
+        """
+         Decodes params of items at once (see lib.batch).
+         All of items must have IO elements of the same sizes
+         @param data: Input binary data
+         @param count: Number of items
+         @return: list of dicts or None if batch decoding is not available
+        """
+        if not batch.isAvailable(count):
+            return None
+        layout = cls.getBatchLayout(data)
+        if layout is None or layout.size * count != len(data):
+            return None
+        columns = batch.decode(layout, data, count, {
+            'time': lambda values: batch.toDatetimes(values, 'ms'),
+            'longitude': batch.convertCoordinates,
+            'latitude': batch.convertCoordinates
+        })
+        for size in (1, 2, 4, 8):
+            counts = columns.pop('io%d' % size)
+            if (counts != counts[0]).any():
+                return None
+        return batch.toRecords(columns)
 
     def _parseBody(self):
         """
@@ -232,16 +330,7 @@ class AvlDataCodec8(AvlData):
         super(AvlDataCodec8, self)._parseBody()
         self._body = self._rawData
 
-        self._params = {}
-        self._params['time'] = datetime.utcfromtimestamp(
-            self.readFrom('>Q') / 1000)
-        self._params['priority'] = self.readFrom('>B')
-        self._params['longitude'] = self.convertCoordinate(self.readFrom('>l'))
-        self._params['latitude'] = self.convertCoordinate(self.readFrom('>l'))
-        self._params['altitude'] = self.readFrom('>H')
-        self._params['azimuth'] = self.readFrom('>H')
-        self._params['satellitescount'] = self.readFrom('>B')
-        self._params['speed'] = self.readFrom('>H')
+        self._params = self.readLayout(self._layoutGps)
 
         # get ioElement
         eventIoId = self.readFrom('>B')
@@ -295,6 +384,7 @@ class AvlDataCodec7(AvlData):
     """
       Item of data packet of naviset messaging protocol with codec \x08
     """
+    __slots__ = ()
 
     def _parseBody(self):
         """
@@ -549,15 +639,7 @@ class TeltonikaConfigurationParam(BasePacket):
          @param itemsCount: Count of items in the buffer
          @return: array of TeltonikaConfigurationParam instances (empty array if no param found)
         """
-        params = []
-        index = 0
-        while (itemsCount is None) or (index < itemsCount):
-            item = TeltonikaConfigurationParam(buffer)
-            buffer = item.rawDataTail
-            params.append(item)
-            if (len(buffer) == 0): break
-            index += 1
-        return params
+        return list(iterPacketsFromBuffer(cls, buffer, itemsCount))
 
     @classmethod
     def getInstance(cls, id, value):
@@ -676,6 +758,24 @@ class PacketFactory(AbstractPacketFactory):
      Packet factory
     """
 
+    def getFrameSize(self, data):
+        """
+         Returns size of the packet at the beginning of data
+         @param data: Input binary data
+         @return: int
+        """
+        if len(data) < 2:
+            return 2
+        length = unpack(">H", data[:2])[0]
+        if length > 0:
+            # head packet
+            return 2 + length
+        # data packet
+        if len(data) < 8:
+            return 8
+        length = unpack(">L", data[4:8])[0]
+        return 8 + length + calcsize(PacketData._fmtChecksum)
+
     def getInstance(self, data = None):
         """
           Returns a packet instance by its number
@@ -709,6 +809,18 @@ class TestCase(unittest.TestCase):
         self.assertEqual(packet.body, b'012896001609129')
         self.assertEqual(packet.deviceImei, '012896001609129')
 
+    def test_frameSize(self):
+        head = b'\x00\x0f012896001609129'
+        data = b'\x00\x00\x00\x00\x00\x00\x00\x2c\x08\x01\x00\x00\x01' + \
+            b'\x13\xfc\x20\x8d\xff\x00\x0f\x14\xf6\x50\x20\x9c\xca\x80' + \
+            b'\x00\x6f\x00\xd6\x04\x00\x04\x00\x04\x03\x01\x01\x15\x03' + \
+            b'\x16\x03\x00\x01\x46\x00\x00\x01\x5d\x00\x01\x00\x00\xcf\x77'
+        self.assertEqual(self.factory.getFrameSize(head), 17)
+        self.assertEqual(self.factory.getFrameSize(data[:5]), 8)
+        self.assertEqual(self.factory.getFrameSize(data), len(data))
+        self.assertEqual(self.factory.getFramesSize(head + data[:20]),
+            (17, len(data)))
+
     def test_AvlDataArray(self):
         data = b'\x08\x04\x00\x00\x01\x13\xfc\x20\x8d\xff\x00\x0f\x14\xf6' + \
             b'\x50\x20\x9c\xca\x80\x00\x6f\x00\xd6\x04\x00\x04\x00\x04\x03' + \
@@ -725,6 +837,7 @@ class TestCase(unittest.TestCase):
         avl = AvlDataArray(data)
         self.assertEqual(avl.codecId, 8)
         self.assertEqual(len(avl.items), 4)
+        self.assertFalse(hasattr(avl.items[0], '__dict__'))
         item = avl.items[0]
         self.assertEqual(item.params['time'].
             strftime('%Y-%m-%dT%H:%M:%S.%f'), '2007-07-25T06:46:38.335000')
@@ -743,6 +856,25 @@ class TestCase(unittest.TestCase):
                       {'id': 70, 'value': 349}]
         })
 
+    @unittest.skipIf(not batch.isAvailable(), 'numpy is not installed')
+    def test_itemsBatch(self):
+        item = b'\x00\x00\x01\x13\xfc\x20\x8d\xff\x00\x0f\x14\xf6' + \
+            b'\x50\x20\x9c\xca\x80\x00\x6f\x00\xd6\x04\x00\x04\x00' + \
+            b'\x04\x03\x01\x01\x15\x03\x16\x03\x00\x01\x46\x00\x00' + \
+            b'\x01\x5d\x00'
+        count = batch.MIN_RECORDS
+        avl = AvlDataArray(bytes((8, count)) + item * count + bytes((count,)))
+        params = avl.itemsParams
+        self.assertIsNone(avl._items)
+        self.assertEqual(params, [item.params for item in avl.items])
+        self.assertEqual(params[0]['longitude'], 25.3032016)
+        # items with different IO elements are decoded one by one
+        other = item[:-1] + b'\x01\x01\x00\x00\x00\x00\x00\x00\x00\x00'
+        avl = AvlDataArray(bytes((8, count)) + item * (count - 1) + other +
+            bytes((count,)))
+        self.assertIsNone(AvlDataCodec8.getParamsByBatch(avl._body, count))
+        self.assertEqual(len(avl.itemsParams), count)
+
     def test_PacketData(self):
         data = b'\x00\x00\x00\x00\x00\x00\x00\x2c\x08\x01\x00\x00\x01\x13' + \
                b'\xfc\x20\x8d\xff\x00\x0f\x14\xf6\x50\x20\x9c\xca\x80\x00' + \
@@ -846,6 +978,9 @@ class TestCase(unittest.TestCase):
         packet = packets[0]
         self.assertTrue(isinstance(packet, PacketData))
         avl = packet.AvlDataArray
+        if batch.isAvailable():
+            self.assertEqual(avl.itemsParams,
+                [item.params for item in AvlDataArray(avl.rawData).items])
         self.assertEqual(len(avl.items), 25)
         self.assertEqual(avl.codecId, 8)
         item = avl.items[0]
@@ -6,20 +6,237 @@
 '''
 
 from struct import *
+from types import MemberDescriptorType
 from kernel.utils import NeedMoreDataException
 
+# compiled structs by their format strings
+_structs = {}
+
+def getStruct(fmt):
+    """
+     Returns compiled struct of the format string.
+     Structs are compiled once per format, so readers and builders do not
+     parse format strings on every field
+     @param fmt: pack() format string
+     @return: struct.Struct
+    """
+    compiled = _structs.get(fmt)
+    if compiled is None:
+        compiled = Struct(fmt)
+        _structs[fmt] = compiled
+    return compiled
+
+def convertCoordinate(coord):
+    """
+     Returns coordinate value of its decimal digits.
+     Protocols send coordinates as integers, where the decimal point
+     follows the second digit (see lib.batch.convertCoordinates)
+     @param coord: int, like 55123456
+     @return: float, like 55.123456
+    """
+    result = str(coord)
+    result = result[:2] + '.' + result[2:]
+    return float(result)
+
+class RecordLayout(object):
+    """
+     Declarative layout of a fixed-size binary record.
+     Layout is given as a list of fields (name, struct code[, transform]),
+     it is compiled once into a single struct, so a record is read by one
+     unpack_from() call instead of one call per field.
+     Transform is a callable, which converts unpacked value, or a number,
+     by which the value is scaled. Scales like 0.1 are applied as division
+     by 10, so results equal to the values divided by hand.
+     Fields with None name are read and dropped (reserved bytes)
+    """
+
+    def __init__(self, fields, byteOrder = '<'):
+        """
+         Constructor
+         @param fields: list of tuples (name, struct code[, transform])
+         @param byteOrder: struct byte order character
+        """
+        self.fields = tuple(fields)
+        self.names = tuple(field[0] for field in self.fields)
+        self.byteOrder = byteOrder
+        for field in self.fields:
+            if len(Struct(byteOrder + field[1]).unpack(
+                    bytes(calcsize(byteOrder + field[1])))) != 1:
+                raise Exception('Field "%s" must have one value' % field[0])
+        self.struct = getStruct(byteOrder +
+            ''.join(field[1] for field in self.fields))
+        self.size = self.struct.size
+        # post-processing steps: (field index, name, callable)
+        self.transforms = tuple((index, field[0], self.getTransform(field[2]))
+            for index, field in enumerate(self.fields)
+            if len(field) > 2 and field[2] is not None and field[0])
+        self._dropped = tuple(name for name in self.names if not name)
+
+    @staticmethod
+    def getTransform(transform):
+        """
+         Returns callable of the field transform
+         @param transform: callable or number
+         @return: callable
+        """
+        if callable(transform):
+            return transform
+        if 0 < transform < 1:
+            divisor = round(1 / transform)
+            if abs(transform * divisor - 1) < 1e-12:
+                return lambda value: value / divisor
+        return lambda value: value * transform
+
+    def unpack(self, buffer, offset = 0):
+        """
+         Reads one record
+         @param buffer: bytes, bytearray or memoryview
+         @param offset: Offset of the record in the buffer
+         @return: dict of field values by their names
+        """
+        record = dict(zip(self.names, self.struct.unpack_from(buffer, offset)))
+        for index, name, transform in self.transforms:
+            record[name] = transform(record[name])
+        if self._dropped:
+            record.pop(None, None)
+        return record
+
+    def unpackAll(self, buffer, offset = 0, count = None):
+        """
+         Reads consecutive records.
+         Values are unpacked by struct.iter_unpack, and transforms are
+         applied column by column, so the post-processing step is done
+         for the whole batch at once
+         @param buffer: bytes, bytearray or memoryview
+         @param offset: Offset of the first record in the buffer
+         @param count: Number of records, all of the whole records by default
+         @return: list of dicts
+        """
+        view = memoryview(buffer)[offset:]
+        if count is None:
+            count = len(view) // self.size
+        view = view[:count * self.size]
+        if len(view) < count * self.size:
+            raise NeedMoreDataException('Not enough data for %d records' %
+                count)
+        if not count:
+            return []
+        columns = list(zip(*self.struct.iter_unpack(view)))
+        for index, name, transform in self.transforms:
+            columns[index] = map(transform, columns[index])
+        records = [dict(zip(self.names, values)) for values in zip(*columns)]
+        if self._dropped:
+            for record in records:
+                record.pop(None, None)
+        return records
+
+# ---------------------------------------------------------------------------
+
+class BufferCursor(object):
+    """
+     Read position in an immutable binary buffer.
+     Packets are given memoryview windows of the buffer starting from
+     the current offset, so extraction of N packets walks the buffer
+     once instead of copying its remaining tail N times.
+    """
+
+    def __init__(self, data):
+        """
+         Constructor
+         @param data: Input binary data (bytes or memoryview)
+        """
+        self._view = memoryview(data)
+        self.offset = 0
+
+    def __len__(self):
+        return len(self._view) - self.offset
+
+    def tail(self):
+        """
+         Returns unread data
+         @return: memoryview
+        """
+        return self._view[self.offset:]
+
+    def peek(self, size):
+        """
+         Returns size bytes from the current offset without moving it
+         @param size: Number of bytes
+         @return: bytes
+        """
+        return bytes(self._view[self.offset:self.offset + size])
+
+    def skip(self, size):
+        """
+         Moves the offset forward
+         @param size: Number of bytes
+        """
+        self.offset = min(self.offset + size, len(self._view))
+
+    def skipPacket(self, packet):
+        """
+         Moves the offset to the end of the packet.
+         Packet was created from tail(), so its size is the difference
+         between length of the tail and length of the packet's rawDataTail.
+         @param packet: Packet instance with rawDataTail property
+        """
+        rest = packet.rawDataTail
+        self.offset = len(self._view) - (len(rest) if rest else 0)
+
+def iterPacketsFromBuffer(getInstance, data, limit = None):
+    """
+     Walks the buffer once and yields packets
+     @param getInstance: Callable, which returns packet instance by data
+     @param data: Input binary data (bytes, memoryview or BufferCursor)
+     @param limit: Maximum number of packets to return
+    """
+    cursor = data if isinstance(data, BufferCursor) else BufferCursor(data)
+    count = 0
+    while len(cursor) > 0 and (limit is None or count < limit):
+        packet = getInstance(cursor.tail())
+        if not packet: break
+        cursor.skipPacket(packet)
+        count += 1
+        yield packet
+        if not packet.rawDataTail: break
+
 # ---------------------------------------------------------------------------
 
 class SolidBinaryPacket(object):
     """
-     Solid binary packet, which can not determine its length
+     Solid binary packet, which can not determine its length.
+     State of the packet is kept in slots instead of per-instance dict.
+     Classes declare initial values of their slots in _slotDefaults,
+     so slots are initialized by __new__ even if a subclass does not call
+     this constructor (like commands). __new__ is compiled for every class
+     into plain assignments of its slots (see compileSlotsInitializer).
+     Subclasses without __slots__ have a dict for their own attributes
+     as usual
     """
-    # protected properties
-    _head = None
-    _body = None
-    _tail = None
-    _rawData = None
-    _rebuild = True       # flag to rebuild rawData
+    __slots__ = ('_head', '_body', '_tail', '_rawData', '_rebuild', '_offset')
+
+    # initial values of slots declared by the class
+    _slotDefaults = {
+        '_head': None,
+        '_body': None,
+        '_tail': None,
+        '_rawData': None,
+        '_rebuild': True, # flag to rebuild rawData
+        '_offset': 0
+    }
+    def __init_subclass__(cls, **kwargs):
+        """
+         Collects initial values of slots of the class and its bases.
+         Slots, which are shadowed by class attributes of a subclass,
+         are skipped, so class attribute stays the default value
+        """
+        super(SolidBinaryPacket, cls).__init_subclass__(**kwargs)
+        values = {}
+        for base in reversed(cls.__mro__):
+            values.update(base.__dict__.get('_slotDefaults', {}))
+        cls.__new__ = compileSlotsInitializer(dict((name, value)
+            for name, value in values.items()
+            if isinstance(getattr(cls, name, None), MemberDescriptorType)))
 
     def __init__(self, data = None, config = None):
         """
@@ -156,15 +373,48 @@ class SolidBinaryPacket(object):
             return None
         if buffer is None:
             buffer = self._rawData
-        fmtSize = calcsize(fmt)
-        shift = self._offset + fmtSize
-        result = unpack(fmt, buffer[self._offset:shift])[0]
-        self._offset += fmtSize
+        compiled = getStruct(fmt)
+        result = compiled.unpack_from(buffer, self._offset)[0]
+        self._offset += compiled.size
+        return result
+
+    def readLayout(self, layout, buffer = None):
+        """
+         Reads record from buffer, and increases offset
+         @param layout: RecordLayout instance
+         @param buffer: buffer from which we will get the result
+         @return: dict
+        """
+        if buffer is None:
+            buffer = self._rawData
+        result = layout.unpack(buffer, self._offset)
+        self._offset += layout.size
         return result
     
     def to_string(self):
         return "Not Implemented!"
 
+def compileSlotsInitializer(values):
+    """
+     Returns __new__ method, which creates instance with initialized slots.
+     Slots are set by assignments compiled for the class instead of
+     setattr() calls in a loop (they are executed for every packet)
+     @param values: dict of initial values of slots
+     @return: staticmethod
+    """
+    namespace = {'createObject': object.__new__}
+    lines = ['def __new__(cls, *args, **kwargs):',
+        '    packet = createObject(cls)']
+    for number, (name, value) in enumerate(values.items()):
+        namespace['value%d' % number] = value
+        lines.append('    packet.%s = value%d' % (name, number))
+    lines.append('    return packet')
+    exec('\n'.join(lines), namespace)
+    return staticmethod(namespace['__new__'])
+
+SolidBinaryPacket.__new__ = compileSlotsInitializer(
+    SolidBinaryPacket._slotDefaults)
+
 # ---------------------------------------------------------------------------
 
 class BinaryPacket(SolidBinaryPacket):
@@ -173,8 +423,10 @@ class BinaryPacket(SolidBinaryPacket):
      and through this cut the tail of supplied raw data
     """
 
+    __slots__ = ('_rawDataTail',)
+
     # protected properties
-    _rawDataTail = None
+    _slotDefaults = {'_rawDataTail': None}
 
     @property
     def rawDataTail(self):
@@ -184,11 +436,14 @@ class BinaryPacket(SolidBinaryPacket):
         """
          Parses packet's tail.
          By default it cuts the unused tail of packet buffer.
+         If rawData is a memoryview of the receive buffer, the tail stays
+         a memoryview and only the packet itself is copied. The receive
+         buffer does not overwrite bytes under such views (see lib.buffer)
          @return: self
         """
         # cut the tail
         self._rawDataTail = self._rawData[self._offset:]
-        self._rawData = self._rawData[:self._offset]
+        self._rawData = bytes(self._rawData[:self._offset])
         return self
 
 # ---------------------------------------------------------------------------
@@ -198,18 +453,33 @@ class BasePacket(BinaryPacket):
      Abstract binary protocol packet with length and checksum
     """
 
+    __slots__ = ('_length', '_checksum')
+
     # protected properties
+    _slotDefaults = {'_length': 0, '_checksum': None}
+
+    # header and footer values are overridden by protocol classes,
+    # so they are class attributes instead of slots
     _header = None
     _footer = None
-    _length = 0
-    _checksum = None
-    _offset = 0
 
     _fmtHeader = None   # header format
     _fmtLength = None   # packet length format
     _fmtChecksum = None # checksum format
     _fmtFooter = None   # footer format
 
+    def __init_subclass__(cls, **kwargs):
+        """
+         Compiles formats of the packet class when the class is created.
+         Formats are looked up by getStruct() on every read, so formats
+         changed in runtime (like ImeBase._fmtChecksum) are used too
+        """
+        super(BasePacket, cls).__init_subclass__(**kwargs)
+        for fmt in (cls._fmtHeader, cls._fmtLength,
+                cls._fmtChecksum, cls._fmtFooter):
+            if fmt is not None:
+                getStruct(fmt)
+
     @property
     def header(self):
         if self._rebuild: self._build()
@@ -290,6 +560,27 @@ class BasePacket(BinaryPacket):
          """
         return self.calculateChecksum() == self.checksum
 
+    def _checkSize(self, buffer, size):
+        """
+         Raises NeedMoreDataException if buffer is shorter than size
+         @param buffer: Input binary data
+         @param size: Required size of the buffer
+        """
+        if size > len(buffer):
+            raise NeedMoreDataException('Not enough data in buffer')
+
+    def _unpackField(self, fmt, buffer):
+        """
+         Reads field at the current offset without moving it.
+         Raises NeedMoreDataException if buffer is too short
+         @param fmt: pack() format string
+         @param buffer: Input binary data
+         @return: tuple (value, field size)
+        """
+        compiled = getStruct(fmt)
+        self._checkSize(buffer, self._offset + compiled.size)
+        return compiled.unpack_from(buffer, self._offset)[0], compiled.size
+
     def _parseHead(self):
         """
          Parses packet header
@@ -301,27 +592,25 @@ class BasePacket(BinaryPacket):
 
         # read header and length
         fmt = self._fmtHeader
-        fmtSize = calcsize(fmt or '')
-        shift = self._offset + fmtSize
+        fmtSize = 0
         if fmt is not None:
-            self._header = unpack(fmt, buffer[self._offset:shift])[0]
-            self._head = buffer[:shift]
+            self._header, fmtSize = self._unpackField(fmt, buffer)
+            self._head = bytes(buffer[:self._offset + fmtSize])
         self._offset += self._parseHeader() or fmtSize
 
         fmt = self._fmtLength
-        fmtSize = calcsize(fmt or '')
-        shift = self._offset + fmtSize
+        fmtSize = 0
         if fmt is not None:
-            self._length = unpack(fmt, buffer[self._offset:shift])[0]
-            self._head = buffer[:shift]
+            self._length, fmtSize = self._unpackField(fmt, buffer)
+            self._head = bytes(buffer[:self._offset + fmtSize])
         self._offset += self._parseLength() or fmtSize
 
-        if self._length > len(buffer):
-            raise NeedMoreDataException('Not enough data in buffer')
+        self._checkSize(buffer, self._offset + self._length)
 
         self._body = b''
         if self._length > 0:
-            self._body = buffer[self._offset:self._offset + self._length]
+            self._body = bytes(
+                buffer[self._offset:self._offset + self._length])
             if len(self._body) != self._length:
                 raise Exception('Body length is incorrect! ' +\
                     str(self._length) + ' (given) != ' + \
@@ -339,11 +628,10 @@ class BasePacket(BinaryPacket):
 
         # read checksum and compare with calculated checksum
         fmt = self._fmtChecksum
-        fmtSize = calcsize(fmt or '')
-        shift = self._offset + fmtSize
+        fmtSize = 0
         if fmt is not None:
-            self._checksum = unpack(fmt, buffer[self._offset:shift])[0]
-            self._tail = buffer[self._offset:shift]
+            self._checksum, fmtSize = self._unpackField(fmt, buffer)
+            self._tail = bytes(buffer[self._offset:self._offset + fmtSize])
             # checksum check
             if not self._isCorrectChecksum():
                 raise Exception('Checksum is incorrect! ' +
@@ -352,11 +640,10 @@ class BasePacket(BinaryPacket):
         self._offset += self._parseChecksum() or fmtSize
 
         fmt = self._fmtFooter
-        fmtSize = calcsize(fmt or '')
-        shift = self._offset + fmtSize
+        fmtSize = 0
         if fmt is not None:
-            self._footer = unpack(fmt, buffer[self._offset:shift])[0]
-            self._tail += buffer[self._offset:shift]
+            self._footer, fmtSize = self._unpackField(fmt, buffer)
+            self._tail += bytes(buffer[self._offset:self._offset + fmtSize])
         self._offset += self._parseFooter() or fmtSize
 
         return super(BasePacket, self)._parseTail()
@@ -370,9 +657,10 @@ class BasePacket(BinaryPacket):
         if self._fmtHeader is not None:
             if self._header is None:
                 self._header = 0
-            data += pack(str(self._fmtHeader), self._header)
+            data += getStruct(self._fmtHeader).pack(self._header)
         if self._fmtLength is not None:
-            data += pack(str(self._fmtLength), self._buildCalculateLength())
+            data += getStruct(self._fmtLength).pack(
+                self._buildCalculateLength())
         return data
 
     def _buildTail(self):
@@ -383,9 +671,9 @@ class BasePacket(BinaryPacket):
         data = b''
         if self._fmtChecksum is not None:
             self._checksum = self.calculateChecksum()
-            data += pack(str(self._fmtChecksum), self._checksum)
+            data += getStruct(self._fmtChecksum).pack(self._checksum)
         if self._footer and self._fmtFooter is not None:
-            data += pack(str(self._fmtFooter), self._footer)
+            data += getStruct(self._fmtFooter).pack(self._footer)
         return data
 
     def _buildCalculateLength(self):
@@ -396,4 +684,113 @@ class BasePacket(BinaryPacket):
         self._length = 0
         if self._body is not None:
             self._length = len(self._body)
-        return self._length
\ No newline at end of file
+        return self._length
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+
+class TestPacket(BasePacket):
+    """ Test packet with one byte length """
+    _fmtLength = '<B'
+
+class TestCase(unittest.TestCase):
+
+    def test_bufferCursor(self):
+        cursor = BufferCursor(b'0123456789')
+        cursor.skip(3)
+        self.assertEqual(len(cursor), 7)
+        self.assertEqual(cursor.peek(2), b'34')
+        self.assertEqual(cursor.tail(), b'3456789')
+        cursor.skip(100)
+        self.assertEqual(len(cursor), 0)
+
+    def test_iterPacketsFromBuffer(self):
+        data = b'\x02ab\x01c\x03def'
+        packets = list(iterPacketsFromBuffer(TestPacket, data))
+        self.assertEqual([p.body for p in packets], [b'ab', b'c', b'def'])
+        self.assertEqual(packets[1].rawData, b'\x01c')
+        self.assertIsInstance(packets[1].rawData, bytes)
+        # tails are windows of the source buffer, not copies
+        self.assertIsInstance(packets[0].rawDataTail, memoryview)
+        self.assertEqual(packets[0].rawDataTail, b'\x01c\x03def')
+        packets = list(iterPacketsFromBuffer(TestPacket, data, 2))
+        self.assertEqual(len(packets), 2)
+        self.assertEqual(list(iterPacketsFromBuffer(TestPacket, b'')), [])
+
+    def test_iterPacketsIncomplete(self):
+        cursor = BufferCursor(b'\x02ab\x03de')
+        packets = iterPacketsFromBuffer(TestPacket, cursor)
+        self.assertEqual(next(packets).body, b'ab')
+        self.assertRaises(NeedMoreDataException, next, packets)
+        self.assertEqual(cursor.offset, 3)
+
+    def test_structCache(self):
+        class ChecksumPacket(TestPacket):
+            _fmtChecksum = '>H'
+            def calculateChecksum(self):
+                return 0x0102
+        self.assertIn('>H', _structs)
+        self.assertIs(getStruct('<B'), getStruct('<B'))
+        packet = ChecksumPacket(b'\x01a\x01\x02')
+        self.assertEqual(packet.checksum, 0x0102)
+        self.assertEqual(packet.readFrom('<B', b'\x00\x00\x00\x00\x05'), 5)
+        # format changed in runtime is used
+        ChecksumPacket._fmtChecksum = '<H'
+        packet = ChecksumPacket(b'\x01a\x02\x01')
+        self.assertEqual(packet.rawData, b'\x01a\x02\x01')
+        packet.body = b'b'
+        self.assertEqual(packet.rawData, b'\x01b\x02\x01')
+
+    def test_recordLayout(self):
+        layout = RecordLayout([
+            ('number', 'H'),
+            (None, 'B'),
+            ('latitude', 'l', 0.000001),
+            ('odometer', 'H', 100),
+            ('flag', 'B', bool)
+        ])
+        self.assertEqual(layout.size, 10)
+        self.assertIs(layout.struct, getStruct('<HBlHB'))
+        data = pack('<HBlHB', 7, 0xFF, 55788660, 12, 1) + \
+            pack('<HBlHB', 8, 0xFF, -37660096, 0, 0)
+        first = {'number': 7, 'latitude': 55.78866, 'odometer': 1200,
+            'flag': True}
+        second = {'number': 8, 'latitude': -37.660096, 'odometer': 0,
+            'flag': False}
+        self.assertEqual(layout.unpack(data), first)
+        self.assertEqual(layout.unpack(data, 10), second)
+        self.assertEqual(layout.unpackAll(data), [first, second])
+        self.assertEqual(layout.unpackAll(memoryview(data), 10), [second])
+        self.assertEqual(layout.unpackAll(data, 0, 0), [])
+        self.assertRaises(NeedMoreDataException, layout.unpackAll, data, 1, 2)
+        self.assertRaises(Exception, RecordLayout, [('pair', 'HH')])
+        packet = TestPacket(b'\x00')
+        packet._offset = 0
+        self.assertEqual(packet.readLayout(layout, data), first)
+        self.assertEqual(packet.readLayout(layout, data), second)
+        self.assertEqual(convertCoordinate(55123456), 55.123456)
+        self.assertEqual(convertCoordinate(-3765432), -3.765432)
+
+    def test_slots(self):
+        class SlotPacket(BasePacket):
+            __slots__ = ()
+            _fmtLength = '<B'
+        class HeaderPacket(TestPacket):
+            _length = 5
+        class CommandPacket(TestPacket):
+            def __init__(self):
+                pass
+        packet = SlotPacket(b'\x01a')
+        self.assertFalse(hasattr(packet, '__dict__'))
+        self.assertEqual(packet.rawData, b'\x01a')
+        self.assertRaises(AttributeError, setattr, packet, 'unknown', 1)
+        # class attribute of subclass stays the default value
+        self.assertEqual(HeaderPacket()._length, 5)
+        # slots are initialized without constructor
+        command = CommandPacket()
+        self.assertIsNone(command._rawDataTail)
+        self.assertEqual(command._offset, 0)
+        self.assertEqual(command.rawData, b'\x00')
@@ -0,0 +1,207 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Background batched publisher of packets
+@copyright 2016, Maprox LLC
+"""
+
+import os
+import time
+import queue
+import atexit
+from threading import Thread, Lock
+from concurrent.futures import Future
+
+from kernel.config import conf
+from kernel.logger import log
+from lib.spool import spool
+
+# timeout of waiting for the publisher thread on exit (seconds)
+STOP_TIMEOUT = 5
+
+
+class BatchPublisher:
+    """
+     Publishes packets from a background thread.
+     Handlers put packets into a bounded queue and continue socket I/O,
+     the thread joins queued packets into batches (by size or linger time)
+     and sends every batch with one call of the send function.
+     When the queue is full, publish() blocks for up to timeout seconds,
+     so slow message broker slows down reading from devices instead of
+     growing memory usage.
+    """
+
+    def __init__(self, send, queueSize = 10000, batchSize = 100,
+            linger = 0.05, timeout = 5):
+        """
+         Publisher constructor
+         @param send: Callable, which sends a list of packets and returns
+           True on success
+         @param queueSize: Maximum number of queued publish() calls
+         @param batchSize: Maximum number of packets in one batch
+         @param linger: Time to wait for more packets before sending
+           an incomplete batch (seconds)
+         @param timeout: Maximum time to wait for free space in the queue
+           (seconds)
+        """
+        self._send = send
+        self.queueSize = queueSize
+        self.batchSize = batchSize
+        self.linger = linger
+        self.timeout = timeout
+        self._lock = Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """
+         Starts publisher thread if it is not started in this process
+        """
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self.queueSize)
+            self._thread = Thread(target = self.threadHandler, daemon = True)
+            self._thread.start()
+
+    def stop(self, timeout = STOP_TIMEOUT):
+        """
+         Sends queued packets and stops publisher thread
+         @param timeout: Maximum time to wait for the thread (seconds)
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._thread = None
+            try:
+                self._queue.put(None, timeout = timeout)
+            except queue.Full:
+                log.error('Publisher queue is full, packets are lost')
+                return
+        thread.join(timeout)
+
+    def publish(self, packets):
+        """
+         Queues packets for sending
+         @param packets: list of dict
+         @return: Future, its result is True when packets are sent
+           and False when sending is failed.
+           Raises queue.Full if the queue is full longer than timeout
+        """
+        self.start()
+        future = Future()
+        self._queue.put((packets, future), timeout = self.timeout)
+        return future
+
+    def getBatch(self):
+        """
+         Waits for the next batch of queued packets
+         @return: tuple (list of packets, list of futures, stop flag)
+        """
+        item = self._queue.get()
+        packets = []
+        futures = []
+        deadline = time.monotonic() + self.linger
+        while item is not None:
+            packets.extend(item[0])
+            futures.append(item[1])
+            if len(packets) >= self.batchSize:
+                break
+            try:
+                item = self._queue.get(
+                    timeout = max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+        return packets, futures, item is None
+
+    def threadHandler(self):
+        """
+         Thread handler
+        """
+        stopped = False
+        while not stopped:
+            packets, futures, stopped = self.getBatch()
+            if not packets and not futures:
+                continue
+            try:
+                result = bool(self._send(packets))
+            except Exception as E:
+                log.exception('Error during packets publishing: %s', E)
+                result = False
+            for future in futures:
+                future.set_result(result)
+
+# global publisher of packets, which are spooled when sending is failed
+publisher = BatchPublisher(
+    spool.send,
+    queueSize = conf.publishQueueSize,
+    batchSize = conf.publishBatchSize,
+    linger = conf.publishLinger,
+    timeout = conf.publishTimeout
+)
+atexit.register(publisher.stop)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+from threading import Event
+
+class TestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.batches = []
+        self.publisher = BatchPublisher(self.send, queueSize = 2,
+            batchSize = 3, linger = 0.05, timeout = 0.1)
+
+    def tearDown(self):
+        self.publisher.stop()
+
+    def send(self, packets):
+        self.batches.append(packets)
+        return True
+
+    def test_batchBySize(self):
+        futures = [self.publisher.publish([{'n': 1}, {'n': 2}])]
+        futures.append(self.publisher.publish([{'n': 3}]))
+        self.assertTrue(all(f.result(timeout = 1) for f in futures))
+        self.assertEqual(self.batches, [[{'n': 1}, {'n': 2}, {'n': 3}]])
+
+    def test_batchByLinger(self):
+        future = self.publisher.publish([{'n': 1}])
+        self.assertTrue(future.result(timeout = 1))
+        future = self.publisher.publish([{'n': 2}])
+        self.assertTrue(future.result(timeout = 1))
+        self.assertEqual(self.batches, [[{'n': 1}], [{'n': 2}]])
+
+    def test_sendError(self):
+        self.publisher._send = lambda packets: 1 / 0
+        future = self.publisher.publish([{'n': 1}])
+        self.assertFalse(future.result(timeout = 1))
+
+    def test_backpressure(self):
+        sending = Event()
+        release = Event()
+        def send(packets):
+            sending.set()
+            release.wait(5)
+            return True
+        self.publisher._send = send
+        futures = [self.publisher.publish([{'n': 0}] * 3)]
+        sending.wait(1)
+        futures.append(self.publisher.publish([{'n': 1}]))
+        futures.append(self.publisher.publish([{'n': 2}]))
+        self.assertRaises(queue.Full, self.publisher.publish, [{'n': 3}])
+        release.set()
+        self.assertTrue(all(f.result(timeout = 1) for f in futures))
+
+    def test_stopSendsQueuedPackets(self):
+        self.publisher.linger = 10
+        future = self.publisher.publish([{'n': 1}])
+        self.publisher.stop()
+        self.assertTrue(future.result(timeout = 0))
+        self.assertEqual(self.batches, [[{'n': 1}]])
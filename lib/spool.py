@@ -0,0 +1,590 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Local write-ahead spool of packets
+@copyright 2016, Maprox LLC
+"""
+
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import atexit
+from threading import Thread, Lock, Event
+
+from kernel.config import conf
+from kernel.logger import log
+from kernel.metrics import metrics
+from lib.serializer import encode, decode
+
+# segment header: read offset
+SEGMENT_HEADER = struct.Struct('<Q')
+# record header: length and crc32 of the record data
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_SUFFIX = '.spool'
+
+# --------------------------------------------------------------------
+
+class SpoolSegment:
+    """
+     Memory-mapped segment file of the spool.
+     Records are appended one after another and never changed, the offset
+     of the first not replayed record is kept in the segment header.
+     Zero length or wrong crc32 marks the end of written records, so
+     a record torn by a crash is ignored
+    """
+
+    def __init__(self, path, size = None):
+        """
+         Opens existing segment or creates a new one
+         @param path: Segment file path
+         @param size: Size of a new segment file (bytes)
+        """
+        self.path = path
+        if size is not None:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self._file = open(path, 'r+b')
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+        self.readOffset = SEGMENT_HEADER.unpack_from(self._map)[0] or \
+            SEGMENT_HEADER.size
+        self.writeOffset = self.readOffset
+        for record, offset in self.iterRecords(self.readOffset):
+            self.writeOffset = offset
+
+    def iterRecords(self, offset, limit = None):
+        """
+         Iterates over written records
+         @param offset: Offset of the first record
+         @param limit: Maximum number of records
+         @return: iterator of tuples (record data, offset of the next record)
+        """
+        count = 0
+        while offset + RECORD_HEADER.size <= self.size:
+            if limit is not None and count >= limit:
+                return
+            length, crc = RECORD_HEADER.unpack_from(self._map, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + length
+            if not length or end > self.size:
+                return
+            data = self._map[start:end]
+            if zlib.crc32(data) != crc:
+                return
+            offset = end
+            count += 1
+            yield data, offset
+
+    def append(self, data):
+        """
+         Appends record to the segment
+         @param data: bytes
+         @return: False if there is no space for the record
+        """
+        end = self.writeOffset + RECORD_HEADER.size + len(data)
+        if end > self.size:
+            return False
+        RECORD_HEADER.pack_into(self._map, self.writeOffset,
+            len(data), zlib.crc32(data))
+        self._map[self.writeOffset + RECORD_HEADER.size:end] = data
+        self.writeOffset = end
+        return True
+
+    def commit(self, offset):
+        """
+         Marks records before the offset as replayed
+         @param offset: int
+        """
+        self.readOffset = offset
+        SEGMENT_HEADER.pack_into(self._map, 0, offset)
+
+    def isEmpty(self):
+        """
+         Returns True if all of written records are replayed
+        """
+        return self.readOffset >= self.writeOffset
+
+    def flush(self):
+        """
+         Writes changed pages to disk
+        """
+        self._map.flush()
+
+    def close(self):
+        """
+         Closes segment file
+        """
+        self._map.close()
+        self._file.close()
+
+    def remove(self):
+        """
+         Closes and removes segment file
+        """
+        self.close()
+        os.remove(self.path)
+
+# --------------------------------------------------------------------
+
+class PacketSpool:
+    """
+     Append-only on-disk spool of packets, which are not published
+     because the message broker is unreachable or the publisher queue
+     is full.
+     Packets are kept in memory-mapped segment files of the spool slot,
+     a replay thread sends them to the broker in order, by batches,
+     once the broker recovers.
+     Once sending is failed the spool is degraded: all of the next packets
+     are written to the spool behind failed ones, until the replay thread
+     drains it, so packets are sent in their order. Changed pages are flushed to disk every
+     syncInterval seconds instead of every write.
+     Every process locks its own slot directory, so prefork workers do not
+     share segments and packets of a stopped process are replayed by
+     the next process, which takes its slot
+    """
+    _thread = None
+    _pid = None
+    _slotFile = None
+    # True while packets must be written to the spool (see send)
+    degraded = False
+
+    def __init__(self, path, send = None, segmentSize = 16777216,
+            maxSize = 1073741824, batchSize = 100, syncInterval = 1,
+            retryDelay = 5):
+        """
+         Spool constructor
+         @param path: Spool directory, empty string disables the spool
+         @param send: Callable, which sends a list of packets and returns
+           True on success
+         @param segmentSize: Size of segment file (bytes)
+         @param maxSize: Maximum total size of segment files (bytes)
+         @param batchSize: Maximum number of packets sent at once
+         @param syncInterval: Interval of flushing to disk (seconds)
+         @param retryDelay: Delay of replay after failed sending (seconds)
+        """
+        self.path = path
+        self._send = send
+        self.segmentSize = segmentSize
+        self.maxSize = maxSize
+        self.batchSize = batchSize
+        self.syncInterval = syncInterval
+        self.retryDelay = retryDelay
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stop = Event()
+        self._segments = []
+        self._dirty = False
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def start(self):
+        """
+         Opens spool slot and starts replay thread if they are not
+         started in this process
+        """
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._segments = []
+            self.open()
+            self._stop.clear()
+            self._thread = Thread(target = self.threadHandler, daemon = True)
+            self._thread.start()
+
+    def open(self):
+        """
+         Locks the first free slot directory and opens its segments
+        """
+        number = 0
+        while True:
+            slotPath = os.path.join(self.path, str(number))
+            os.makedirs(slotPath, exist_ok = True)
+            slotFile = open(os.path.join(slotPath, 'lock'), 'w')
+            try:
+                fcntl.flock(slotFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                slotFile.close()
+                number += 1
+        self._slotFile = slotFile
+        self.slotPath = slotPath
+        names = sorted(name for name in os.listdir(slotPath)
+            if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            segment = SpoolSegment(os.path.join(slotPath, name))
+            if segment.isEmpty() and name != names[-1]:
+                segment.remove()
+            else:
+                self._segments.append(segment)
+        if self.hasPackets():
+            self.degraded = True
+            log.info('Spool %s has packets to replay', slotPath)
+
+    def close(self):
+        """
+         Flushes and closes segments, unlocks the slot
+        """
+        for segment in self._segments:
+            segment.flush()
+            segment.close()
+        self._segments = []
+        if self._slotFile is not None:
+            self._slotFile.close()
+            self._slotFile = None
+
+    def stop(self):
+        """
+         Stops replay thread and closes the spool
+        """
+        with self._lock:
+            thread = self._thread
+            if thread is None or self._pid != os.getpid():
+                return
+            self._thread = None
+        self._stop.set()
+        self._wakeup.set()
+        thread.join()
+        with self._lock:
+            self.close()
+
+    def getSize(self):
+        """
+         Returns total size of segment files (bytes)
+        """
+        return sum(segment.size for segment in self._segments)
+
+    def hasPackets(self):
+        """
+         Returns True if there are packets to replay
+        """
+        return any(not segment.isEmpty() for segment in self._segments)
+
+    def setDegraded(self):
+        """
+         Makes the next packets go to the spool until it is replayed
+        """
+        self.start()
+        with self._lock:
+            self.degraded = True
+
+    def send(self, packets):
+        """
+         Sends packets by the send function or, if sending is failed or
+         the spool is degraded, writes them to the spool.
+         Packets must be sent by one thread, so their order is kept
+         @param packets: list of dict
+         @return: True if packets are sent or spooled
+        """
+        if not self.enabled:
+            return self._send(packets)
+        if not self.degraded:
+            try:
+                if self._send(packets):
+                    return True
+            except Exception as E:
+                log.exception('Error during packets sending: %s', E)
+        return self.append(packets)
+
+    def append(self, packets):
+        """
+         Writes packets to the spool, the spool becomes degraded
+         @param packets: list of dict
+         @return: False if the spool is full
+        """
+        self.start()
+        data = encode(packets)
+        with self._lock:
+            self.degraded = True
+            segments = self._segments
+            if not segments or not segments[-1].append(data):
+                size = max(self.segmentSize,
+                    SEGMENT_HEADER.size + RECORD_HEADER.size + len(data))
+                if self.getSize() + size > self.maxSize:
+                    log.error('Spool is full, %d packets are lost',
+                        len(packets))
+                    metrics.increment('spool.dropped', len(packets))
+                    return False
+                if segments:
+                    segments[-1].flush()
+                number = 0
+                if segments:
+                    number = int(os.path.basename(segments[-1].path)[
+                        :-len(SEGMENT_SUFFIX)]) + 1
+                name = '%016d%s' % (number, SEGMENT_SUFFIX)
+                segment = SpoolSegment(os.path.join(self.slotPath, name),
+                    size)
+                segment.append(data)
+                segments.append(segment)
+            self._dirty = True
+        metrics.increment('spool.written', len(packets))
+        self._wakeup.set()
+        return True
+
+    def read(self):
+        """
+         Returns the next batch of spooled packets
+         @return: tuple (list of packets, position to commit) or
+           (None, None) if there are no packets, then the spool is
+           not degraded any more
+        """
+        with self._lock:
+            for segment in self._segments:
+                if segment.isEmpty():
+                    continue
+                packets = []
+                offset = segment.readOffset
+                for data, offset in segment.iterRecords(offset):
+                    packets.extend(decode(data))
+                    if len(packets) >= self.batchSize:
+                        break
+                return packets, (segment, offset)
+            self.degraded = False
+        return None, None
+
+    def commit(self, position):
+        """
+         Marks read packets as replayed, replayed segments are removed
+         @param position: Position returned by read()
+        """
+        segment, offset = position
+        with self._lock:
+            segment.commit(offset)
+            self._dirty = True
+            if segment.isEmpty() and segment is not self._segments[-1]:
+                self._segments.remove(segment)
+                segment.remove()
+
+    def sync(self):
+        """
+         Flushes changed segments to disk
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            for segment in self._segments:
+                segment.flush()
+
+    def replay(self):
+        """
+         Sends spooled packets to the broker until the spool is empty
+         or sending is failed
+         @return: True if all of packets are sent
+        """
+        while not self._stop.is_set():
+            packets, position = self.read()
+            if position is None:
+                return True
+            if packets:
+                try:
+                    sent = self._send(packets)
+                except Exception as E:
+                    log.exception('Error during spool replay: %s', E)
+                    sent = False
+                if not sent:
+                    return False
+                metrics.increment('spool.replayed', len(packets))
+            self.commit(position)
+        return False
+
+    def threadHandler(self):
+        """
+         Thread handler
+        """
+        while not self._stop.is_set():
+            self._wakeup.wait(self.syncInterval)
+            self._wakeup.clear()
+            self.sync()
+            if self._stop.is_set():
+                break
+            if self.degraded and not self.replay():
+                # appended packets do not wake the thread up until delay
+                self._stop.wait(self.retryDelay)
+        self.sync()
+
+def createSpool():
+    """
+     Creates global spool of the process
+     @return: PacketSpool
+    """
+    from lib.broker import broker
+    return PacketSpool(
+        conf.spoolPath,
+        broker.send,
+        segmentSize = conf.spoolSegmentSize,
+        maxSize = conf.spoolMaxSize,
+        batchSize = conf.publishBatchSize,
+        syncInterval = conf.spoolSyncInterval
+    )
+
+# global spool of packets
+spool = createSpool()
+atexit.register(spool.stop)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+import queue
+import tempfile
+
+class TestCase(unittest.TestCase):
+    failing = True
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sent = []
+        self.spool = self.createSpool()
+
+    def tearDown(self):
+        self.spool.stop()
+        self.directory.cleanup()
+
+    def createSpool(self, **kwargs):
+        return PacketSpool(self.directory.name, self.send,
+            segmentSize = 64, syncInterval = 0.05, retryDelay = 0.05,
+            **kwargs)
+
+    def send(self, packets):
+        if self.failing:
+            return False
+        self.sent.extend(packets)
+        return True
+
+    def waitFor(self, condition):
+        for _ in range(100):
+            if condition(): return True
+            time.sleep(0.02)
+        return False
+
+    def waitForReplay(self):
+        return self.waitFor(lambda: not self.spool.hasPackets())
+
+    def test_replayInOrder(self):
+        for n in range(10):
+            self.assertTrue(self.spool.append([{'n': n}]))
+        self.assertGreater(len(self.spool._segments), 1)
+        time.sleep(0.1)
+        self.assertEqual(self.sent, [])
+        self.failing = False
+        self.assertTrue(self.waitForReplay())
+        self.assertEqual(self.sent, [{'n': n} for n in range(10)])
+        self.assertEqual(len(self.spool._segments), 1)
+
+    def test_reopen(self):
+        self.spool.append([{'n': 1}, {'n': 2}])
+        self.spool.append([{'n': 3}])
+        packets, position = self.spool.read()
+        self.assertEqual(packets, [{'n': 1}, {'n': 2}, {'n': 3}])
+        self.spool.batchSize = 2
+        packets, position = self.spool.read()
+        self.assertEqual(packets, [{'n': 1}, {'n': 2}])
+        self.spool.commit(position)
+        # the second process takes another slot
+        other = self.createSpool()
+        other.append([{'n': 4}])
+        self.assertNotEqual(other.slotPath, self.spool.slotPath)
+        other.stop()
+        # not replayed packets are kept after restart
+        self.spool.stop()
+        self.spool = self.createSpool()
+        self.spool.start()
+        self.assertEqual(self.spool.read()[0], [{'n': 3}])
+
+    def test_replayAtStart(self):
+        for n in range(5):
+            self.spool.append([{'n': n}])
+        self.assertGreater(len(self.spool._segments), 1)
+        self.spool.stop()
+        # packets of the stopped process are replayed without new packets
+        self.failing = False
+        self.spool = self.createSpool()
+        self.spool.start()
+        self.assertTrue(self.spool.degraded)
+        self.assertTrue(self.waitFor(lambda: not self.spool.degraded))
+        self.assertEqual(self.sent, [{'n': n} for n in range(5)])
+
+    def test_tornRecord(self):
+        self.spool.append([{'n': 1}])
+        segment = self.spool._segments[-1]
+        offset = segment.writeOffset
+        self.spool.append([{'n': 2}])
+        segment._map[offset + RECORD_HEADER.size] ^= 0xFF
+        self.spool.stop()
+        self.spool = self.createSpool()
+        self.spool.start()
+        self.assertEqual(self.spool.read()[0], [{'n': 1}])
+
+    def test_maxSize(self):
+        self.spool.maxSize = 64
+        self.assertTrue(self.spool.append([{'n': 1}]))
+        self.assertFalse(self.spool.append([{'n': 2}] * 10))
+
+    def test_managerFallback(self):
+        import kernel.pipe as pipe
+        from lib.publisher import BatchPublisher
+        publisher = BatchPublisher(self.spool.send, batchSize = 1,
+            linger = 0)
+        manager = pipe.Manager()
+        manager.dedupeWindow = 0
+        modulePublisher, moduleSpool = pipe.publisher, pipe.spool
+        try:
+            pipe.publisher, pipe.spool = publisher, self.spool
+            futures = [manager.sendPacketsViaBroker([{'n': n}])
+                for n in range(3)]
+            self.assertTrue(all(f.result(timeout = 1) for f in futures))
+            self.assertTrue(self.spool.degraded)
+            self.assertEqual(self.sent, [])
+            # the broker recovers during replay of the spool
+            self.failing = False
+            futures = [manager.sendPacketsViaBroker([{'n': n}])
+                for n in range(3, 30)]
+            self.assertTrue(all(f.result(timeout = 1) for f in futures))
+            self.assertTrue(self.waitFor(lambda: not self.spool.degraded))
+            self.assertEqual(self.sent, [{'n': n} for n in range(30)])
+        finally:
+            pipe.publisher, pipe.spool = modulePublisher, moduleSpool
+            publisher.stop()
+
+    def test_managerQueueFull(self):
+        import kernel.pipe as pipe
+        class TestPublisher:
+            calls = 0
+            def publish(self, packets):
+                self.calls += 1
+                raise queue.Full()
+        manager = pipe.Manager()
+        manager.dedupeWindow = 0
+        modulePublisher, moduleSpool = pipe.publisher, pipe.spool
+        try:
+            pipe.publisher, pipe.spool = TestPublisher(), self.spool
+            self.assertFalse(manager.send([{'n': 1}]).isSuccess())
+            # publisher queue is drained to the spool, but the handler
+            # does not wait for it twice
+            self.assertEqual(pipe.publisher.calls, 1)
+            self.assertTrue(self.spool.degraded)
+        finally:
+            pipe.publisher, pipe.spool = modulePublisher, moduleSpool
+
+    def test_failedBatchOrder(self):
+        # packets, which are queued behind a failed batch, are spooled
+        # after it, though the broker is available again
+        calls = []
+        def send(packets):
+            calls.append(packets)
+            return len(calls) > 1
+        self.spool._send = send
+        for n in range(3):
+            self.assertTrue(self.spool.send([{'n': n}]))
+        self.assertEqual(calls, [[{'n': 0}]])
+        self.assertTrue(self.waitFor(lambda: not self.spool.degraded))
+        self.assertEqual(calls[1:], [[{'n': 0}, {'n': 1}, {'n': 2}]])
+        self.assertTrue(self.spool.send([{'n': 3}]))
+        self.assertEqual(calls[-1], [{'n': 3}])
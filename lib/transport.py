@@ -0,0 +1,373 @@
+# -*- coding: utf8 -*-
+"""
+@project   Maprox <http://www.maprox.net>
+@info      Message transports of the message broker
+@copyright 2016, Maprox LLC
+"""
+
+import os
+import queue
+from threading import Lock
+
+from kombu import BrokerConnection, Queue, pools
+
+from kernel.config import conf
+from kernel.logger import log
+from kernel.database.streams import DatabaseStreams
+from lib.serializer import serialize, deserialize
+
+# reconnection policy of the publisher, so send() does not hang forever
+# when the message broker is unavailable
+PUBLISH_RETRY_POLICY = {
+    'max_retries': 3,
+    'interval_start': 0,
+    'interval_step': 1,
+    'interval_max': 3
+}
+
+# --------------------------------------------------------------------
+
+class AbstractTransport:
+    """
+     Transport delivers messages published by the message broker.
+     Messages are given as a list of tuples (routing key, body),
+     routing keys already contain the environment prefix.
+    """
+    # name of the transport in conf.messageTransport
+    name = None
+
+    def publish(self, exchange, messages, serializer = None):
+        """
+         Publishes messages. Raises exception on failure
+         @param exchange: kombu Exchange instance
+         @param messages: list of tuples (routing key, body)
+         @param serializer: Name of kombu serializer, json by default
+        """
+        raise NotImplementedError()
+
+    def reset(self):
+        """
+         Closes connections, they are opened again on the next publish()
+        """
+
+# --------------------------------------------------------------------
+
+class AmqpTransport(AbstractTransport):
+    """
+     AMQP transport (RabbitMQ), which uses kombu connection and producer
+     pools, so AMQP connections and channels are reused by all publish()
+     calls
+    """
+    name = 'amqp'
+
+    _connection = None
+    _connectionPid = None
+    _connectionUrl = None
+
+    def __init__(self):
+        """
+         Constructor
+        """
+        self._queues = {}
+        self._lock = Lock()
+
+    def getConnection(self):
+        """
+         Returns long-lived connection to the message broker.
+         It is a key of kombu connection and producer pools.
+         Connection is recreated in a forked process or when
+         conf.amqpConnection is changed.
+         @return: BrokerConnection
+        """
+        with self._lock:
+            connection = self._connection
+            if connection is None or \
+                    self._connectionPid != os.getpid() or \
+                    self._connectionUrl != conf.amqpConnection:
+                self._reset()
+                connection = BrokerConnection(conf.amqpConnection,
+                    transport_options = {
+                        'confirm_publish': conf.amqpConfirmPublish
+                    })
+                self._connection = connection
+                self._connectionUrl = conf.amqpConnection
+                self._connectionPid = os.getpid()
+            return connection
+
+    def reset(self):
+        """
+         Closes pooled connections, they are opened again on the next send()
+        """
+        with self._lock:
+            self._reset()
+
+    def _reset(self):
+        """
+         Closes pooled connections (must be called under the lock)
+        """
+        connection = self._connection
+        self._connection = None
+        if connection is None:
+            return
+        if self._connectionPid == os.getpid():
+            for group in (pools.producers, pools.connections):
+                try:
+                    group[connection].force_close_all()
+                    del group[connection]
+                except Exception as E:
+                    log.debug('BROKER: Error during pool reset: %s', E)
+        connection.release()
+
+    def getProducer(self):
+        """
+         Acquires producer from the pool.
+         Use it as a context manager, producer is returned to the pool
+         when the block is exited. Queues are declared by producers only
+         once per AMQP connection (kombu caches declared entities and
+         clears the cache on reconnect)
+         @return: kombu.Producer
+        """
+        return pools.producers[self.getConnection()].acquire(block = True)
+
+    def getQueue(self, routingKey, exchange):
+        """
+         Returns cached queue instance for the routing key
+         @param routingKey: str
+         @param exchange: Exchange instance
+         @return: Queue
+        """
+        key = (exchange.name, routingKey)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = Queue(routingKey,
+                exchange = exchange,
+                routing_key = routingKey)
+            self._queues[key] = queue
+        return queue
+
+    def publish(self, exchange, messages, serializer = None):
+        """
+         Publishes messages using pooled producer
+         @param exchange: kombu Exchange instance
+         @param messages: list of tuples (routing key, body)
+         @param serializer: Name of kombu serializer, json by default
+        """
+        with self.getProducer() as producer:
+            for routingKey, body in messages:
+                producer.publish(
+                    body,
+                    serializer = serializer,
+                    exchange = exchange,
+                    routing_key = routingKey,
+                    declare = [self.getQueue(routingKey, exchange)],
+                    retry = True,
+                    retry_policy = PUBLISH_RETRY_POLICY
+                )
+
+# --------------------------------------------------------------------
+
+class RedisStreamsTransport(AbstractTransport):
+    """
+     Redis streams transport.
+     Every routing key is a stream, messages of one publish() call are
+     appended by one pipelined round-trip.
+     Stream message has 'body' and its content 'type' fields.
+     Streams are not limited by length, their consumers remove
+     acknowledged messages (see DatabaseStreams.trim)
+    """
+    name = 'redis'
+
+    _store = None
+    _storePid = None
+
+    def __init__(self):
+        """
+         Constructor
+        """
+        self._lock = Lock()
+
+    def getStore(self):
+        """
+         Returns streams storage, it is recreated in a forked process
+         @return: DatabaseStreams
+        """
+        with self._lock:
+            if self._store is None or self._storePid != os.getpid():
+                self._store = DatabaseStreams()
+                self._storePid = os.getpid()
+            return self._store
+
+    def reset(self):
+        """
+         Closes redis connections
+        """
+        with self._lock:
+            store = self._store
+            self._store = None
+            if store is not None and self._storePid == os.getpid():
+                store.close()
+
+    def publish(self, exchange, messages, serializer = None):
+        """
+         Appends messages to streams of their routing keys
+         @param exchange: kombu Exchange instance
+         @param messages: list of tuples (routing key, body)
+         @param serializer: Name of kombu serializer, json by default
+        """
+        streamMessages = []
+        for routingKey, body in messages:
+            contentType, data = serialize(body, serializer)
+            streamMessages.append((routingKey,
+                {'body': data, 'type': contentType}))
+        self.getStore().add(streamMessages)
+
+    @staticmethod
+    def decode(fields):
+        """
+         Returns body of the stream message
+         @param fields: dict of stream message fields
+         @return: Message body
+        """
+        contentType = fields.get(b'type')
+        if contentType is None:
+            return deserialize(fields[b'body'])
+        return deserialize(fields[b'body'], contentType.decode())
+
+# --------------------------------------------------------------------
+
+class MemoryTransport(AbstractTransport):
+    """
+     In-process transport for tests and benchmarks.
+     Messages are kept in bounded local queues of routing keys and can be
+     read by consumers of the same process. Bodies are serialized like by
+     other transports, so consumers get copies of published messages and
+     serialization cost is measured by benchmarks.
+     Nothing reads these queues in the server, so it does not start
+     with this transport (see SERVER_TRANSPORTS)
+    """
+    name = 'memory'
+
+    def __init__(self, maxSize = 10000):
+        """
+         Constructor
+         @param maxSize: Maximum number of messages of a routing key
+        """
+        self.maxSize = maxSize
+        self._queues = {}
+        self._lock = Lock()
+
+    def getQueue(self, routingKey):
+        """
+         Returns local queue of the routing key
+         @param routingKey: str
+         @return: queue.Queue
+        """
+        with self._lock:
+            localQueue = self._queues.get(routingKey)
+            if localQueue is None:
+                localQueue = queue.Queue(self.maxSize)
+                self._queues[routingKey] = localQueue
+            return localQueue
+
+    def publish(self, exchange, messages, serializer = None):
+        """
+         Puts messages into local queues.
+         Raises queue.Full if a queue is full, then the rest of messages
+         are not published
+         @param exchange: kombu Exchange instance
+         @param messages: list of tuples (routing key, body)
+         @param serializer: Name of kombu serializer, json by default
+        """
+        for routingKey, body in messages:
+            self.getQueue(routingKey).put_nowait(serialize(body, serializer))
+
+    def get(self, routingKey, timeout = None):
+        """
+         Returns next message of the routing key.
+         Raises queue.Empty if there is no message during timeout
+         @param routingKey: str
+         @param timeout: Time to wait for message (seconds), None to wait
+           forever, 0 to return immediately
+         @return: message body
+        """
+        localQueue = self.getQueue(routingKey)
+        if timeout == 0:
+            contentType, data = localQueue.get_nowait()
+        else:
+            contentType, data = localQueue.get(timeout = timeout)
+        return deserialize(data, contentType)
+
+    def qsize(self, routingKey):
+        """
+         Returns number of messages of the routing key
+         @param routingKey: str
+         @return: int
+        """
+        return self.getQueue(routingKey).qsize()
+
+    def clear(self):
+        """
+         Drops all of queued messages
+        """
+        with self._lock:
+            self._queues = {}
+
+# --------------------------------------------------------------------
+
+# transports, which can be used by the server
+# (the memory transport is for tests and benchmarks only)
+SERVER_TRANSPORTS = ('amqp', 'redis')
+
+def getTransport(name):
+    """
+     Creates message transport
+     @param name: 'amqp', 'redis' or 'memory' (conf.messageTransport)
+     @return: AbstractTransport
+    """
+    if name == 'amqp':
+        return AmqpTransport()
+    if name == 'redis':
+        return RedisStreamsTransport()
+    if name == 'memory':
+        return MemoryTransport()
+    raise Exception('Unknown message transport "%s"' % name)
+
+# ===========================================================================
+# TESTS
+# ===========================================================================
+
+import unittest
+from kombu import Exchange
+
+class TestCase(unittest.TestCase):
+
+    def test_memoryTransport(self):
+        transport = getTransport('memory')
+        exchange = Exchange('mon.device', 'topic')
+        body = {'uid': '1', 'time': '2013-04-04T03:22:34.000000'}
+        transport.publish(exchange, [('key.1', body), ('key.2', {'n': 2})])
+        body['time'] = None
+        self.assertEqual(transport.qsize('key.1'), 1)
+        self.assertEqual(transport.get('key.1', 0),
+            {'uid': '1', 'time': '2013-04-04T03:22:34.000000'})
+        self.assertRaises(queue.Empty, transport.get, 'key.1', 0)
+        transport.reset()
+        self.assertEqual(transport.qsize('key.2'), 1)
+        transport.clear()
+        self.assertEqual(transport.qsize('key.2'), 0)
+        transport.publish(exchange, [('key.1', body)], 'pipe')
+        self.assertEqual(transport.get('key.1', 0), body)
+
+    def test_memoryTransportBound(self):
+        transport = MemoryTransport(maxSize = 1)
+        exchange = Exchange('mon.device', 'topic')
+        transport.publish(exchange, [('key.1', {'n': 1})])
+        self.assertRaises(queue.Full, transport.publish, exchange,
+            [('key.1', {'n': 2})])
+        self.assertEqual(transport.qsize('key.1'), 1)
+        self.assertEqual(transport.get('key.1', 0), {'n': 1})
+
+    def test_getTransport(self):
+        self.assertIsInstance(getTransport('amqp'), AmqpTransport)
+        self.assertIsInstance(getTransport('redis'), RedisStreamsTransport)
+        self.assertRaises(Exception, getTransport, 'unknown')
@@ -40,6 +40,24 @@ from lib.handlers.ime.abstract import TestCase as tc23
 from lib.handlers.ime.packets import TestCase as tc25
 from lib.handlers.ime.commands import TestCase as tc26
 from lib.handlers.globusgps.gltr1mini import TestCase as tc27
+from kernel.aioserver import TestCase as tc28
+from kernel.metrics import TestCase as tc29
+from lib.handlers.list import TestCase as tc30
+from kernel.server import TestCase as tc31
+from kernel.prefork import TestCase as tc32
+from lib.buffer import TestCase as tc33
+from lib.packets import TestCase as tc34
+from lib.broker import TestCase as tc35
+from lib.publisher import TestCase as tc36
+from lib.dedupe import TestCase as tc37
+from kernel.balancer import TestCase as tc38
+from kernel.database.balancer import TestCase as tc39
+from lib.transport import TestCase as tc40
+from kernel.streambalancer import TestCase as tc41
+from kernel.database.streams import TestCase as tc42
+from lib.serializer import TestCase as tc43
+from lib.spool import TestCase as tc44
+from lib.batch import TestCase as tc45
 
 if __name__ == '__main__':
     unittest.main()